@@ -8,6 +8,23 @@ from typing import Optional, Dict, Any, List
 import requests
 import time
 import re
+import math
+import io
+import csv
+import zlib
+import base64
+import struct
+import html
+import hmac
+import bisect
+import threading
+import signal
+import sys
+import random
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, Chat
 from telegram.ext import (
@@ -19,6 +36,8 @@ from telegram.ext import (
     filters,
     JobQueue
 )
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from aiohttp import web
 import json
 import aiohttp_cors
@@ -43,6 +62,8 @@ DATABASE_URL = (os.getenv("DATABASE_PUBLIC_URL") or
                 os.getenv("POSTGRES_URL"))
 
 TOKEN = os.getenv("TOKEN")
+# Bot API manzili (benchmark/test uchun soxta Telegram serveriga yo'naltirish mumkin)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip('/')
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "")
 
@@ -84,10 +105,391 @@ logger.info(f"🔧 PAYME_RECEIPTS_GROUP_ID: {PAYME_RECEIPTS_GROUP_ID}, parsed: {
 # Global application
 application = None
 
+# ==========================================
+# METRIKALAR (Prometheus text format)
+# ==========================================
+
+# Kechikish bucketlari (soniya)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+
+METRICS_REGISTRY = []
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """Faqat o'suvchi hisoblagich"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+    
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+    
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+    
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"
+                for key, value in list(self._values.items())]
+
+class Gauge(Counter):
+    """Ixtiyoriy qiymat (in-flight, hajm, ...)"""
+    
+    kind = 'gauge'
+    
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+    
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+class Histogram:
+    """Bucketli histogram: _bucket / _sum / _count"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label qiymatlari -> [bucket_1, ..., bucket_n, +Inf, sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+    
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+http_request_duration = Histogram(
+    'bodrum_http_request_duration_seconds', 'HTTP so\'rovlar kechikishi', ('route', 'method', 'status'))
+db_query_duration = Histogram(
+    'bodrum_db_query_duration_seconds', 'Nomlangan DB so\'rovlari kechikishi', ('query',))
+db_query_errors = Counter(
+    'bodrum_db_query_errors_total', 'DB so\'rovlari xatolari', ('query',))
+telegram_api_duration = Histogram(
+    'bodrum_telegram_api_duration_seconds', 'Telegram Bot API chaqiruvlari kechikishi', ('method',))
+telegram_api_errors = Counter(
+    'bodrum_telegram_api_errors_total', 'Telegram Bot API xatolari', ('method',))
+event_loop_lag = Histogram(
+    'bodrum_event_loop_lag_seconds', 'asyncio event loop kechikishi', (),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+webhook_in_flight = Gauge(
+    'bodrum_webhook_updates_in_flight', 'Qayta ishlanayotgan webhook update lar')
+webhook_in_flight.set(0)
+
+# Boshqa joylardagi hisoblagichlar (kesh va h.k.) render vaqtida o'qiladi
+METRICS_COLLECTORS = []
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS_REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for collector in METRICS_COLLECTORS:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            logger.error(f"❌ Metrika collector xatosi: {e}")
+    return "\n".join(lines) + "\n"
+
+# ==========================================
+# TRACING (so'rov bo'yicha span lar)
+# ==========================================
+
+# Root span lar ulushi (0..1). Tanlanmagan trace da span lar hech narsa qilmaydi
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+# Exporter: jsonl | otlp | off
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl").lower()
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_BUFFER_MAX = int(os.getenv("TRACE_BUFFER_MAX", "10000"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "bodrum-bot")
+# 1 - kiruvchi traceparent dagi sampled bayrog'iga ishoniladi (faqat ishonchli ichki chaqiruvchilar
+# orqasida). 0 - trace_id davom ettiriladi, lekin tanlash har doim TRACE_SAMPLE_RATE bo'yicha
+TRACE_TRUST_PARENT = os.getenv("TRACE_TRUST_PARENT", "0") == "1"
+
+_TRACEPARENT_RE = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+# Tugagan span lar - exporter davriy ravishda bo'shatadi (thread-safe append)
+finished_spans = deque(maxlen=TRACE_BUFFER_MAX)
+
+spans_dropped = Counter(
+    'bodrum_trace_spans_dropped_total', 'Bufer to\'lgani uchun tashlab yuborilgan span lar')
+
+class Span:
+    """Bitta operatsiya: trace_id / span_id / parent_id + vaqt va atributlar"""
+    
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes',
+                 'start_ns', 'end_ns', 'error', '_token')
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error = None
+        self._token = None
+    
+    def set(self, key: str, value):
+        self.attributes[key] = value
+    
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        if len(finished_spans) == finished_spans.maxlen:
+            spans_dropped.inc()
+        finished_spans.append(self)
+        return False
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+class _NoopSpan:
+    """Trace tanlanmaganda - deyarli bepul"""
+    
+    __slots__ = ()
+    
+    def set(self, key: str, value):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = _NoopSpan()
+
+def span(name: str, **attributes):
+    """Joriy trace ichida child span; trace bo'lmasa no-op"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple]:
+    """W3C traceparent -> (trace_id, parent_id, sampled). Noto'g'ri sarlavha - None (umuman yo'qdek)"""
+    match = _TRACEPARENT_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+def start_trace(name: str, traceparent: Optional[str] = None, **attributes):
+    """Root span: TRACE_SAMPLE_RATE bo'yicha (TRACE_TRUST_PARENT=1 da - traceparent qarori);
+    to'g'ri traceparent bo'lsa trace uning trace_id si bilan davom etadi"""
+    if TRACE_EXPORTER == 'off':
+        return NOOP_SPAN
+    parent = parse_traceparent(traceparent)
+    if parent and TRACE_TRUST_PARENT:
+        sampled = parent[2]
+    else:
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled:
+        return NOOP_SPAN
+    if parent:
+        return Span(name, parent[0], parent[1], attributes)
+    return Span(name, os.urandom(16).hex(), None, attributes)
+
+def current_traceparent() -> Optional[str]:
+    current = _current_span.get()
+    if current is None:
+        return None
+    return f"00-{current.trace_id}-{current.span_id}-01"
+
+class JsonlSpanExporter:
+    """Har bir span - bitta JSON qator (standart)"""
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def export(self, spans: List[Span]):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for item in spans:
+                f.write(json.dumps(item.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+class OtlpHttpSpanExporter:
+    """OTLP/HTTP JSON (Jaeger, Tempo, otel-collector :4318)"""
+    
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+    
+    @staticmethod
+    def _attribute(key: str, value) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+    
+    def export(self, spans: List[Span]):
+        otlp_spans = []
+        for item in spans:
+            otlp_span = {
+                'traceId': item.trace_id,
+                'spanId': item.span_id,
+                'name': item.name,
+                'kind': 1,
+                'startTimeUnixNano': str(item.start_ns),
+                'endTimeUnixNano': str(item.end_ns),
+                'attributes': [self._attribute(k, v) for k, v in item.attributes.items()],
+                'status': {'code': 2, 'message': item.error} if item.error else {'code': 1}
+            }
+            if item.parent_id:
+                otlp_span['parentSpanId'] = item.parent_id
+            otlp_spans.append(otlp_span)
+        
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [self._attribute('service.name', TRACE_SERVICE_NAME)]},
+            'scopeSpans': [{'scope': {'name': 'bodrum.tracing'}, 'spans': otlp_spans}]
+        }]}
+        response = requests.post(self.endpoint, json=payload, timeout=10)
+        response.raise_for_status()
+
+# Exporter nomi -> yaratuvchi; yangi exporter shu yerga qo'shiladi
+SPAN_EXPORTERS = {
+    'jsonl': lambda: JsonlSpanExporter(TRACE_EXPORT_PATH),
+    'otlp': lambda: OtlpHttpSpanExporter(TRACE_OTLP_ENDPOINT),
+}
+
+def flush_spans(exporter) -> int:
+    batch = []
+    while finished_spans:
+        try:
+            batch.append(finished_spans.popleft())
+        except IndexError:
+            break
+    if batch:
+        try:
+            exporter.export(batch)
+        except Exception as e:
+            spans_dropped.inc(amount=len(batch))
+            logger.error(f"❌ Trace export xatosi ({TRACE_EXPORTER}): {e}")
+    return len(batch)
+
+async def span_export_loop(exporter):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await loop.run_in_executor(None, flush_spans, exporter)
+    except asyncio.CancelledError:
+        await loop.run_in_executor(None, flush_spans, exporter)
+        raise
+
+async def start_tracing(app):
+    factory = SPAN_EXPORTERS.get(TRACE_EXPORTER)
+    if factory is None:
+        if TRACE_EXPORTER != 'off':
+            logger.error(f"❌ Noma'lum TRACE_EXPORTER: {TRACE_EXPORTER}")
+        return
+    app['span_export_task'] = asyncio.create_task(span_export_loop(factory()))
+    logger.info(f"🔭 Tracing: {TRACE_EXPORTER}, sample rate {TRACE_SAMPLE_RATE}")
+
+async def stop_tracing(app):
+    task = app.get('span_export_task')
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API chaqiruvlarini metod bo'yicha o'lchaydigan HTTPXRequest"""
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        with span('telegram.' + api_method) as api_span:
+            try:
+                code, payload = await super().do_request(url, method, request_data, **kwargs)
+            except Exception:
+                telegram_api_errors.inc(api_method)
+                raise
+            finally:
+                telegram_api_duration.observe(time.perf_counter() - started, api_method)
+            api_span.set('http.status_code', code)
+        if code >= 400:
+            telegram_api_errors.inc(api_method)
+        return code, payload
+
 # ==========================================
 # DATABASE FUNCTIONS
 # ==========================================
 
+# To'lanmagan (pending_payment) buyurtma shuncha soatdan keyin 'expired' bo'ladi.
+# 0 - o'chirilgan (standart): statusni avtomatik o'zgartirish faqat aniq yoqilganda
+ORDER_EXPIRE_HOURS = int(os.getenv("ORDER_EXPIRE_HOURS", "0"))
+# Delta sync: oxirgi N soniyada o'zgargan qatorlar kursorni oldinga surmaydi
+DELTA_SETTLE_SECONDS = int(os.getenv("DELTA_SETTLE_SECONDS", "2"))
+DELTA_MAX_LIMIT = 1000
+
 def init_database():
     """Jadval va column'larni avtomatik yaratish/yangilash"""
     conn = None
@@ -95,6 +497,9 @@ def init_database():
         conn = get_db_connection()
         cur = conn.cursor()
         
+        # O'zgarishlar ketma-ketligi (delta sync uchun)
+        cur.execute("CREATE SEQUENCE IF NOT EXISTS orders_change_seq")
+        
         # Orders jadvali
         cur.execute("""
             CREATE TABLE IF NOT EXISTS orders (
@@ -121,7 +526,13 @@ def init_database():
                 initiated_from VARCHAR(50) DEFAULT 'website',
                 source VARCHAR(50) DEFAULT 'website',
                 payme_receipt_id VARCHAR(100),
-                payme_card_mask VARCHAR(50)
+                payme_card_mask VARCHAR(50),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                change_seq BIGINT DEFAULT nextval('orders_change_seq'),
+                lat DOUBLE PRECISION,
+                lng DOUBLE PRECISION,
+                delivery_zone VARCHAR(100),
+                delivery_distance_m INTEGER
             )
         """)
         
@@ -136,21 +547,65 @@ def init_database():
             ('accepted_at', 'TIMESTAMP'),
             ('rejected_at', 'TIMESTAMP'),
             ('payme_receipt_id', 'VARCHAR(100)'),
-            ('payme_card_mask', 'VARCHAR(50)')
+            ('payme_card_mask', 'VARCHAR(50)'),
+            ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+            # Eski qatorlar ham ketma-ket raqam oladi (volatile default)
+            ('change_seq', 'BIGINT DEFAULT nextval(\'orders_change_seq\')'),
+            # create_order da bir marta hisoblanadi; eski qatorlar location matnidan o'qiladi
+            ('lat', 'DOUBLE PRECISION'),
+            ('lng', 'DOUBLE PRECISION'),
+            ('delivery_zone', 'VARCHAR(100)'),
+            ('delivery_distance_m', 'INTEGER')
         ]
         
-        for col_name, col_type in columns_to_check:
-            cur.execute(f"""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'orders' AND column_name = '{col_name}'
-            """)
-            if not cur.fetchone():
-                cur.execute(f"""
-                    ALTER TABLE orders 
-                    ADD COLUMN {col_name} {col_type}
-                """)
-                logger.info(f"✅ '{col_name}' ustuni qo'shildi")
+        # Sovuq tarix arxivi (ORDERS_ARCHIVE_MODE=archive): orders ustunlari + siqilgan items
+        cur.execute("CREATE TABLE IF NOT EXISTS orders_archive (LIKE orders)")
+        
+        # ALTER TABLE (hatto IF NOT EXISTS bilan ham) ACCESS EXCLUSIVE lock oladi va uzoq
+        # o'qishlar (eksport) ortida navbatda turadi - faqat yetishmayotgan ustun bo'lsa
+        cur.execute("""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name IN ('orders', 'orders_archive')
+        """)
+        existing = set(cur.fetchall())
+        
+        missing = [(col_name, col_type) for col_name, col_type in columns_to_check
+                   if ('orders', col_name) not in existing]
+        if missing:
+            cur.execute("ALTER TABLE orders " + ", ".join(
+                f"ADD COLUMN IF NOT EXISTS {col_name} {col_type}" for col_name, col_type in missing
+            ))
+            logger.info(f"✅ orders ga ustunlar qo'shildi: {', '.join(col_name for col_name, _ in missing)}")
+        
+        archive_columns = [(col_name, col_type.split(' DEFAULT')[0]) for col_name, col_type in columns_to_check]
+        archive_columns += [('items_z', 'BYTEA'), ('items_count', 'INTEGER')]
+        missing = [(col_name, col_type) for col_name, col_type in archive_columns
+                   if ('orders_archive', col_name) not in existing]
+        if missing:
+            cur.execute("ALTER TABLE orders_archive " + ", ".join(
+                f"ADD COLUMN IF NOT EXISTS {col_name} {col_type}" for col_name, col_type in missing
+            ))
+        
+        # Admin kartalari va admin jarayonlari (barcha replikalar uchun umumiy holat)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS order_messages (
+                order_pk BIGINT NOT NULL,
+                role VARCHAR(20) NOT NULL,
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (order_pk, role)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS admin_flows (
+                admin_id BIGINT PRIMARY KEY,
+                action VARCHAR(50) NOT NULL,
+                order_id VARCHAR(100),
+                expires_at TIMESTAMP NOT NULL
+            )
+        """)
         
         # Users jadvali
         cur.execute("""
@@ -166,12 +621,128 @@ def init_database():
         """)
         
         # Index'lar
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders(order_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_payment_status ON orders(payment_status)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_transaction_id ON orders(transaction_id)")
+        for statement in ORDER_INDEXES:
+            cur.execute(statement)
+        ensure_name_search_index(cur)
         cur.execute("CREATE INDEX IF NOT EXISTS idx_users_tg_id ON users(tg_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_order_id ON orders_archive(order_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_created_at ON orders_archive(created_at)")
+        
+        # ⭐ Har bir INSERT/UPDATE da updated_at va change_seq ni trigger yangilaydi
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION orders_touch_change_seq() RETURNS trigger AS $$
+            BEGIN
+                NEW.change_seq := nextval('orders_change_seq');
+                NEW.updated_at := CURRENT_TIMESTAMP;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'trg_orders_change_seq' AND tgrelid = 'orders'::regclass")
+        if not cur.fetchone():
+            cur.execute(ORDERS_TRIGGER_SQL)
+            logger.info("✅ orders change_seq trigger yaratildi")
+        
+        # ⭐ Ro'yxat versiyasi: bitta qator, har bir yozuvchi statement oshiradi. Qator qulfi commit
+        # gacha ushlanadi - versiyalar commit tartibida ko'rinadi (change_seq nextval dan farqli)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS orders_version (
+                id SMALLINT PRIMARY KEY CHECK (id = 1),
+                version BIGINT NOT NULL
+            )
+        """)
+        cur.execute("""
+            INSERT INTO orders_version (id, version)
+            SELECT 1, COALESCE(MAX(change_seq), 0) FROM orders
+            ON CONFLICT (id) DO NOTHING
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION orders_bump_version() RETURNS trigger AS $$
+            BEGIN
+                UPDATE orders_version SET version = version + 1 WHERE id = 1;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'trg_orders_version' AND tgrelid = 'orders'::regclass")
+        if not cur.fetchone():
+            cur.execute(ORDERS_VERSION_TRIGGER_SQL)
+            logger.info("✅ orders_version trigger yaratildi")
+        
+        # Buyurtma bosqichlari davomiyligi (lifecycle analitikasi)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS order_stage_durations (
+                order_pk INTEGER NOT NULL,
+                stage VARCHAR(30) NOT NULL,
+                started_at TIMESTAMP NOT NULL,
+                ended_at TIMESTAMP NOT NULL,
+                duration_seconds DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (order_pk, stage)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_stage_durations_stage_ended ON order_stage_durations(stage, ended_at)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS analytics_watermarks (
+                name VARCHAR(50) PRIMARY KEY,
+                value BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Payme Merchant API tranzaksiyalari (payme_id bo'yicha idempotent)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS payme_transactions (
+                id BIGSERIAL PRIMARY KEY,
+                payme_id VARCHAR(64) UNIQUE NOT NULL,
+                order_id VARCHAR(100) NOT NULL,
+                order_pk BIGINT NOT NULL,
+                order_created_at TIMESTAMP NOT NULL,
+                amount BIGINT NOT NULL,
+                state SMALLINT NOT NULL DEFAULT 1,
+                reason SMALLINT,
+                payme_time BIGINT NOT NULL,
+                create_time BIGINT NOT NULL,
+                perform_time BIGINT NOT NULL DEFAULT 0,
+                cancel_time BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+        # Bitta buyurtmaga bir vaqtda faqat bitta faol (yoki bajarilgan) tranzaksiya
+        cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_payme_transactions_active_order
+            ON payme_transactions(order_id) WHERE state IN (1, 2)
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_payme_transactions_payme_time ON payme_transactions(payme_time)")
+        
+        # Umumiy rate limit bucketlari (RATE_LIMIT_BACKEND=postgres) - yo'qolsa bucketlar to'liq boshlanadi
+        if RATE_LIMIT_BACKEND == 'postgres':
+            cur.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+                    key VARCHAR(200) PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    capacity DOUBLE PRECISION NOT NULL,
+                    rate DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL,
+                    allowed BOOLEAN NOT NULL
+                )
+            """)
+        
+        # Sekin so'rovlar rejalari (SLOW_QUERY_EXPLAIN=table)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS slow_query_plans (
+                id SERIAL PRIMARY KEY,
+                query_name VARCHAR(100) NOT NULL,
+                duration_ms REAL NOT NULL,
+                params TEXT,
+                analyzed BOOLEAN DEFAULT FALSE,
+                plan JSONB,
+                captured_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # 📆 Oylik partitsiyalar (ORDERS_PARTITIONING=1): bir martalik migratsiya
+        if ORDERS_PARTITIONING:
+            migrate_orders_to_partitions(cur)
+            ensure_order_partitions(cur)
         
         conn.commit()
         cur.close()
@@ -187,66 +758,1204 @@ def init_database():
         if conn:
             conn.close()
 
-def get_db_connection():
+# ==========================================
+# ORDERS PARTITSIYALARI (oylik) VA ARXIV
+# ==========================================
+
+# 1 - orders ni created_at bo'yicha oylik partitsiyalarga o'tkazish (lider, bir marta)
+ORDERS_PARTITIONING = os.getenv("ORDERS_PARTITIONING", "0") == "1"
+ORDERS_PARTITIONS_AHEAD = int(os.getenv("ORDERS_PARTITIONS_AHEAD", "2"))
+# Partitsiyalangan jadvalda issiq so'rovlar (admin ro'yxati, yangi buyurtmalar, statistika)
+# shu kunlar bilan cheklanadi
+ORDERS_HOT_DAYS = int(os.getenv("ORDERS_HOT_DAYS", "30"))
+# ORD_<ms>_... ID sidagi vaqt va created_at orasidagi ruxsat etilgan farq
+ORDER_ID_TIME_SLACK = timedelta(days=int(os.getenv("ORDER_ID_TIME_SLACK_DAYS", "2")))
+# Arxiv: off | detach (partitsiyani ajratib qo'yish) | archive (orders_archive ga ko'chirish)
+ORDERS_ARCHIVE_MODE = os.getenv("ORDERS_ARCHIVE_MODE", "off").lower()
+ORDERS_ARCHIVE_AFTER_MONTHS = int(os.getenv("ORDERS_ARCHIVE_AFTER_MONTHS", "12"))
+# archive rejimida items: keep | compress (zlib, items_z) | strip (faqat items_count)
+ORDERS_ARCHIVE_ITEMS = os.getenv("ORDERS_ARCHIVE_ITEMS", "keep").lower()
+
+# Qidiruv uchun telefon: faqat raqamlar, oxirgi 9 tasi (normalize_phone_digits bilan bir xil qoida).
+# Ustun emas, ifoda indeksi - STORED ustun qo'shish butun jadvalni ACCESS EXCLUSIVE ostida qayta yozadi
+PHONE_DIGITS_SQL = r"right(regexp_replace(phone, '\D', '', 'g'), 9)"
+
+ORDER_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders(order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_payment_status ON orders(payment_status)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_transaction_id ON orders(transaction_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_change_seq ON orders(change_seq)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_tg_id_created ON orders(tg_id, created_at DESC, id DESC)",
+    # Qidiruv: "#ab12cd" suffiksi va telefon raqami bo'yicha prefiks (LIKE 'x%')
+    "CREATE INDEX IF NOT EXISTS idx_orders_order_id_reverse ON orders(reverse(lower(order_id)) text_pattern_ops)",
+    f"CREATE INDEX IF NOT EXISTS idx_orders_phone_digits ON orders(({PHONE_DIGITS_SQL}) text_pattern_ops)",
+]
+
+def ensure_name_search_index(cur) -> bool:
+    """Ism bo'yicha trigram indeksi. pg_trgm o'rnatib bo'lmasa (huquq yo'q) qidiruv indekssiz ishlaydi"""
+    cur.execute("SAVEPOINT name_search_index")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_name_trgm ON orders USING gin (lower(name) gin_trgm_ops)")
+        cur.execute("RELEASE SAVEPOINT name_search_index")
+        return True
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT name_search_index")
+        logger.warning(f"⚠️ pg_trgm mavjud emas - ism qidiruvi indekssiz: {e}")
+        return False
+
+ORDERS_TRIGGER_SQL = """
+    CREATE TRIGGER trg_orders_change_seq
+    BEFORE INSERT OR UPDATE ON orders
+    FOR EACH ROW EXECUTE FUNCTION orders_touch_change_seq()
+"""
+ORDERS_VERSION_TRIGGER_SQL = """
+    CREATE TRIGGER trg_orders_version
+    AFTER INSERT OR UPDATE OR DELETE ON orders
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_bump_version()
+"""
+
+def orders_hot_bound(since: str = "CURRENT_TIMESTAMP") -> str:
+    """Issiq oyna sharti (SQL matni). Faqat ORDERS_PARTITIONING da - partitsiya pruning uchun;
+    oddiy jadvalda eski, hali ko'rib chiqilmagan buyurtmalar ro'yxat va hisoblardan tushib qolmasin"""
+    if not ORDERS_PARTITIONING:
+        return ""
+    return f"AND created_at > {since} - make_interval(days => {ORDERS_HOT_DAYS})"
+
+_PARTITION_NAME_RE = re.compile(r'^orders_p(\d{4})_(\d{2})$')
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+def _next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+def order_created_bounds(order_id: str) -> Optional[tuple]:
+    """ORD_<ms>_xxx -> (created_at dan, gacha) partitsiya pruning uchun; boshqa formatda None"""
+    match = re.match(r'ORD_(\d{12,14})', order_id or '', re.IGNORECASE)
+    if not match:
+        return None
+    created = datetime.utcfromtimestamp(int(match.group(1)) / 1000)
+    return created - ORDER_ID_TIME_SLACK, created + ORDER_ID_TIME_SLACK
+
+def orders_is_partitioned(cur) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('orders')")
+    row = cur.fetchone()
+    return bool(row) and row[0] == 'p'
+
+def ensure_order_partitions(cur, start: Optional[datetime] = None) -> int:
+    """start oyidan ORDERS_PARTITIONS_AHEAD oy oldinga partitsiyalar (+ DEFAULT)"""
+    month = _month_start(start or datetime.utcnow())
+    last = _month_start(datetime.utcnow())
+    for _ in range(ORDERS_PARTITIONS_AHEAD):
+        last = _next_month(last)
+    
+    created = 0
+    while month <= last:
+        name = f"orders_p{month:%Y_%m}"
+        cur.execute("SELECT to_regclass(%s)", (name,))
+        if cur.fetchone()[0] is None:
+            cur.execute(
+                f"CREATE TABLE {name} PARTITION OF orders FOR VALUES FROM (%s) TO (%s)",
+                (month, _next_month(month))
+            )
+            created += 1
+        month = _next_month(month)
+    cur.execute("CREATE TABLE IF NOT EXISTS orders_default PARTITION OF orders DEFAULT")
+    return created
+
+def migrate_orders_to_partitions(cur) -> bool:
+    """Oddiy orders jadvalini RANGE (created_at) partitsiyalanganiga o'tkazish.
+    Bitta tranzaksiyada: eski jadval orders_legacy bo'lib qoladi (qo'lda o'chiriladi)."""
+    if orders_is_partitioned(cur):
+        return False
+    
+    started = time.perf_counter()
+    cur.execute("LOCK TABLE orders IN ACCESS EXCLUSIVE MODE")
+    cur.execute("SELECT MIN(COALESCE(created_at, updated_at, CURRENT_TIMESTAMP)) FROM orders")
+    oldest = cur.fetchone()[0] or datetime.utcnow()
+    cur.execute("SELECT pg_get_serial_sequence('orders', 'id')")
+    id_sequence = cur.fetchone()[0]
+    
+    # Indeks/constraint nomlari sxema bo'yicha yagona - eskilariga _legacy qo'shimchasi
+    cur.execute("ALTER TABLE orders RENAME TO orders_legacy")
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'orders_legacy'")
+    for (index_name,) in cur.fetchall():
+        cur.execute(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_legacy"')
+    cur.execute("DROP TRIGGER IF EXISTS trg_orders_change_seq ON orders_legacy")
+    cur.execute("DROP TRIGGER IF EXISTS trg_orders_version ON orders_legacy")
+    if id_sequence:
+        cur.execute(f"ALTER SEQUENCE {id_sequence} OWNED BY NONE")
+    
+    # PK/UNIQUE partitsiya kalitini o'z ichiga olishi shart
+    cur.execute("CREATE TABLE orders (LIKE orders_legacy INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE (created_at)")
+    cur.execute("ALTER TABLE orders ALTER COLUMN created_at SET NOT NULL")
+    cur.execute("ALTER TABLE orders ADD PRIMARY KEY (id, created_at)")
+    cur.execute("ALTER TABLE orders ADD CONSTRAINT orders_order_id_created_key UNIQUE (order_id, created_at)")
+    ensure_order_partitions(cur, oldest)
+    
+    columns = ', '.join(ORDER_COLUMNS)
+    source_columns = ', '.join(
+        'COALESCE(created_at, updated_at, CURRENT_TIMESTAMP)' if col == 'created_at' else col
+        for col in ORDER_COLUMNS
+    )
+    cur.execute(f"INSERT INTO orders ({columns}) SELECT {source_columns} FROM orders_legacy")
+    copied = cur.rowcount
+    
+    if id_sequence:
+        cur.execute(f"ALTER SEQUENCE {id_sequence} OWNED BY orders.id")
+    for statement in ORDER_INDEXES:
+        cur.execute(statement)
+    ensure_name_search_index(cur)
+    # Trigger nusxadan keyin - ko'chirilgan qatorlarning change_seq o'zgarmaydi
+    cur.execute(ORDERS_TRIGGER_SQL)
+    cur.execute(ORDERS_VERSION_TRIGGER_SQL)
+    
+    logger.info(f"✅ orders partitsiyalandi: {copied} ta qator, "
+                f"{(time.perf_counter() - started) * 1000:.0f} ms (eski jadval: orders_legacy)")
+    return True
+
+def orders_archive_cutoff() -> datetime:
+    """Shu oydan oldingi partitsiyalar sovuq (arxivlanadi yoki ajratiladi)"""
+    cutoff = _month_start(datetime.utcnow())
+    for _ in range(ORDERS_ARCHIVE_AFTER_MONTHS):
+        cutoff = _month_start(cutoff - timedelta(days=1))
+    return cutoff
+
+def _cold_partitions(cur) -> List[str]:
+    cutoff = orders_archive_cutoff()
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'orders'::regclass
+    """)
+    cold = []
+    for (name,) in cur.fetchall():
+        match = _PARTITION_NAME_RE.match(name)
+        if match and datetime(int(match.group(1)), int(match.group(2)), 1) < cutoff:
+            cold.append(name)
+    return sorted(cold)
+
+def _archive_partition(cur, name: str) -> int:
+    """Partitsiya qatorlarini orders_archive ga ko'chirib, partitsiyani o'chirish"""
+    columns = [col for col in ORDER_COLUMNS if col != 'items']
+    column_list = ', '.join(columns)
+    items_count = "CASE WHEN jsonb_typeof(items) = 'array' THEN jsonb_array_length(items) END"
+    
+    if ORDERS_ARCHIVE_ITEMS == 'compress':
+        read = cur.connection.cursor(name=f"archive_{name}")
+        read.itersize = 500
+        read.execute(f"SELECT {column_list}, items::text, {items_count} FROM {name}")
+        moved = 0
+        while True:
+            rows = read.fetchmany(500)
+            if not rows:
+                break
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO orders_archive ({column_list}, items_z, items_count) VALUES %s",
+                [row[:-2] + (zlib.compress(row[-2].encode()) if row[-2] else None, row[-1]) for row in rows]
+            )
+            moved += len(rows)
+        read.close()
+    else:
+        items = 'items' if ORDERS_ARCHIVE_ITEMS == 'keep' else 'NULL'
+        cur.execute(f"""
+            INSERT INTO orders_archive ({column_list}, items, items_count)
+            SELECT {column_list}, {items}, {items_count} FROM {name}
+        """)
+        moved = cur.rowcount
+    
+    cur.execute(f"ALTER TABLE orders DETACH PARTITION {name}")
+    cur.execute(f"DROP TABLE {name}")
+    return moved
+
+def maintain_order_partitions() -> Dict[str, Any]:
+    """Lider job: oldindagi partitsiyalar + sovuq partitsiyalarni arxivlash"""
+    result = {'created': 0, 'archived': []}
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        if not orders_is_partitioned(cur):
+            cur.close()
+            return result
+        
+        result['created'] = ensure_order_partitions(cur)
+        conn.commit()
+        
+        if ORDERS_ARCHIVE_MODE in ('detach', 'archive'):
+            for name in _cold_partitions(cur):
+                if ORDERS_ARCHIVE_MODE == 'detach':
+                    cur.execute(f"ALTER TABLE orders DETACH PARTITION {name}")
+                    cur.execute(f"ALTER TABLE {name} RENAME TO {name.replace('orders_p', 'orders_archived_p')}")
+                    moved = None
+                else:
+                    moved = _archive_partition(cur, name)
+                conn.commit()
+                result['archived'].append(name)
+                logger.info(f"🗄 {name} arxivlandi ({ORDERS_ARCHIVE_MODE}, {moved if moved is not None else '-'} qator)")
+        
+        cur.close()
+        return result
+    except Exception as e:
+        logger.error(f"❌ Partitsiya xizmati xatosi: {e}")
+        if conn:
+            conn.rollback()
+        return result
+    finally:
+        if conn:
+            conn.close()
+
+# ==========================================
+# READ REPLIKALAR VA ULANISH MARSHRUTI
+# ==========================================
+
+# Vergul bilan ajratilgan replika URL lari (bo'sh - hammasi primary ga)
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Shundan ko'p orqada qolgan replika ishlatilmaydi (soniya)
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+# Replika lag ini shuncha soniyada bir marta tekshirish (o'sha ulanishning o'zida)
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+# Ishlamagan replika shuncha soniya chetlab o'tiladi
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "2"))
+# Primary ga ulanish shuncha soniyadan ko'p kutilmaydi (Postgres sekinlashsa thread lar osilib qolmaydi)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+# Read-your-writes: yozuvdan keyin (replika lag + shu zaxira) soniya primary dan o'qiladi
+READ_YOUR_WRITES_MARGIN = float(os.getenv("READ_YOUR_WRITES_MARGIN", "1"))
+
+db_connections_total = Counter(
+    'bodrum_db_connections_total', 'Ochilgan DB ulanishlari', ('target',))
+replica_lag_seconds = Gauge(
+    'bodrum_db_replica_lag_seconds', 'Oxirgi o\'lchangan replika lag', ('replica',))
+
+class ReplicaState:
+    __slots__ = ('index', 'url', 'lag', 'checked_at', 'down_until')
+    
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.lag = 0.0
+        self.checked_at = 0.0
+        self.down_until = 0.0
+
+replicas = [ReplicaState(i, url) for i, url in enumerate(DATABASE_REPLICA_URLS)]
+_replica_cursor = 0
+# consistency kaliti ('orders', 'user:<tg_id>') -> oxirgi yozuv vaqti (monotonic)
+recent_writes: Dict[str, float] = {}
+_routing_lock = threading.Lock()
+
+def note_write(*keys: str):
+    """Yozuvdan keyin: shu kalitlar bo'yicha o'qishlar vaqtincha primary ga"""
+    now = time.monotonic()
+    for key in keys:
+        recent_writes[key] = now
+
+def _check_replica_lag(conn, replica: ReplicaState) -> float:
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """)
+    lag = float(cur.fetchone()[0])
+    cur.close()
+    conn.rollback()
+    replica.lag = lag
+    replica.checked_at = time.monotonic()
+    replica_lag_seconds.set(lag, str(replica.index))
+    return lag
+
+def _replica_connection(consistency_key: Optional[str]):
+    """Sog'lom va yetarlicha yangi replika ulanishi yoki None (primary ga fallback)"""
+    global _replica_cursor
+    with _routing_lock:
+        start = _replica_cursor
+        _replica_cursor = (_replica_cursor + 1) % len(replicas)
+    
+    now = time.monotonic()
+    last_write = recent_writes.get(consistency_key) if consistency_key else None
+    for offset in range(len(replicas)):
+        replica = replicas[(start + offset) % len(replicas)]
+        if replica.down_until > now:
+            continue
+        # Read-your-writes: replika hali bu yozuvni ko'rmagan bo'lishi mumkin
+        if last_write is not None and now - last_write < replica.lag + READ_YOUR_WRITES_MARGIN:
+            continue
+        
+        conn = None
+        try:
+            conn = psycopg2.connect(replica.url, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+            if now - replica.checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+                lag = _check_replica_lag(conn, replica)
+                if lag > REPLICA_MAX_LAG_SECONDS:
+                    logger.warning(f"⚠️ Replika #{replica.index} orqada: {lag:.1f} s")
+                    replica.down_until = now + REPLICA_LAG_CHECK_INTERVAL
+                    conn.close()
+                    continue
+                if last_write is not None and now - last_write < lag + READ_YOUR_WRITES_MARGIN:
+                    conn.close()
+                    continue
+            return conn
+        except Exception as e:
+            logger.error(f"❌ Replika #{replica.index} ulanish xatosi: {e}")
+            replica.down_until = now + REPLICA_RETRY_SECONDS
+            if conn:
+                conn.close()
+    return None
+
+def get_db_connection(readonly: bool = False, consistency_key: Optional[str] = None):
+    """readonly=True - replikaga (bo'lsa); consistency_key bo'yicha yaqinda yozilgan
+    ma'lumot va orqada qolgan/ishlamayotgan replikalar uchun primary ga fallback"""
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL not set!")
+    if readonly and replicas:
+        conn = _replica_connection(consistency_key)
+        if conn is not None:
+            db_connections_total.inc('replica')
+            return conn
+        db_connections_total.inc('primary_fallback')
+    else:
+        db_connections_total.inc('primary')
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+        # Oddiy tuple cursor - qatorlar Order/UserProfile modellariga pozitsiya bo'yicha o'giriladi
+        conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
         return conn
     except Exception as e:
         logger.error(f"Database connection error: {e}")
         raise
 
 # ==========================================
-# TELEGRAM BOT API DIRECT FUNCTIONS
+# NOMLANGAN SO'ROVLAR VA SEKIN SO'ROVLAR LOGI
 # ==========================================
 
-def send_telegram_message(chat_id: int, text: str, parse_mode: str = 'HTML', reply_markup=None) -> bool:
-    """Direct API call to send message"""
-    if not TOKEN:
-        logger.error("❌ TOKEN not set")
-        return False
+# Shu chegaradan sekin so'rovlar logga yoziladi (ms)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Sekin so'rov rejasini saqlash: off | file | table
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "off").lower()
+SLOW_QUERY_EXPLAIN_PATH = os.getenv("SLOW_QUERY_EXPLAIN_PATH", "slow_query_plans.jsonl")
+# Bitta so'rov nomi uchun EXPLAIN ko'pi bilan shuncha soniyada bir marta
+SLOW_QUERY_EXPLAIN_INTERVAL = int(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+
+# name -> (sql, read_only)
+QUERIES: Dict[str, tuple] = {}
+
+slow_queries_total = Counter(
+    'bodrum_db_slow_queries_total', 'SLOW_QUERY_MS dan sekin so\'rovlar', ('query',))
+
+_explain_last_run: Dict[str, float] = {}
+_explain_lock = threading.Lock()
+
+def register_query(name: str, sql: str, read_only: bool = False) -> str:
+    """So'rovni nomi bilan ro'yxatga olish. read_only - EXPLAIN ANALYZE xavfsiz"""
+    QUERIES[name] = (sql, read_only)
+    return name
+
+def _redact_params(params) -> str:
+    """Parametr qiymatlari logga tushmaydi - faqat turi va uzunligi"""
+    if params is None:
+        return "()"
+    redacted = []
+    for value in params:
+        if value is None:
+            redacted.append("NULL")
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        elif isinstance(value, (list, tuple)):
+            redacted.append(f"<array:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return "(" + ", ".join(redacted) + ")"
+
+def execute_named(cur, name: str, params=None, sql: str = None):
+    """Ro'yxatdagi so'rovni bajarish: vaqt metrikasi + sekin so'rov logi.
+    sql berilsa (dinamik so'rovlar) shu matn bajariladi - name faqat metrika va log uchun."""
+    if sql is None:
+        sql, read_only = QUERIES[name]
+    else:
+        read_only = name in QUERIES and QUERIES[name][1]
+    started = time.perf_counter()
+    try:
+        with span('db.' + name):
+            cur.execute(sql, params)
+    except Exception:
+        db_query_errors.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        db_query_duration.observe(elapsed, name)
     
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        slow_queries_total.inc(name)
+        logger.warning(f"🐢 Sekin so'rov {name}: {elapsed_ms:.1f} ms, params={_redact_params(params)}")
+        if SLOW_QUERY_EXPLAIN in ('file', 'table') and _explain_due(name):
+            threading.Thread(
+                target=capture_query_plan,
+                args=(name, sql, params, read_only, elapsed_ms),
+                daemon=True
+            ).start()
+
+def _explain_due(name: str) -> bool:
+    now = time.monotonic()
+    with _explain_lock:
+        last = _explain_last_run.get(name)
+        if last is not None and now - last < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        _explain_last_run[name] = now
+        return True
+
+def capture_query_plan(name: str, sql: str, params, read_only: bool, duration_ms: float):
+    """Alohida ulanishda EXPLAIN olish. ANALYZE so'rovni qayta bajaradi,
+    shuning uchun faqat read_only so'rovlarda; yozuvchi so'rovlar uchun oddiy EXPLAIN."""
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if read_only else "FORMAT JSON"
+    conn = None
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': text,
-            'parse_mode': parse_mode
+        conn = get_db_connection(readonly=read_only and SLOW_QUERY_EXPLAIN != 'table')
+        cur = conn.cursor()
+        cur.execute(f"EXPLAIN ({options}) {sql}", params)
+        plan = cur.fetchone()[0]
+        conn.rollback()
+        
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        record = {
+            "query": name,
+            "duration_ms": round(duration_ms, 1),
+            "params": _redact_params(params),
+            "analyzed": read_only,
+            "captured_at": datetime.utcnow().isoformat(),
+            "plan": plan
         }
-        if reply_markup:
-            payload['reply_markup'] = json.dumps(reply_markup.to_dict() if hasattr(reply_markup, 'to_dict') else reply_markup)
         
-        response = requests.post(url, json=payload, timeout=10)
-        result = response.json()
-        
-        if result.get('ok'):
-            logger.info(f"✅ Message sent to {chat_id}")
-            return True
+        if SLOW_QUERY_EXPLAIN == 'table':
+            cur.execute("""
+                INSERT INTO slow_query_plans (query_name, duration_ms, params, analyzed, plan)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (name, record["duration_ms"], record["params"], read_only, json.dumps(plan)))
+            conn.commit()
         else:
-            logger.error(f"❌ Telegram API error: {result}")
-            return False
+            with _explain_lock:
+                with open(SLOW_QUERY_EXPLAIN_PATH, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        cur.close()
+        logger.info(f"🔍 {name} uchun EXPLAIN saqlandi ({SLOW_QUERY_EXPLAIN})")
     except Exception as e:
-        logger.error(f"❌ send_telegram_message error: {e}")
-        return False
+        logger.error(f"❌ EXPLAIN capture error ({name}): {e}")
+    finally:
+        if conn:
+            conn.close()
 
-def send_telegram_location(chat_id: int, latitude: float, longitude: float) -> bool:
-    """Direct API call to send location"""
-    if not TOKEN:
-        return False
-    
-    try:
-        url = f"https://api.telegram.org/bot{TOKEN}/sendLocation"
-        payload = {
-            'chat_id': chat_id,
-            'latitude': latitude,
-            'longitude': longitude
-        }
-        response = requests.post(url, json=payload, timeout=10)
-        return response.json().get('ok', False)
-    except Exception as e:
-        logger.error(f"❌ send_telegram_location error: {e}")
-        return False
+# JSONB ni psycopg2 parse qilmaydi - Order.items kerak bo'lganda bir marta parse qiladi,
+# ro'yxat endpointlari esa xom JSON matnini to'g'ridan-to'g'ri javobga qo'yadi
+psycopg2.extras.register_default_jsonb(globally=True, loads=lambda raw: raw)
+
+# ==========================================
+# ORDER / USER MODELLARI
+# ==========================================
+
+# SELECT ustunlari tartibi = Order.__init__ argumentlari tartibi
+ORDER_COLUMNS = (
+    'id', 'order_id', 'name', 'phone', 'items', 'total', 'status', 'payment_status',
+    'payment_method', 'location', 'tg_id', 'notified', 'created_at', 'accepted_at',
+    'rejected_at', 'paid_at', 'confirmed_at', 'admin_note', 'transaction_id',
+    'auto_accepted', 'initiated_from', 'source', 'payme_receipt_id', 'payme_card_mask',
+    'updated_at', 'change_seq', 'lat', 'lng', 'delivery_zone', 'delivery_distance_m'
+)
+ORDER_SELECT = ', '.join(ORDER_COLUMNS)
+ORDER_SELECT_O = ', '.join(f"o.{col}" for col in ORDER_COLUMNS)
+
+_UNSET = object()
+
+class Order:
+    """orders jadvalidagi bitta qator"""
+    
+    __slots__ = tuple(col for col in ORDER_COLUMNS if col != 'items') + ('_items', '_coords')
+    
+    def __init__(self, id, order_id, name, phone, items, total, status, payment_status,
+                 payment_method, location, tg_id, notified, created_at, accepted_at,
+                 rejected_at, paid_at, confirmed_at, admin_note, transaction_id,
+                 auto_accepted, initiated_from, source, payme_receipt_id, payme_card_mask,
+                 updated_at, change_seq, lat, lng, delivery_zone, delivery_distance_m):
+        self.id = id
+        self.order_id = order_id
+        self.name = name
+        self.phone = phone
+        self._items = items
+        self.total = total
+        self.status = status
+        self.payment_status = payment_status
+        self.payment_method = payment_method
+        self.location = location
+        self.tg_id = tg_id
+        self.notified = notified
+        self.created_at = created_at
+        self.accepted_at = accepted_at
+        self.rejected_at = rejected_at
+        self.paid_at = paid_at
+        self.confirmed_at = confirmed_at
+        self.admin_note = admin_note
+        self.transaction_id = transaction_id
+        self.auto_accepted = auto_accepted
+        self.initiated_from = initiated_from
+        self.source = source
+        self.payme_receipt_id = payme_receipt_id
+        self.payme_card_mask = payme_card_mask
+        self.updated_at = updated_at
+        self.change_seq = change_seq
+        self.lat = lat
+        self.lng = lng
+        self.delivery_zone = delivery_zone
+        self.delivery_distance_m = delivery_distance_m
+        self._coords = _UNSET
+    
+    @property
+    def items(self) -> List[Dict[str, Any]]:
+        """Mahsulotlar - faqat birinchi murojaatda parse qilinadi"""
+        if isinstance(self._items, str):
+            try:
+                self._items = json.loads(self._items)
+            except ValueError:
+                self._items = []
+        if not isinstance(self._items, list):
+            self._items = []
+        return self._items
+    
+    @property
+    def coords(self) -> Optional[tuple]:
+        """(lat, lng) - raqamli ustunlardan; eski qatorlarda 'lat,lng' matni bir marta parse qilinadi"""
+        if self._coords is _UNSET:
+            if self.lat is not None and self.lng is not None:
+                self._coords = (self.lat, self.lng)
+            else:
+                self._coords = parse_location(self.location)
+                if self._coords is None and self.location and ',' in str(self.location):
+                    logger.warning(f"Joylashuv parse xatosi: {self.location}")
+        return self._coords
+    
+    @property
+    def short_id(self) -> str:
+        return str(self.order_id or 'N/A')[-6:]
+    
+    @property
+    def has_customer(self) -> bool:
+        return bool(self.tg_id) and str(self.tg_id) not in ['0', 'None', '', 'null']
+    
+    def _fields_dict(self) -> Dict[str, Any]:
+        """items dan tashqari barcha ustunlar, vaqtlar isoformat da"""
+        data = {}
+        for col in ORDER_COLUMNS:
+            if col == 'items':
+                continue
+            value = getattr(self, col)
+            if value is not None and hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            data[col] = value
+        return data
+    
+    def to_dict(self) -> Dict[str, Any]:
+        data = self._fields_dict()
+        data['items'] = self.items
+        return data
+    
+    def to_json(self) -> str:
+        """JSON matn. items parse qilinmagan bo'lsa xom JSONB matni qo'yiladi"""
+        if isinstance(self._items, str):
+            head = json.dumps(self._fields_dict())
+            return f'{head[:-1]}, "items": {self._items}}}'
+        return json.dumps(self.to_dict())
+
+def orders_to_json(orders: List[Order]) -> bytes:
+    return ('[' + ','.join(order.to_json() for order in orders) + ']').encode('utf-8')
+
+USER_COLUMNS = ('id', 'tg_id', 'name', 'phone', 'username', 'created_at', 'updated_at')
+USER_SELECT = ', '.join(USER_COLUMNS)
+
+class UserProfile:
+    """users jadvalidagi bitta qator"""
+    
+    __slots__ = USER_COLUMNS
+    
+    def __init__(self, id, tg_id, name, phone, username, created_at, updated_at):
+        self.id = id
+        self.tg_id = tg_id
+        self.name = name
+        self.phone = phone
+        self.username = username
+        self.created_at = created_at
+        self.updated_at = updated_at
+    
+    @classmethod
+    def from_json(cls, data: Optional[Dict[str, Any]]) -> Optional['UserProfile']:
+        """row_to_json natijasidan (profil servisi)"""
+        if not data:
+            return None
+        return cls(*(data.get(col) for col in USER_COLUMNS))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        data = {}
+        for col in USER_COLUMNS:
+            value = getattr(self, col)
+            if value is not None and hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            data[col] = value
+        return data
+
+# ==========================================
+# YETKAZIB BERISH ZONALARI (geo indeks)
+# ==========================================
+
+# GeoJSON FeatureCollection: Polygon / MultiPolygon, properties.name va ixtiyoriy properties.fee.
+# Zonalar ustma-ust tushsa fayldagi birinchisi tanlanadi (ichki zonalarni oldinroq yozing)
+DELIVERY_ZONES_PATH = os.getenv('DELIVERY_ZONES_PATH', '')
+# Restoran joylashuvi "lat,lng" - masofa shu nuqtadan hisoblanadi (bo'sh - hisoblanmaydi)
+STORE_LOCATION = os.getenv('STORE_LOCATION', '')
+# Grid katagi o'lchami (gradus, 0.01 ~ 1.1 km)
+DELIVERY_GRID_STEP = float(os.getenv('DELIVERY_GRID_STEP', '0.01'))
+
+EARTH_RADIUS_M = 6371008.8
+
+delivery_zone_lookups = Counter(
+    'bodrum_delivery_zone_lookups_total', 'Yetkazish zonasini aniqlash natijalari', ('result',))
+
+def parse_location(value) -> Optional[tuple]:
+    """'lat,lng' -> (lat, lng); noto'g'ri yoki chegaradan tashqari qiymat - None"""
+    if not value or ',' not in str(value):
+        return None
+    try:
+        lat, lng = (float(part.strip()) for part in str(value).split(','))
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Haversine - to'g'ri chiziq bo'yicha masofa (metr)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def _point_in_ring(x: float, y: float, ring: List[tuple]) -> bool:
+    """Ray casting: nuqtadan o'ngga chiqqan nur qirralarni toq marta kesadimi"""
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+class DeliveryZone:
+    """Bitta zona: [(tashqi halqa, [teshiklar]), ...], nuqtalar GeoJSON tartibida (lng, lat)"""
+    
+    __slots__ = ('name', 'fee', 'polygons', 'bbox')
+    
+    def __init__(self, name: str, fee: Optional[int], polygons: List[tuple]):
+        self.name = name
+        self.fee = fee
+        self.polygons = polygons
+        xs = [x for outer, _ in polygons for x, _ in outer]
+        ys = [y for outer, _ in polygons for _, y in outer]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+    
+    def contains(self, lat: float, lng: float) -> bool:
+        min_x, min_y, max_x, max_y = self.bbox
+        if not (min_x <= lng <= max_x and min_y <= lat <= max_y):
+            return False
+        return any(
+            _point_in_ring(lng, lat, outer) and not any(_point_in_ring(lng, lat, hole) for hole in holes)
+            for outer, holes in self.polygons
+        )
+
+class DeliveryZoneIndex:
+    """Bir xil o'lchamli grid: katak -> bbox i shu katakka tushadigan zonalar (fayl tartibida).
+    Qidiruv bitta dict murojaati + bir-ikki nomzodda point-in-polygon."""
+    
+    __slots__ = ('zones', 'by_name', 'step', 'cells')
+    
+    def __init__(self, zones: List[DeliveryZone], step: float):
+        self.zones = zones
+        self.by_name = {zone.name: zone for zone in zones}
+        self.step = step
+        self.cells: Dict[tuple, List[DeliveryZone]] = {}
+        for zone in zones:
+            min_x, min_y, max_x, max_y = zone.bbox
+            for cx in range(self._cell(min_x), self._cell(max_x) + 1):
+                for cy in range(self._cell(min_y), self._cell(max_y) + 1):
+                    self.cells.setdefault((cx, cy), []).append(zone)
+    
+    def _cell(self, value: float) -> int:
+        return math.floor(value / self.step)
+    
+    def find(self, lat: float, lng: float) -> Optional[DeliveryZone]:
+        for zone in self.cells.get((self._cell(lng), self._cell(lat)), ()):
+            if zone.contains(lat, lng):
+                return zone
+        return None
+
+def _zone_polygons(geometry: Dict[str, Any]) -> List[tuple]:
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError(f"geometriya turi: {geometry.get('type')}")
+    return [
+        ([(float(p[0]), float(p[1])) for p in rings[0]],
+         [[(float(p[0]), float(p[1])) for p in hole] for hole in rings[1:]])
+        for rings in polygons if rings and len(rings[0]) >= 3
+    ]
+
+def load_delivery_zones(path: str) -> Optional[DeliveryZoneIndex]:
+    """GeoJSON fayldan zonalar indeksi; fayl yo'q yoki xato bo'lsa None (zona aniqlanmaydi)"""
+    if not path:
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Yetkazish zonalari faylini o'qib bo'lmadi ({path}): {e}")
+        return None
+    
+    features = data.get('features', []) if isinstance(data, dict) else data
+    zones = []
+    for number, feature in enumerate(features, 1):
+        properties = feature.get('properties') or {}
+        name = str(properties.get('name') or f"Zona {number}")
+        try:
+            polygons = _zone_polygons(feature.get('geometry') or {})
+            if not polygons:
+                raise ValueError("bo'sh poligon")
+            fee = properties.get('fee')
+            zones.append(DeliveryZone(name, int(fee) if fee is not None else None, polygons))
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Zona o'tkazib yuborildi ({name}): {e}")
+    
+    index = DeliveryZoneIndex(zones, DELIVERY_GRID_STEP)
+    logger.info(f"🗺 Yetkazish zonalari: {len(zones)} ta, grid {len(index.cells)} katak")
+    return index
+
+delivery_zone_index = load_delivery_zones(DELIVERY_ZONES_PATH)
+store_coords = parse_location(STORE_LOCATION)
+
+def locate_delivery(coords: Optional[tuple]) -> tuple:
+    """(lat, lng) -> (zona nomi yoki None, restorangacha masofa metrda yoki None)"""
+    if not coords:
+        return None, None
+    lat, lng = coords
+    zone_name = None
+    if delivery_zone_index:
+        zone = delivery_zone_index.find(lat, lng)
+        zone_name = zone.name if zone else None
+        delivery_zone_lookups.inc('zone' if zone else 'outside')
+    distance = round(distance_m(store_coords[0], store_coords[1], lat, lng)) if store_coords else None
+    return zone_name, distance
+
+def delivery_text(order: Order) -> str:
+    """Admin kartasi uchun: zona, narx va masofa (create_order da hisoblangan)"""
+    parts = []
+    if order.delivery_zone:
+        zone = delivery_zone_index.by_name.get(order.delivery_zone) if delivery_zone_index else None
+        fee = f" ({format_price(zone.fee)} so'm)" if zone and zone.fee is not None else ""
+        parts.append(f"{order.delivery_zone}{fee}")
+    elif delivery_zone_index and order.lat is not None:
+        parts.append("⚠️ zonadan tashqarida")
+    if order.delivery_distance_m is not None:
+        parts.append(f"{order.delivery_distance_m / 1000:.1f} km")
+    return f"\n🗺 <b>Yetkazish:</b> {' · '.join(parts)}" if parts else ""
+
+# ==========================================
+# TELEGRAM BOT API DIRECT FUNCTIONS
+# ==========================================
+
+def send_telegram_message(chat_id: int, text: str, parse_mode: str = 'HTML', reply_markup=None) -> bool:
+    """Direct API call to send message"""
+    if not TOKEN:
+        logger.error("❌ TOKEN not set")
+        return False
+    
+    try:
+        url = f"{TELEGRAM_API_URL}/bot{TOKEN}/sendMessage"
+        payload = {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': parse_mode
+        }
+        if reply_markup:
+            payload['reply_markup'] = json.dumps(reply_markup.to_dict() if hasattr(reply_markup, 'to_dict') else reply_markup)
+        
+        started = time.perf_counter()
+        with span('telegram.sendMessage'):
+            response = requests.post(url, json=payload, timeout=10)
+        telegram_api_duration.observe(time.perf_counter() - started, 'sendMessage')
+        result = response.json()
+        
+        if result.get('ok'):
+            logger.info(f"✅ Message sent to {chat_id}")
+            return True
+        else:
+            telegram_api_errors.inc('sendMessage')
+            logger.error(f"❌ Telegram API error: {result}")
+            return False
+    except Exception as e:
+        telegram_api_errors.inc('sendMessage')
+        logger.error(f"❌ send_telegram_message error: {e}")
+        return False
+
+def send_telegram_location(chat_id: int, latitude: float, longitude: float) -> bool:
+    """Direct API call to send location"""
+    if not TOKEN:
+        return False
+    
+    try:
+        url = f"{TELEGRAM_API_URL}/bot{TOKEN}/sendLocation"
+        payload = {
+            'chat_id': chat_id,
+            'latitude': latitude,
+            'longitude': longitude
+        }
+        started = time.perf_counter()
+        with span('telegram.sendLocation'):
+            response = requests.post(url, json=payload, timeout=10)
+        telegram_api_duration.observe(time.perf_counter() - started, 'sendLocation')
+        ok = response.json().get('ok', False)
+        if not ok:
+            telegram_api_errors.inc('sendLocation')
+        return ok
+    except Exception as e:
+        telegram_api_errors.inc('sendLocation')
+        logger.error(f"❌ send_telegram_location error: {e}")
+        return False
+
+# ==========================================
+# MIJOZ XABARLARI NAVBATI (throttled)
+# ==========================================
+
+# Bot API cheklovi ~30 xabar/s - status xabarlari (yuborish/tahrirlash) shu tezlikdan oshmaydi
+NOTIFY_RATE_PER_SEC = float(os.getenv("NOTIFY_RATE_PER_SEC", "25"))
+NOTIFY_QUEUE_MAX = int(os.getenv("NOTIFY_QUEUE_MAX", "5000"))
+NOTIFY_MAX_RETRIES = 3
+
+notify_queue_depth = Gauge('bodrum_notify_queue_depth', 'Navbatdagi Bot API chaqiruvlari')
+notify_dropped = Counter('bodrum_notify_dropped_total', 'Bajarilmay qolgan Bot API chaqiruvlari', ('reason',))
+
+notification_queue: Optional[asyncio.Queue] = None
+
+def customer_status_text(order: Order, status: str, prep_time: Optional[str] = None) -> Optional[str]:
+    """Status o'zgarganda mijozga yuboriladigan matn (bitta va ommaviy amallar uchun)"""
+    if status == 'accepted':
+        items = order.items
+        items_short = ", ".join([f"{i.get('name')} x{i.get('qty')}" for i in items[:3]])
+        if len(items) > 3:
+            items_short += f" va yana {len(items)-3} ta"
+        prep_line = f"⏱ <b>Tayyorlanish vaqti:</b> {prep_time}\n" if prep_time else ""
+        return (
+            f"🎉 <b>Buyurtmangiz qabul qilindi!</b>\n\n"
+            f"🆔 <b>Buyurtma raqami:</b> #{order.short_id}\n"
+            f"{prep_line}"
+            f"💵 <b>Summa:</b> {format_price(order.total or 0)} so'm\n\n"
+            f"🍽 <b>Buyurtma:</b>\n{items_short}\n\n"
+            f"👨‍🍳 Oshxonada tayyorlanmoqda...\n"
+            f"🚚 Tayyor bo'lganda yetkazib beramiz!\n\n"
+            f"📞 Savollar bo'yicha: +998901234567\n"
+            f"⏰ {datetime.now().strftime('%H:%M')}"
+        )
+    if status == 'rejected':
+        return (
+            f"❌ <b>Buyurtmangiz bekor qilindi</b>\n\n"
+            f"🆔 Buyurtma: #{order.short_id}\n"
+            f"📞 Qo'llab-quvvatlash: +998901234567"
+        )
+    if status == 'confirmed':
+        return (
+            f"✅✅ <b>Buyurtmangiz tayyor!</b>\n\n"
+            f"🆔 Buyurtma: #{order.short_id}\n"
+            f"🚚 Tez orada yetkazib beramiz!"
+        )
+    return None
+
+def enqueue_bot_call(job, label: str) -> bool:
+    """Bot API chaqiruvini (argumentsiz coroutine funksiya) navbatga qo'yish.
+    Navbat to'lgan yoki ishga tushmagan bo'lsa False."""
+    if notification_queue is None:
+        notify_dropped.inc('not_started')
+        return False
+    try:
+        notification_queue.put_nowait((job, label))
+    except asyncio.QueueFull:
+        notify_dropped.inc('queue_full')
+        logger.warning(f"⚠️ Xabarlar navbati to'ldi, tashlandi: {label}")
+        return False
+    notify_queue_depth.set(notification_queue.qsize())
+    return True
+
+async def notification_sender():
+    """Navbatdan NOTIFY_RATE_PER_SEC tezlikda yuborish; RetryAfter da butun navbat kutadi"""
+    loop = asyncio.get_running_loop()
+    interval = 1.0 / NOTIFY_RATE_PER_SEC
+    next_at = loop.time()
+    while True:
+        job, label = await notification_queue.get()
+        notify_queue_depth.set(notification_queue.qsize())
+        
+        for attempt in range(NOTIFY_MAX_RETRIES):
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at = loop.time() + interval
+            try:
+                await job()
+                break
+            except RetryAfter as e:
+                logger.warning(f"⏳ Telegram flood limit: {e.retry_after} s kutamiz")
+                next_at = loop.time() + float(e.retry_after)
+            except Exception as e:
+                logger.error(f"❌ Xabar yuborishda xato ({label}): {e}")
+                notify_dropped.inc('error')
+                break
+        else:
+            notify_dropped.inc('retry_after')
+
+async def start_notifications(app):
+    global notification_queue
+    notification_queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_MAX)
+    app['notification_task'] = asyncio.create_task(notification_sender())
+
+async def stop_notifications(app):
+    task = app.get('notification_task')
+    if task:
+        task.cancel()
+    if notification_queue is not None and notification_queue.qsize():
+        logger.warning(f"⚠️ {notification_queue.qsize()} ta xabar yuborilmadi (to'xtatildi)")
+
+# ==========================================
+# BUYURTMA XABARLARI (joyida tahrirlash)
+# ==========================================
+
+# Admin alerti va mijozning status xabari order_messages da saqlanadi; keyingi
+# o'tishlar yangi xabar yubormaydi, o'shalarni tahrirlaydi. orders qatorida emas:
+# har bir UPDATE change_seq ni oshiradi va tugmalar versiyasini eskirtirib qo'yadi.
+# Shu oraliqdagi bir nechta o'zgarish bitta tahrirga birlashtiriladi (soniya)
+ORDER_MESSAGE_COALESCE = float(os.getenv("ORDER_MESSAGE_COALESCE", "1.5"))
+PREP_TIME_NOTE = "Tayyorlanish vaqti: "
+
+order_message_updates = Counter(
+    'bodrum_order_message_updates_total', 'Buyurtma xabarlarini yangilash', ('role', 'result'))
+
+ADMIN_CARD_HEADERS = {
+    'pending_payment': "⏳ <b>YANGI BUYURTMA - TO'LOV KUTILMOQDA!</b>",
+    'payment_pending': "⏳ <b>YANGI BUYURTMA - TO'LOV KUTILMOQDA!</b>",
+    'pending': "💳 <b>TO'LOV QILINDI - QABUL QILISH KERAK!</b>",
+    'accepted': "👨‍🍳 <b>QABUL QILINDI - TAYYORLANMOQDA</b>",
+    'confirmed': "✅✅ <b>BUYURTMA TASDIQLANDI</b>",
+    'rejected': "❌ <b>BUYURTMA BEKOR QILINDI</b>",
+    'expired': "⌛ <b>MUDDATI O'TDI - TO'LANMADI</b>",
+}
+
+register_query('order_message_save', """
+    INSERT INTO order_messages (order_pk, role, chat_id, message_id, updated_at)
+    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (order_pk, role) DO UPDATE SET
+        chat_id = EXCLUDED.chat_id,
+        message_id = EXCLUDED.message_id,
+        updated_at = EXCLUDED.updated_at
+""")
+register_query('order_messages_get', "SELECT role, chat_id, message_id FROM order_messages WHERE order_pk = %s", read_only=True)
+register_query('order_messages_prune', """
+    DELETE FROM order_messages WHERE updated_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+""")
+
+def save_order_message(order_pk: int, role: str, chat_id: int, message_id: int) -> bool:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'order_message_save', (order_pk, role, chat_id, message_id))
+        conn.commit()
+        cur.close()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Buyurtma xabarini saqlash xatosi: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def get_order_messages(order_pk: int) -> Dict[str, tuple]:
+    """role ('admin' / 'customer') -> (chat_id, message_id)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'order_messages_get', (order_pk,))
+        messages = {role: (chat_id, message_id) for role, chat_id, message_id in cur.fetchall()}
+        cur.close()
+        return messages
+    except Exception as e:
+        logger.error(f"❌ Buyurtma xabarlarini o'qish xatosi: {e}")
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
+def prune_order_messages() -> int:
+    """Issiq oynadan eski yozuvlar - bu buyurtmalar endi o'zgarmaydi"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'order_messages_prune', (ORDERS_HOT_DAYS,))
+        count = cur.rowcount
+        conn.commit()
+        cur.close()
+        return count
+    except Exception as e:
+        logger.error(f"❌ Buyurtma xabarlarini tozalash xatosi: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def order_prep_time(order: Order) -> Optional[str]:
+    note = order.admin_note or ''
+    return note[len(PREP_TIME_NOTE):] if note.startswith(PREP_TIME_NOTE) else None
+
+def render_admin_order_card(order: Order):
+    """Admin alerti matni va tugmalari - buyurtmaning joriy statusiga qarab"""
+    items = order.items
+    items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
+    phone_display = format_phone_display(order.phone)
+    
+    customer_name = order.name
+    if not customer_name or customer_name == 'null':
+        customer_name = 'Mijoz'
+    
+    location_text = ""
+    if order.coords:
+        lat, lng = order.coords
+        location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
+    elif order.location:
+        location_text = f"\n📍 <b>Manzil:</b> {order.location}"
+    
+    source_icon = "🤖 WebApp" if order.source == 'webapp' else "🌐 Sayt"
+    prep_time = order_prep_time(order)
+    prep_text = f"\n⏱ <b>Tayyorlanish vaqti:</b> {prep_time}" if prep_time and order.status in ('accepted', 'confirmed') else ""
+    header = ADMIN_CARD_HEADERS.get(order.status, f"📦 <b>BUYURTMA - {order.status}</b>")
+    
+    text = f"""{header}
+
+🆔 Buyurtma: #{order.short_id}
+👤 Mijoz: {customer_name}
+📞 Telefon: {phone_display}
+💵 Summa: {format_price(order.total or 0)} so'm
+📱 Manba: {source_icon}{location_text}{delivery_text(order)}{prep_text}
+
+🍽 Mahsulotlar:
+{items_text}
+
+⏰ {datetime.now().strftime('%H:%M:%S')}"""
+    
+    if can_transition(order.status, 'accepted'):
+        text += "\n\n<i>⚡ To'lovni tekshiring, keyin qabul qiling yoki bekor qiling</i>"
+        return text, admin_order_keyboard(order)
+    if order.status == 'accepted':
+        return text, InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅✅ TAYYOR", callback_data=order_callback('confirm', order)),
+            InlineKeyboardButton("❌ BEKOR QILISH", callback_data=order_callback('reject', order))
+        ]])
+    return text, None
+
+# order_pk -> (eng yangi Order, shu holatni allaqachon ko'rsatayotgan xabar yoki None)
+pending_order_refresh: Dict[int, tuple] = {}
+# Ishlayotgan flush tasklari - havola saqlanadi (GC da yo'qolmasin), tugagach olib tashlanadi
+order_refresh_tasks: set = set()
+
+def _start_order_flush(order_pk: int):
+    task = asyncio.create_task(flush_order_messages(order_pk))
+    order_refresh_tasks.add(task)
+    task.add_done_callback(_order_flush_done)
+
+def _order_flush_done(task: asyncio.Task):
+    order_refresh_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"❌ Buyurtma xabarlarini yangilash xatosi: {task.exception()}")
+
+def queue_order_refresh(order: Order, fresh_message: Optional[tuple] = None) -> bool:
+    """Status o'zgargandan keyin admin alerti va mijoz xabarini yangilashni rejalashtirish.
+    fresh_message - (chat_id, message_id), masalan tugma bosilgan xabar allaqachon tahrirlangan."""
+    if not order or not order.id:
+        return False
+    pending = pending_order_refresh.get(order.id)
+    if pending is None:
+        asyncio.get_running_loop().call_later(
+            ORDER_MESSAGE_COALESCE, _start_order_flush, order.id)
+    else:
+        order_message_updates.inc('any', 'coalesced')
+        if (pending[0].change_seq or 0) > (order.change_seq or 0):
+            return True
+    pending_order_refresh[order.id] = (order, fresh_message)
+    return True
+
+def refresh_order_messages(orders: List[Order]) -> int:
+    """Ommaviy amaldan keyin - xabari yangilanadigan mijozlar soni"""
+    for order in orders:
+        queue_order_refresh(order)
+    return sum(1 for order in orders if order.has_customer and customer_status_text(order, order.status))
+
+async def flush_order_messages(order_pk: int):
+    order, fresh_message = pending_order_refresh.pop(order_pk, (None, None))
+    if order is None:
+        return
+    messages = await asyncio.get_running_loop().run_in_executor(None, get_order_messages, order_pk)
+    
+    # Admin: faqat alerti bor buyurtmalar (eski buyurtmalarga yangi xabar yuborilmaydi)
+    admin_message = messages.get('admin')
+    if admin_message and admin_message != fresh_message:
+        admin_text, admin_markup = render_admin_order_card(order)
+        enqueue_bot_call(lambda: update_order_message(order, 'admin', admin_message, admin_text, admin_markup),
+                         f"admin #{order.short_id}")
+    
+    customer_text = customer_status_text(order, order.status, order_prep_time(order))
+    if customer_text and order.has_customer:
+        customer_message = messages.get('customer')
+        enqueue_bot_call(lambda: update_order_message(order, 'customer', customer_message, customer_text, None),
+                         f"mijoz #{order.short_id}")
+
+async def update_order_message(order: Order, role: str, target: Optional[tuple], text: str, markup):
+    """Saqlangan xabarni tahrirlash; yo'q yoki tahrirlab bo'lmasa - yangisini yuborib saqlash"""
+    bot = application.bot
+    if target:
+        chat_id, message_id = target
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                        reply_markup=markup, parse_mode='HTML')
+            order_message_updates.inc(role, 'edited')
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                order_message_updates.inc(role, 'unchanged')
+                return
+            logger.warning(f"⚠️ #{order.short_id} {role} xabarini tahrirlab bo'lmadi ({e}), yangisi yuboriladi")
+    else:
+        chat_id = ADMIN_CHAT_ID_INT if role == 'admin' else int(order.tg_id)
+    
+    sent = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, parse_mode='HTML')
+    order_message_updates.inc(role, 'sent')
+    await asyncio.get_running_loop().run_in_executor(
+        None, save_order_message, order.id, role, chat_id, sent.message_id)
 
 # ==========================================
 # PAYME CHEK PARSER - FAQAT ORDER ID
@@ -362,39 +2071,30 @@ async def open_payme_group_handler(update: Update, context: ContextTypes.DEFAULT
         parse_mode='HTML'
     )
 
-async def show_order_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, order: Dict):
+async def show_order_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, order: Order):
     """Buyurtma ma'lumotlarini admin ga qayta ko'rsatish"""
-    items = order.get('items', [])
-    if isinstance(items, str):
-        items = json.loads(items)
+    items = order.items
     
     items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
     
-    raw_phone = order.get('phone', '')
-    phone_display = format_phone_display(raw_phone)
+    phone_display = format_phone_display(order.phone)
     
-    location = order.get('location')
     location_text = ""
-    if location and ',' in str(location):
-        try:
-            lat, lng = str(location).split(',')
-            lat = float(lat.strip())
-            lng = float(lng.strip())
-            location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
-        except:
-            pass
+    if order.coords:
+        lat, lng = order.coords
+        location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
     
     status_text = "💳 <b>TO'LOV QILINDI - QABUL QILISH KERAK!</b>"
     
     message = f"""{status_text}
 
-🆔 Buyurtma: #{order.get('order_id', 'N/A')[-6:]}
-👤 Mijoz: {order.get('name')}
+🆔 Buyurtma: #{order.short_id}
+👤 Mijoz: {order.name}
 📞 Telefon: {phone_display}
-💵 Summa: {format_price(order.get('total', 0))} so'm
-💳 Karta: {order.get('payme_card_mask', 'N/A')}
-🧾 Chek ID: {order.get('payme_receipt_id', 'N/A')}
-📱 Manba: {'🤖 WebApp' if order.get('source') == 'webapp' else '🌐 Sayt'}{location_text}
+💵 Summa: {format_price(order.total or 0)} so'm
+💳 Karta: {order.payme_card_mask or 'N/A'}
+🧾 Chek ID: {order.payme_receipt_id or 'N/A'}
+📱 Manba: {'🤖 WebApp' if order.source == 'webapp' else '🌐 Sayt'}{location_text}{delivery_text(order)}
 
 🍽 Mahsulotlar:
 {items_text}
@@ -403,30 +2103,116 @@ async def show_order_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 <i>⚡ To'lov muvaffaqiyatli! Buyurtmani qabul qiling yoki bekor qiling</i>"""
 
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ QABUL QILISH", callback_data=f"accept_{order.get('order_id')}"),
-            InlineKeyboardButton("❌ BEKOR QILISH", callback_data=f"reject_{order.get('order_id')}")
-        ],
-        [
-            InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=f"open_payme_group_{order.get('order_id')}")
-        ]
-    ]
+    keyboard = admin_order_keyboard(order)
     
     if update.callback_query:
         await update.callback_query.edit_message_text(
             message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=keyboard,
             parse_mode='HTML'
         )
     else:
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID_INT,
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=keyboard,
             parse_mode='HTML'
         )
 
+# ==========================================
+# PROFIL KESHI (TTL + LRU)
+# ==========================================
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "300"))
+# Telefoni yo'q foydalanuvchilar uchun qisqa muddatli "manfiy" yozuv
+PROFILE_CACHE_NEGATIVE_TTL = int(os.getenv("PROFILE_CACHE_NEGATIVE_TTL", "30"))
+
+class ProfileCache:
+    """tg_id -> profil. Hajmi cheklangan, muddati o'tgan yozuvlar qayta o'qiladi"""
+    
+    def __init__(self, max_size: int, ttl: int, negative_ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, tg_id: int) -> tuple:
+        """(topildi, profil) - profil None bo'lsa manfiy yozuv"""
+        with self._lock:
+            entry = self._data.get(tg_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[tg_id]
+                self.misses += 1
+                return False, None
+            
+            self._data.move_to_end(tg_id)
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+    
+    def put(self, tg_id: int, profile: Optional['UserProfile']):
+        """Profilni saqlash. Telefoni yo'q profil manfiy yozuv bo'lib saqlanadi"""
+        if not profile or not profile.phone:
+            profile, ttl = None, self.negative_ttl
+        else:
+            ttl = self.ttl
+        
+        with self._lock:
+            self._data[tg_id] = (time.monotonic() + ttl, profile)
+            self._data.move_to_end(tg_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, tg_id: int):
+        with self._lock:
+            self._data.pop(tg_id, None)
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_CACHE_NEGATIVE_TTL)
+
+def _profile_cache_metrics() -> List[str]:
+    stats = profile_cache.stats()
+    lines = ["# TYPE bodrum_profile_cache_size gauge",
+             f"bodrum_profile_cache_size {stats['size']}",
+             "# TYPE bodrum_profile_cache_requests_total counter"]
+    for result in ('hits', 'negative_hits', 'misses'):
+        lines.append(f'bodrum_profile_cache_requests_total{{result="{result}"}} {stats[result]}')
+    lines.append("# TYPE bodrum_profile_cache_evictions_total counter")
+    lines.append(f"bodrum_profile_cache_evictions_total {stats['evictions']}")
+    return lines
+
+METRICS_COLLECTORS.append(_profile_cache_metrics)
+
+register_query('save_user_profile', f"""
+    INSERT INTO users (tg_id, name, phone, username, updated_at)
+    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (tg_id) 
+    DO UPDATE SET 
+        name = EXCLUDED.name,
+        phone = EXCLUDED.phone,
+        username = EXCLUDED.username,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING {USER_SELECT}
+""")
+
 def save_user_profile(tg_id: int, name: str, phone: str, username: str = None) -> bool:
     """Foydalanuvchi profilini saqlash yoki yangilash"""
     conn = None
@@ -434,299 +2220,948 @@ def save_user_profile(tg_id: int, name: str, phone: str, username: str = None) -
         conn = get_db_connection()
         cur = conn.cursor()
         
-        cur.execute("""
-            INSERT INTO users (tg_id, name, phone, username, updated_at)
-            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (tg_id) 
-            DO UPDATE SET 
-                name = EXCLUDED.name,
-                phone = EXCLUDED.phone,
-                username = EXCLUDED.username,
-                updated_at = CURRENT_TIMESTAMP
-            RETURNING *
-        """, (tg_id, name, phone, username))
+        execute_named(cur, 'save_user_profile', (tg_id, name, phone, username))
         
         result = cur.fetchone()
         conn.commit()
         cur.close()
         
+        # Write-through: /start endi DB ga murojaat qilmaydi
+        profile_cache.put(tg_id, UserProfile(*result))
+        note_write(f"user:{tg_id}")
+        
         logger.info(f"✅ Profil saqlandi: {tg_id} - {name} - {phone}")
         return True
         
     except Exception as e:
         logger.error(f"❌ Profil saqlash xatosi: {e}")
+        profile_cache.invalidate(tg_id)
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+register_query('get_user_profile', f"SELECT {USER_SELECT} FROM users WHERE tg_id = %s", read_only=True)
+
+def get_user_profile(tg_id: int, use_cache: bool = True) -> Optional[UserProfile]:
+    """Foydalanuvchi profilini olish (avval keshdan)"""
+    if use_cache:
+        found, profile = profile_cache.get(tg_id)
+        if found:
+            return profile
+    
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True, consistency_key=f"user:{tg_id}")
+        cur = conn.cursor()
+        
+        execute_named(cur, 'get_user_profile', (tg_id,))
+        result = cur.fetchone()
+        cur.close()
+        
+        profile = UserProfile(*result) if result else None
+        profile_cache.put(tg_id, profile)
+        return profile
+        
+    except Exception as e:
+        logger.error(f"❌ Profil olish xatosi: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# ==========================================
+# PROFIL SERVISI - BITTA ROUND TRIP
+# ==========================================
+
+PROFILE_ORDERS_PAGE_SIZE = int(os.getenv("PROFILE_ORDERS_PAGE_SIZE", "20"))
+PROFILE_ORDERS_MAX_PAGE_SIZE = 100
+
+def _user_history_sql(with_cursor: bool) -> str:
+    """Buyurtmalar tarixi - yengil proyeksiya, (created_at, id) bo'yicha keyset pagination"""
+    cursor_filter = "AND (o.created_at, o.id) < (%s::timestamp, %s)" if with_cursor else ""
+    return f"""
+        SELECT COALESCE(json_agg(h ORDER BY h.created_at DESC, h.id DESC), '[]'::json)
+        FROM (
+            SELECT o.id, o.order_id, o.total, o.status, o.payment_status,
+                   o.created_at, o.accepted_at, o.confirmed_at,
+                   (SELECT COALESCE(json_agg(json_build_object('name', i->>'name', 'qty', i->'qty')), '[]'::json)
+                    FROM jsonb_array_elements(
+                        CASE WHEN jsonb_typeof(o.items) = 'array' THEN o.items ELSE '[]'::jsonb END
+                    ) i) AS items
+            FROM orders o
+            WHERE o.tg_id = %s {cursor_filter}
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT %s
+        ) h
+    """
+
+def _history_params(tg_id: int, cursor: Optional[str], limit: int) -> tuple:
+    if cursor:
+        created_at, order_pk = parse_history_cursor(cursor)
+        return (tg_id, created_at, order_pk, limit + 1)
+    return (tg_id, limit + 1)
+
+def parse_history_cursor(cursor: str) -> tuple:
+    """'<created_at>|<id>' -> (created_at, id). Noto'g'ri kursor - ValueError (DB gacha yetmaydi)"""
+    created_at, order_pk = cursor.rsplit('|', 1)
+    return datetime.fromisoformat(created_at), int(order_pk)
+
+def _page_result(orders: List[Dict[str, Any]], limit: int) -> tuple:
+    """limit+1 ta qatordan sahifa va keyingi kursorni ajratish"""
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        last = orders[-1]
+        next_cursor = f"{last['created_at']}|{last['id']}"
+    return orders, next_cursor
+
+def normalize_page_size(limit) -> int:
+    try:
+        limit = int(limit or PROFILE_ORDERS_PAGE_SIZE)
+    except (ValueError, TypeError):
+        limit = PROFILE_ORDERS_PAGE_SIZE
+    return max(1, min(limit, PROFILE_ORDERS_MAX_PAGE_SIZE))
+
+register_query('save_profile_with_history', f"""
+    WITH u AS (
+        INSERT INTO users (tg_id, name, phone, username, updated_at)
+        VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (tg_id)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            phone = EXCLUDED.phone,
+            username = EXCLUDED.username,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING *
+    )
+    SELECT row_to_json(u) AS profile, ({_user_history_sql(False)}) AS orders
+    FROM u
+""")
+
+def save_profile_with_history(tg_id: int, name: str, phone: str, username: str = None,
+                              limit: int = PROFILE_ORDERS_PAGE_SIZE) -> Optional[Dict[str, Any]]:
+    """Upsert + profil + oxirgi buyurtmalar - bitta connection, bitta so'rov (CTE)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        execute_named(cur, 'save_profile_with_history', (tg_id, name, phone, username) + _history_params(tg_id, None, limit))
+        
+        profile_json, history = cur.fetchone()
+        conn.commit()
+        cur.close()
+        
+        profile_cache.put(tg_id, UserProfile.from_json(profile_json))
+        note_write(f"user:{tg_id}")
+        orders, next_cursor = _page_result(history, limit)
+        logger.info(f"✅ Profil saqlandi: {tg_id} - {name} - {phone}")
+        return {'profile': profile_json, 'orders': orders, 'next_cursor': next_cursor}
+        
+    except Exception as e:
+        logger.error(f"❌ Profil saqlash xatosi: {e}")
+        profile_cache.invalidate(tg_id)
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+register_query('load_profile_with_history', f"""
+    SELECT
+        (SELECT row_to_json(u) FROM users u WHERE u.tg_id = %s) AS profile,
+        ({_user_history_sql(False)}) AS orders
+""", read_only=True)
+
+def load_profile_with_history(tg_id: int, limit: int = PROFILE_ORDERS_PAGE_SIZE) -> Dict[str, Any]:
+    """Profil + oxirgi buyurtmalar - bitta so'rov"""
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True, consistency_key=f"user:{tg_id}")
+        cur = conn.cursor()
+        
+        execute_named(cur, 'load_profile_with_history', (tg_id,) + _history_params(tg_id, None, limit))
+        
+        profile_json, history = cur.fetchone()
+        cur.close()
+        
+        profile_cache.put(tg_id, UserProfile.from_json(profile_json))
+        orders, next_cursor = _page_result(history, limit)
+        return {'profile': profile_json, 'orders': orders, 'next_cursor': next_cursor}
+        
+    finally:
+        if conn:
+            conn.close()
+
+register_query('user_orders_first_page', f"SELECT ({_user_history_sql(False)}) AS orders", read_only=True)
+register_query('user_orders_next_page', f"SELECT ({_user_history_sql(True)}) AS orders", read_only=True)
+
+def get_user_orders_page(tg_id: int, cursor: Optional[str] = None,
+                         limit: int = PROFILE_ORDERS_PAGE_SIZE) -> Dict[str, Any]:
+    """Buyurtmalar tarixining keyingi sahifasi"""
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True, consistency_key=f"user:{tg_id}")
+        cur = conn.cursor()
+        
+        execute_named(cur, 'user_orders_next_page' if cursor else 'user_orders_first_page',
+                      _history_params(tg_id, cursor, limit))
+        history = cur.fetchone()[0]
+        cur.close()
+        
+        orders, next_cursor = _page_result(history, limit)
+        return {'orders': orders, 'next_cursor': next_cursor}
+        
+    finally:
+        if conn:
+            conn.close()
+
+def format_price(price: int) -> str:
+    return f"{price:,}".replace(",", " ")
+
+def normalize_phone_digits(phone) -> str:
+    """Faqat raqamlar, oxirgi 9 tasi (998 kodisiz) - PHONE_DIGITS_SQL indeks ifodasi bilan bir xil"""
+    return ''.join(filter(str.isdigit, str(phone or '')))[-9:]
+
+def format_phone_display(phone: str) -> str:
+    """Telefon raqamini ko'rsatish uchun formatlash"""
+    if not phone:
+        return "Noma'lum"
+    return f"+998{normalize_phone_digits(phone)}"
+
+register_query('get_order', f"SELECT {ORDER_SELECT} FROM orders WHERE order_id ILIKE %s", read_only=True)
+# ID dagi vaqt bo'yicha created_at oralig'i - faqat 1-2 oylik partitsiya o'qiladi
+register_query('get_order_bounded', f"""
+    SELECT {ORDER_SELECT} FROM orders
+    WHERE order_id ILIKE %s AND created_at BETWEEN %s AND %s
+""", read_only=True)
+
+def get_order(order_id: str) -> Optional[Order]:
+    """Buyurtmani olish - CASE INSENSITIVE"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        # ⭐ CASE INSENSITIVE qidirish - ILIKE ishlatamiz
+        result = None
+        bounds = order_created_bounds(order_id)
+        if bounds:
+            execute_named(cur, 'get_order_bounded', (order_id,) + bounds)
+            result = cur.fetchone()
+        if result is None:
+            # ID formati boshqacha yoki vaqt farqi katta - barcha partitsiyalar
+            execute_named(cur, 'get_order', (order_id,))
+            result = cur.fetchone()
+        cur.close()
+        
+        return Order(*result) if result else None
+    except Exception as e:
+        logger.error(f"Get order error: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# Partitsiyada UNIQUE (order_id, created_at) - order_id yagonaligini o'zimiz saqlaymiz:
+# bir xil ID uchun tranzaksiya qulfi va NOT EXISTS (qayta yuborilgan so'rov dublikat qo'shmaydi)
+register_query('order_id_lock', "SELECT pg_advisory_xact_lock(hashtext(%s))")
+register_query('create_order', f"""
+    INSERT INTO orders (
+        order_id, name, phone, items, total, 
+        status, payment_status, payment_method, 
+        location, tg_id, notified, created_at,
+        initiated_from, source,
+        lat, lng, delivery_zone, delivery_distance_m
+    )
+    SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+    WHERE NOT EXISTS (SELECT 1 FROM orders WHERE order_id = %s)
+    RETURNING {ORDER_SELECT}
+""")
+
+def create_order(data: Dict) -> Optional[Order]:
+    """Yangi buyurtma yaratish"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        items = data.get('items', [])
+        if isinstance(items, list):
+            items_json = json.dumps(items)
+        else:
+            items_json = items
+        
+        tg_id = data.get('tgId') or data.get('tg_id')
+        if tg_id:
+            try:
+                tg_id = int(tg_id)
+            except:
+                tg_id = None
+        
+        source = data.get('source', 'website')
+        initiated_from = data.get('initiated_from', 'website')
+        
+        # Joylashuv shu yerda bir marta parse qilinadi - keyin faqat raqamli ustunlar o'qiladi
+        coords = parse_location(data.get('location'))
+        delivery_zone, delivery_distance = locate_delivery(coords)
+        
+        order_id = data.get('orderId')
+        execute_named(cur, 'order_id_lock', (order_id,))
+        execute_named(cur, 'create_order', (
+            order_id, data.get('name'), data.get('phone'),
+            items_json, data.get('total'), data.get('status', 'pending_payment'),
+            data.get('paymentStatus', 'pending'), data.get('paymentMethod', 'payme'),
+            data.get('location'), tg_id, False, datetime.utcnow(),
+            initiated_from, source,
+            coords[0] if coords else None, coords[1] if coords else None,
+            delivery_zone, delivery_distance,
+            order_id
+        ))
+        
+        result = cur.fetchone()
+        conn.commit()
+        cur.close()
+        
+        if result is None:
+            # Oddiy jadvaldagi UNIQUE buzilishi bilan bir xil: dublikat yaratilmaydi
+            logger.warning(f"⚠️ Buyurtma allaqachon mavjud: {order_id}")
+        if result:
+            order = Order(*result)
+            note_order_seq(order)
+            note_write('orders', f"user:{order.tg_id}")
+            return order
+        return None
+        
+    except Exception as e:
+        logger.error(f"Create order error: {e}")
+        import traceback
+        traceback.print_exc()
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# Status dan boshqa, panel o'zgartira oladigan ustunlar. Status faqat transition_order orqali
+ORDER_EDITABLE_FIELDS = ('payment_status', 'admin_note')
+
+def update_order_fields(order_id: str, expected_version: Optional[int] = None, **fields) -> Optional[Order]:
+    """payment_status / admin_note yangilash. None - topilmadi, versiya mos emas yoki DB xatosi"""
+    update_data = {key: val for key, val in fields.items() if key in ORDER_EDITABLE_FIELDS and val is not None}
+    if not update_data:
+        raise ValueError("Nothing to update")
+    
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        
+        values = list(update_data.values()) + [order_id]
+        query = f"UPDATE orders SET {', '.join(f'{key} = %s' for key in update_data)} WHERE order_id = %s"
+        
+        # ⭐ Optimistic lock: boshqa admin o'zgartirgan bo'lsa hech narsa yangilanmaydi
+        if expected_version is not None:
+            query += " AND change_seq = %s"
+            values.append(expected_version)
+        
+        # Partitsiya pruning: ID dagi vaqt bo'yicha, topilmasa chegarasiz qayta urinish
+        result = None
+        bounds = order_created_bounds(order_id)
+        if bounds:
+            execute_named(cur, 'update_order_fields', values + list(bounds),
+                          sql=query + f" AND created_at BETWEEN %s AND %s RETURNING {ORDER_SELECT}")
+            result = cur.fetchone()
+        if result is None:
+            execute_named(cur, 'update_order_fields', values, sql=query + f" RETURNING {ORDER_SELECT}")
+            result = cur.fetchone()
+        conn.commit()
+        cur.close()
+        
+        if result:
+            order = Order(*result)
+            note_order_seq(order)
+            note_write('orders', f"user:{order.tg_id}")
+            return order
+        return None
+        
+    except Exception as e:
+        logger.error(f"Update error: {e}")
+        import traceback
+        traceback.print_exc()
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# ==========================================
+# BUYURTMA HOLAT MASHINASI
+# ==========================================
+
+# maqsad status -> qaysi statuslardan o'tish mumkin
+ORDER_TRANSITIONS = {
+    'pending': ('pending_payment', 'payment_pending'),
+    'accepted': ('pending_payment', 'payment_pending', 'pending'),
+    'rejected': ('pending_payment', 'payment_pending', 'pending', 'accepted'),
+    'confirmed': ('accepted',),
+    'expired': ('pending_payment', 'payment_pending', 'pending'),
+}
+
+order_transitions_total = Counter(
+    'bodrum_order_transitions_total', 'Status o\'tishlari natijasi', ('target', 'outcome'))
+
+def can_transition(current: Optional[str], target: str) -> bool:
+    return current in ORDER_TRANSITIONS.get(target, ())
+
+class TransitionResult:
+    """transition_order natijasi; order - yangilangan yoki (o'zgarmagan bo'lsa) joriy holati"""
+    APPLIED = 'applied'
+    ALREADY = 'already'        # allaqachon maqsad statusda
+    NOT_FOUND = 'not_found'
+    ILLEGAL = 'illegal'        # joriy statusdan bu o'tish jadvalda yo'q
+    STALE = 'stale'            # expected_version berilgan va buyurtma o'zgargan
+    
+    __slots__ = ('outcome', 'order')
+    
+    def __init__(self, outcome: str, order: Optional[Order] = None):
+        self.outcome = outcome
+        self.order = order
+    
+    @property
+    def applied(self) -> bool:
+        return self.outcome == self.APPLIED
+
+# Status va unga mos timestamp lar (ommaviy va bitta o'tish uchun umumiy SET)
+_STATUS_SET_SQL = """
+        status = p.new_status,
+        accepted_at = CASE WHEN p.new_status = 'accepted' THEN p.changed_at
+                           WHEN p.new_status = 'confirmed' THEN COALESCE(o.accepted_at, p.changed_at)
+                           ELSE o.accepted_at END,
+        rejected_at = CASE WHEN p.new_status = 'rejected' THEN p.changed_at ELSE o.rejected_at END,
+        confirmed_at = CASE WHEN p.new_status = 'confirmed' THEN p.changed_at ELSE o.confirmed_at END,
+        admin_note = COALESCE(p.note, o.admin_note)"""
+
+# Bitta round trip: qatorni qulflash (FOR UPDATE eng yangi versiyani qaytaradi),
+# ruxsat bo'lsa yangilash, bo'lmasa nima uchunligini qaytarish
+_TRANSITION_SQL = f"""
+    WITH p AS (
+        SELECT %s::varchar AS new_status, %s::timestamp AS changed_at, %s::text AS note,
+               %s::varchar[] AS allowed_from, %s::bigint AS expected_seq
+    ), locked AS (
+        SELECT {ORDER_SELECT} FROM orders
+        WHERE {{where}}
+        FOR UPDATE
+    ), updated AS (
+        UPDATE orders o SET {_STATUS_SET_SQL}
+        FROM p, locked l
+        WHERE o.id = l.id AND o.created_at = l.created_at
+        AND l.status = ANY(p.allowed_from)
+        AND (p.expected_seq IS NULL OR l.change_seq = p.expected_seq)
+        RETURNING {ORDER_SELECT_O}
+    )
+    SELECT 'applied', {ORDER_SELECT} FROM updated
+    UNION ALL
+    SELECT CASE
+               WHEN l.status = p.new_status THEN 'already'
+               WHEN p.expected_seq IS NOT NULL AND l.change_seq <> p.expected_seq THEN 'stale'
+               ELSE 'illegal'
+           END, {ORDER_SELECT}
+    FROM locked l, p
+    WHERE NOT EXISTS (SELECT 1 FROM updated)
+"""
+register_query('transition_order', _TRANSITION_SQL.format(where="order_id = %s AND created_at BETWEEN %s AND %s"))
+register_query('transition_order_unbounded', _TRANSITION_SQL.format(where="order_id = %s"))
+register_query('transition_order_pk', _TRANSITION_SQL.format(where="id = %s"))
+
+def transition_order(order_id: Optional[str], target: str, order_pk: Optional[int] = None,
+                     admin_note: Optional[str] = None, expected_version: Optional[int] = None) -> Optional[TransitionResult]:
+    """ORDER_TRANSITIONS bo'yicha status o'zgartirish - bitta shartli UPDATE.
+    order_id yoki order_pk (callback tugmalari). DB xatosida None."""
+    allowed = ORDER_TRANSITIONS.get(target)
+    if allowed is None:
+        raise ValueError(f"Unknown order status: {target}")
+    
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        params = (target, datetime.utcnow(), admin_note, list(allowed), expected_version)
+        
+        row = None
+        if order_pk is not None:
+            execute_named(cur, 'transition_order_pk', params + (order_pk,))
+            row = cur.fetchone()
+        else:
+            bounds = order_created_bounds(order_id)
+            if bounds:
+                execute_named(cur, 'transition_order', params + (order_id,) + bounds)
+                row = cur.fetchone()
+            if row is None:
+                execute_named(cur, 'transition_order_unbounded', params + (order_id,))
+                row = cur.fetchone()
+        conn.commit()
+        cur.close()
+        
+        if row is None:
+            result = TransitionResult(TransitionResult.NOT_FOUND)
+        else:
+            result = TransitionResult(row[0], Order(*row[1:]))
+        order_transitions_total.inc(target, result.outcome)
+        
+        order = result.order
+        if result.applied:
+            note_order_seq(order)
+            note_write('orders', f"user:{order.tg_id}")
+            if target in LIFECYCLE_END_STATUSES:
+                record_stage_durations(order.id, order.created_at)
+        elif order:
+            note_order_seq(order)
+        return result
+        
+    except Exception as e:
+        logger.error(f"❌ Status o'tishi xatosi ({order_id or order_pk} -> {target}): {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+# --- Ommaviy status o'zgartirish (admin panel va bot multi-select) ---
+# Timestamp ustunlari init_database da kafolatlangan - schema probe kerak emas.
+# ORDER_TRANSITIONS ga mos kelmagan (shu jumladan allaqachon shu statusdagi) buyurtmalar o'zgarmaydi.
+_BATCH_UPDATE_SQL = f"""
+    WITH p AS (
+        SELECT %s::varchar AS new_status, %s::timestamp AS changed_at, %s::text AS note,
+               %s::varchar[] AS allowed_from
+    )
+    UPDATE orders o SET {_STATUS_SET_SQL}
+    FROM p
+    WHERE o.order_id = ANY(%s) AND o.status = ANY(p.allowed_from)
+    {{bounds}}
+    RETURNING {ORDER_SELECT_O}
+"""
+register_query('update_orders_batch', _BATCH_UPDATE_SQL.format(bounds="AND o.created_at BETWEEN %s AND %s"))
+register_query('update_orders_batch_unbounded', _BATCH_UPDATE_SQL.format(bounds=""))
+
+def update_orders_batch(order_ids: List[str], status: str, admin_note: Optional[str] = None) -> Optional[List[Order]]:
+    """Bir nechta buyurtma - bitta tranzaksiya, bitta set-based UPDATE (ID vaqti mos
+    kelmaganlar uchun ikkinchi, chegarasiz UPDATE). Xato bo'lsa None."""
+    if not order_ids:
+        return []
+    
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        params = (status, datetime.utcnow(), admin_note, list(ORDER_TRANSITIONS[status]))
+        
+        # Partitsiya pruning: barcha ID lar vaqtini qamrab oluvchi bitta diapazon
+        updated = []
+        bounds = [order_created_bounds(order_id) for order_id in order_ids]
+        if all(bounds):
+            execute_named(cur, 'update_orders_batch', params + (
+                list(order_ids), min(b[0] for b in bounds), max(b[1] for b in bounds)))
+            updated = [Order(*row) for row in cur.fetchall()]
+        
+        if len(updated) < len(order_ids):
+            done = {order.order_id for order in updated}
+            rest = [order_id for order_id in order_ids if order_id not in done]
+            execute_named(cur, 'update_orders_batch_unbounded', params + (rest,))
+            updated += [Order(*row) for row in cur.fetchall()]
+        
+        conn.commit()
+        cur.close()
+        
+        for order in updated:
+            note_order_seq(order)
+        note_write('orders', *{f"user:{order.tg_id}" for order in updated})
+        if updated and status in LIFECYCLE_END_STATUSES:
+            record_stage_durations_batch(updated)
+        
+        logger.info(f"📦 Batch: {len(updated)}/{len(order_ids)} ta buyurtma -> {status}")
+        return updated
+        
+    except Exception as e:
+        logger.error(f"❌ Batch update xatosi: {e}")
         if conn:
             conn.rollback()
-        return False
+        return None
     finally:
         if conn:
             conn.close()
 
-def get_user_profile(tg_id: int) -> Optional[Dict[str, Any]]:
-    """Foydalanuvchi profilini olish"""
+register_query('expire_stale_orders', f"""
+    UPDATE orders SET status = 'expired'
+    WHERE status = 'pending_payment'
+    AND payment_status IS DISTINCT FROM 'paid'
+    AND created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+    {orders_hot_bound()}
+    RETURNING {ORDER_SELECT}
+""")
+
+def expire_stale_orders() -> List[Order]:
+    """Uzoq vaqt to'lanmagan buyurtmalarni 'expired' qilish (delta sync da tombstone bo'ladi).
+    To'langan va admin qabulini kutayotgan (pending) buyurtmalarga tegilmaydi."""
+    if ORDER_EXPIRE_HOURS <= 0:
+        return []
+    
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        cur.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
-        result = cur.fetchone()
+        execute_named(cur, 'expire_stale_orders', (ORDER_EXPIRE_HOURS,))
+        expired = [Order(*row) for row in cur.fetchall()]
+        conn.commit()
         cur.close()
         
-        if result:
-            profile = dict(result)
-            for key in ['created_at', 'updated_at']:
-                if profile.get(key) and hasattr(profile[key], 'isoformat'):
-                    profile[key] = profile[key].isoformat()
-            return profile
-        return None
+        for order in expired:
+            note_order_seq(order)
+        if expired:
+            note_write('orders')
+            logger.info(f"⌛ {len(expired)} ta buyurtma muddati o'tdi")
+        return expired
         
     except Exception as e:
-        logger.error(f"❌ Profil olish xatosi: {e}")
-        return None
+        logger.error(f"❌ Expire xatosi: {e}")
+        if conn:
+            conn.rollback()
+        return []
     finally:
         if conn:
             conn.close()
 
-def get_user_orders(tg_id: int) -> List[Dict[str, Any]]:
-    """Foydalanuvchining barcha buyurtmalarini olish"""
+register_query('get_orders_since', f"""
+    SELECT {ORDER_SELECT}, updated_at > CURRENT_TIMESTAMP - make_interval(secs => %s) AS unsettled
+    FROM orders
+    WHERE change_seq > %s
+    ORDER BY change_seq
+    LIMIT %s
+""", read_only=True)
+
+def get_orders_since(since: int, limit: int = 500) -> Dict[str, Any]:
+    """change_seq > since bo'lgan o'zgarishlar (delta sync). changes - Order lar ro'yxati"""
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("""
-            SELECT * FROM orders 
-            WHERE tg_id = %s 
-            ORDER BY created_at DESC
-        """, (tg_id,))
+        execute_named(cur, 'get_orders_since', (DELTA_SETTLE_SECONDS, since, limit + 1))
         results = cur.fetchall()
         cur.close()
         
-        orders = []
-        for row in results:
-            order_dict = dict(row)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            orders.append(order_dict)
+        has_more = len(results) > limit
+        results = results[:limit]
         
-        return orders
+        changes = []
+        tombstones = []
+        cursor = since
+        settled = True
+        for row in results:
+            order = Order(*row[:-1])
+            
+            # Hali commit bo'lmagan kichikroq change_seq lar o'tkazib yuborilmasligi uchun
+            # kursor yangi o'zgarishlardan oldin to'xtaydi - mijoz ularni qayta oladi
+            if row[-1]:
+                settled = False
+            if settled:
+                cursor = order.change_seq
+            
+            if order.status == 'expired':
+                tombstones.append({
+                    'order_id': order.order_id,
+                    'change_seq': order.change_seq,
+                    'deleted': True
+                })
+                continue
+            
+            changes.append(order)
         
-    except Exception as e:
-        logger.error(f"❌ Buyurtmalarni olish xatosi: {e}")
-        return []
+        return {
+            'changes': changes,
+            'tombstones': tombstones,
+            'cursor': cursor,
+            'has_more': has_more
+        }
     finally:
         if conn:
             conn.close()
 
-def format_price(price: int) -> str:
-    return f"{price:,}".replace(",", " ")
+# ==========================================
+# LIFECYCLE ANALITIKASI (bosqichlar davomiyligi)
+# ==========================================
 
-def format_phone_display(phone: str) -> str:
-    """Telefon raqamini ko'rsatish uchun formatlash"""
-    if not phone:
-        return "Noma'lum"
-    phone = ''.join(filter(str.isdigit, str(phone)))
-    if phone.startswith('998'):
-        phone = phone[3:]
-    phone = phone[-9:] if len(phone) > 9 else phone
-    return f"+998{phone}"
+# bosqich -> (boshlanish ustuni, tugash ustuni) - orders jadvalidagi timestamp lar
+ORDER_STAGES = {
+    'payment': ('o.created_at', 'o.paid_at'),
+    'acceptance': ('COALESCE(o.paid_at, o.created_at)', 'o.accepted_at'),
+    'confirmation': ('o.accepted_at', 'o.confirmed_at'),
+    'rejection': ('o.created_at', 'o.rejected_at'),
+}
+ORDER_STAGE_LABELS = {
+    'payment': "To'lov",
+    'acceptance': 'Qabul qilish',
+    'confirmation': 'Tasdiqlash',
+    'rejection': 'Bekor qilish',
+}
+# Shu statuslarga o'tganda bosqich tugaydi (paid_at esa alohida kwarg)
+LIFECYCLE_END_STATUSES = ('accepted', 'rejected', 'confirmed')
+LIFECYCLE_BACKFILL_BATCH = int(os.getenv("LIFECYCLE_BACKFILL_BATCH", "1000"))
+LIFECYCLE_MAX_DAYS = 90
 
-def get_order(order_id: str) -> Optional[Dict[str, Any]]:
-    """Buyurtmani olish - CASE INSENSITIVE"""
+order_stage_duration = Histogram(
+    'bodrum_order_stage_duration_seconds', 'Buyurtma bosqichlari davomiyligi', ('stage',),
+    (30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 7200, 14400, 43200, 86400))
+
+_stage_values = ",\n        ".join(
+    f"('{stage}', {started}, {ended})" for stage, (started, ended) in ORDER_STAGES.items())
+
+# Bitta so'rov: tugagan bosqichlarni hisoblab yozish; allaqachon borlari qaytmaydi
+_STAGE_INSERT_SQL = f"""
+    INSERT INTO order_stage_durations (order_pk, stage, started_at, ended_at, duration_seconds)
+    SELECT o.id, s.stage, s.started_at, s.ended_at,
+           EXTRACT(EPOCH FROM s.ended_at - s.started_at)
+    FROM orders o
+    CROSS JOIN LATERAL (VALUES
+        {_stage_values}
+    ) AS s(stage, started_at, ended_at)
+    WHERE {{where}}
+    AND s.started_at IS NOT NULL AND s.ended_at IS NOT NULL
+    AND s.ended_at >= s.started_at
+    ON CONFLICT (order_pk, stage) DO NOTHING
+    RETURNING stage, duration_seconds
+"""
+register_query('record_order_stages', _STAGE_INSERT_SQL.format(where="o.id = %s AND o.created_at = %s"))
+register_query('record_order_stages_batch', _STAGE_INSERT_SQL.format(
+    where="o.id = ANY(%s) AND o.created_at BETWEEN %s AND %s"))
+register_query('backfill_order_stages', _STAGE_INSERT_SQL.format(where="o.id > %s AND o.id <= %s"))
+register_query('lifecycle_watermark', """
+    SELECT COALESCE((SELECT value FROM analytics_watermarks WHERE name = 'order_stage_durations'), 0),
+           COALESCE((SELECT MAX(id) FROM orders), 0)
+""", read_only=True)
+register_query('lifecycle_watermark_save', """
+    INSERT INTO analytics_watermarks (name, value, updated_at)
+    VALUES ('order_stage_durations', %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+""")
+
+def _observe_stages(rows):
+    for stage, duration in rows:
+        order_stage_duration.observe(float(duration), stage)
+
+def record_stage_durations(order_pk: int, created_at: datetime):
+    """Status o'zgargandan keyin yangi tugagan bosqichlarni yozish (PK bo'yicha bitta qator)"""
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        # ⭐ CASE INSENSITIVE qidirish - ILIKE ishlatamiz
-        cur.execute(
-            "SELECT * FROM orders WHERE order_id ILIKE %s", 
-            (order_id,)
-        )
-        result = cur.fetchone()
+        execute_named(cur, 'record_order_stages', (order_pk, created_at))
+        rows = cur.fetchall()
+        conn.commit()
         cur.close()
-        
-        if result:
-            order_dict = dict(result)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            return order_dict
-        return None
+        _observe_stages(rows)
     except Exception as e:
-        logger.error(f"Get order error: {e}")
-        return None
+        logger.error(f"❌ Lifecycle yozish xatosi: {e}")
+        if conn:
+            conn.rollback()
     finally:
         if conn:
             conn.close()
 
-def create_order(data: Dict) -> Optional[Dict]:
-    """Yangi buyurtma yaratish"""
+def record_stage_durations_batch(orders: List[Order]):
+    """Ommaviy status o'zgarishidan keyin - barcha buyurtmalar uchun bitta INSERT"""
     conn = None
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        items = data.get('items', [])
-        if isinstance(items, list):
-            items_json = json.dumps(items)
-        else:
-            items_json = items
-        
-        tg_id = data.get('tgId') or data.get('tg_id')
-        if tg_id:
-            try:
-                tg_id = int(tg_id)
-            except:
-                tg_id = None
-        
-        source = data.get('source', 'website')
-        initiated_from = data.get('initiated_from', 'website')
-        
-        cur.execute("""
-            INSERT INTO orders (
-                order_id, name, phone, items, total, 
-                status, payment_status, payment_method, 
-                location, tg_id, notified, created_at,
-                initiated_from, source
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING *
-        """, (
-            data.get('orderId'), data.get('name'), data.get('phone'),
-            items_json, data.get('total'), data.get('status', 'pending_payment'),
-            data.get('paymentStatus', 'pending'), data.get('paymentMethod', 'payme'),
-            data.get('location'), tg_id, False, datetime.utcnow(),
-            initiated_from, source
-        ))
-        
-        result = cur.fetchone()
+        created = [order.created_at for order in orders]
+        execute_named(cur, 'record_order_stages_batch', ([order.id for order in orders], min(created), max(created)))
+        rows = cur.fetchall()
         conn.commit()
         cur.close()
-        
-        if result:
-            order_dict = dict(result)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            return order_dict
-        return None
-        
+        _observe_stages(rows)
     except Exception as e:
-        logger.error(f"Create order error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ Lifecycle yozish xatosi: {e}")
         if conn:
             conn.rollback()
-        return None
     finally:
         if conn:
             conn.close()
 
-def update_order_status(order_id: str, status: str, **kwargs) -> Optional[Dict[str, Any]]:
+def backfill_stage_durations(max_batches: int = 10) -> int:
+    """Tarixdagi buyurtmalarni id watermark bo'yicha bo'lak-bo'lak qayta ishlash.
+    Har bir bo'lak PK diapazoni - to'liq jadval skani yo'q."""
     conn = None
+    recorded = 0
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        execute_named(cur, 'lifecycle_watermark')
+        watermark, max_id = cur.fetchone()
+        
+        for _ in range(max_batches):
+            if watermark >= max_id:
+                break
+            upper = min(watermark + LIFECYCLE_BACKFILL_BATCH, max_id)
+            execute_named(cur, 'backfill_order_stages', (watermark, upper))
+            rows = cur.fetchall()
+            execute_named(cur, 'lifecycle_watermark_save', (upper,))
+            conn.commit()
+            _observe_stages(rows)
+            recorded += len(rows)
+            watermark = upper
         
-        update_data = {'status': status}
-        
-        # ⭐⭐⭐ TIMESTAMP FIELDLAR - BARCHA STATUSLAR UCHUN
-        timestamp_fields = {
-            'accepted': 'accepted_at',
-            'rejected': 'rejected_at', 
-            'confirmed': 'confirmed_at',
-            'pending_payment': None,  # Faqat status o'zgaradi
-            'pending': None
-        }
-        
-        # Statusga mos timestamp ni qo'shish
-        if status in timestamp_fields and timestamp_fields[status]:
-            field_name = timestamp_fields[status]
-            cur.execute(f"""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'orders' AND column_name = '{field_name}'
-            """)
-            if cur.fetchone():
-                update_data[field_name] = datetime.utcnow().isoformat()
-        
-        # Agar confirmed bo'lsa va avval accepted bo'lmasa, accepted_at ham qo'shish
-        if status == 'confirmed':
-            cur.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'orders' AND column_name = 'accepted_at'
-            """)
-            if cur.fetchone():
-                # Avval accepted_at bo'lmasa, hozir qo'shish
-                update_data['accepted_at'] = datetime.utcnow().isoformat()
-        
-        # paid_at alohida
-        if kwargs.get('paid_at'):
-            cur.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = 'orders' AND column_name = 'paid_at'
-            """)
-            if cur.fetchone():
-                update_data['paid_at'] = kwargs.get('paid_at')
-        
-        # notified parametri
-        if 'notified' in kwargs:
-            update_data['notified'] = kwargs['notified']
-        
-        # Qolgan fieldlar
-        for key, val in kwargs.items():
-            if val is not None and key not in ['paid_at', 'notified', 'accepted_at', 'confirmed_at', 'rejected_at']:
-                update_data[key] = val
-        
-        fields = []
-        values = []
-        for key, val in update_data.items():
-            fields.append(f"{key} = %s")
-            values.append(val)
-        values.append(order_id)
-        
-        query = f"UPDATE orders SET {', '.join(fields)} WHERE order_id = %s RETURNING *"
-        cur.execute(query, values)
-        result = cur.fetchone()
-        conn.commit()
         cur.close()
-        
-        if result:
-            order_dict = dict(result)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            return order_dict
-        return None
-        
+        if recorded:
+            logger.info(f"⏱ Lifecycle backfill: {recorded} ta bosqich, watermark {watermark}")
+        return recorded
     except Exception as e:
-        logger.error(f"Update error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ Lifecycle backfill xatosi: {e}")
         if conn:
             conn.rollback()
-        return None
+        return recorded
+    finally:
+        if conn:
+            conn.close()
+
+register_query('lifecycle_percentiles', """
+    SELECT stage, date_trunc(%s, ended_at) AS bucket, COUNT(*),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_seconds),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY duration_seconds),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY duration_seconds),
+           AVG(duration_seconds)
+    FROM order_stage_durations
+    WHERE stage = ANY(%s)
+    AND ended_at >= CURRENT_TIMESTAMP - make_interval(days => %s)
+    GROUP BY stage, bucket
+    ORDER BY stage, bucket
+""", read_only=True)
+
+def get_lifecycle_percentiles(bucket: str = 'hour', days: int = 7,
+                              stages: Optional[List[str]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Bosqichlar bo'yicha soatlik/kunlik p50/p90/p99 ((stage, ended_at) indeksi)"""
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True)
+        cur = conn.cursor()
+        execute_named(cur, 'lifecycle_percentiles', (bucket, list(stages or ORDER_STAGES), days))
+        rows = cur.fetchall()
+        cur.close()
+        
+        result = {}
+        for stage, bucket_start, count, p50, p90, p99, avg in rows:
+            result.setdefault(stage, []).append({
+                'bucket': bucket_start.isoformat(),
+                'count': count,
+                'p50': round(p50, 1),
+                'p90': round(p90, 1),
+                'p99': round(p99, 1),
+                'avg': round(float(avg), 1)
+            })
+        return result
     finally:
         if conn:
             conn.close()
 
-async def notify_admin_payment_received(order: Dict, bot=None):
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} s"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} daq"
+    return f"{minutes // 60} soat {minutes % 60} daq"
+
+# ==========================================
+# ORDERS VERSIYASI VA JAVOB KESHI (ETag)
+# ==========================================
+
+# Versiya - DB da: bitta buyurtma uchun uning change_seq i, ro'yxatlar uchun orders_version
+# (commit tartibida oshadi), shuning uchun ETag barcha replikalarda bir xil. Ustunlar o'zgarsa
+# (deploy) JSON shakli ham o'zgaradi - eski ETag lar mos kelmasligi uchun ustunlar ro'yxatidan
+# olingan teg qo'shiladi
+ORDERS_ETAG_SCHEMA = format(zlib.crc32(ORDER_SELECT.encode()), 'x')
+# Partitsiyada issiq oyna vaqt bilan siljiydi - eski qatorlar yozuvsiz ro'yxatdan chiqadi.
+# Ro'yxat ETag i va keshi shuncha soniyada bir marta eskiradi
+ORDERS_HOT_ETAG_SECONDS = int(os.getenv("ORDERS_HOT_ETAG_SECONDS", "60"))
+ORDER_RESPONSE_CACHE_MAX = int(os.getenv("ORDER_RESPONSE_CACHE_MAX", "1000"))
+
+# Tayyor kodlangan javoblar: key -> (version, body bytes); versiya mos kelmasa ishlatilmaydi
+orders_response_cache: Dict[str, tuple] = {}
+# Yozuvlar db_executor thread larida ham bo'ladi (run_blocking)
+_versions_lock = threading.Lock()
+
+METRICS_COLLECTORS.append(lambda: [
+    "# TYPE bodrum_orders_response_cache_size gauge",
+    f"bodrum_orders_response_cache_size {len(orders_response_cache)}"
+])
+
+def make_etag(kind: str, version: int) -> str:
+    """Kuchli (strong) ETag yaratish"""
+    return f'"{ORDERS_ETAG_SCHEMA}-{kind}-{version}"'
+
+def etag_matches(request, etag: str) -> bool:
+    """If-None-Match sarlavhasini tekshirish"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+def get_cached_response(key: str, version: int) -> Optional[bytes]:
+    """Keshdagi javob faqat versiya mos kelsa qaytariladi"""
+    cached = orders_response_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    return None
+
+def store_cached_response(key: str, version: int, body: bytes):
+    """Kodlangan javobni keshga saqlash (hajmi cheklangan)"""
+    with _versions_lock:
+        if key not in orders_response_cache and len(orders_response_cache) >= ORDER_RESPONSE_CACHE_MAX:
+            # Eng eski yozuvni chiqarib tashlash (dict tartibi = qo'shilish tartibi)
+            orders_response_cache.pop(next(iter(orders_response_cache)))
+        orders_response_cache[key] = (version, body)
+
+def not_modified_response(etag: str):
+    """304 - body siz javob"""
+    return web.Response(status=304, headers={
+        **get_cors_headers(),
+        'ETag': etag,
+        'Cache-Control': 'no-cache'
+    })
+
+def encoded_json_response(body: bytes, etag: str):
+    """Oldindan kodlangan JSON ni ETag bilan qaytarish"""
+    return web.Response(
+        body=body,
+        content_type='application/json',
+        headers={
+            **get_cors_headers(),
+            'ETag': etag,
+            'Cache-Control': 'no-cache'
+        }
+    )
+
+async def notify_admin_payment_received(order: Order, bot=None):
     """
     Admin ga yangi buyurtma haqida xabar (to'lov tekshirilmagan)
     """
     try:
-        logger.info(f"🔔 notify_admin_new_order: {order.get('order_id')}")
+        logger.info(f"🔔 notify_admin_new_order: {order.order_id}")
 
         if not ADMIN_CHAT_ID_INT:
             logger.error("❌ ADMIN_CHAT_ID o'rnatilmagan!")
             return False
 
         if bot is None:
-            global application
             if application and application.bot:
                 bot = application.bot
             else:
@@ -734,49 +3169,37 @@ async def notify_admin_payment_received(order: Dict, bot=None):
                 return False
 
         # Buyurtma ma'lumotlarini olish
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
+        items = order.items
 
         items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
 
-        raw_phone = order.get('phone', '')
-        phone_display = format_phone_display(raw_phone)
+        phone_display = format_phone_display(order.phone)
 
-        customer_name = order.get('name', 'Mijoz')
+        customer_name = order.name
         if not customer_name or customer_name == 'null':
             customer_name = 'Mijoz'
 
-        location = order.get('location')
         location_text = ""
-        location_coords = None
+        location_coords = order.coords
 
-        if location and ',' in str(location):
-            try:
-                lat, lng = str(location).split(',')
-                lat = float(lat.strip())
-                lng = float(lng.strip())
-                location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
-                location_coords = (lat, lng)
-            except Exception as e:
-                logger.warning(f"Joylashuv parse xatosi: {e}")
-                location_text = f"\n📍 <b>Manzil:</b> {location}"
-        elif location:
-            location_text = f"\n📍 <b>Manzil:</b> {location}"
+        if location_coords:
+            lat, lng = location_coords
+            location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
+        elif order.location:
+            location_text = f"\n📍 <b>Manzil:</b> {order.location}"
 
-        source = order.get('source', 'website')
-        source_icon = "🤖 WebApp" if source == 'webapp' else "🌐 Sayt"
+        source_icon = "🤖 WebApp" if order.source == 'webapp' else "🌐 Sayt"
 
         # ⭐ YANGI: To'lov kutilmoqda statusi
         status_text = "⏳ <b>YANGI BUYURTMA - TO'LOV KUTILMOQDA!</b>"
 
         admin_message = f"""{status_text}
 
-🆔 Buyurtma: #{order.get('order_id', 'N/A')[-6:]}
+🆔 Buyurtma: #{order.short_id}
 👤 Mijoz: {customer_name}
 📞 Telefon: {phone_display}
-💵 Summa: {format_price(order.get('total', 0))} so'm
-📱 Manba: {source_icon}{location_text}
+💵 Summa: {format_price(order.total or 0)} so'm
+📱 Manba: {source_icon}{location_text}{delivery_text(order)}
 
 🍽 Mahsulotlar:
 {items_text}
@@ -786,15 +3209,7 @@ async def notify_admin_payment_received(order: Dict, bot=None):
 <i>⚡ To'lovni tekshiring, keyin qabul qiling yoki bekor qiling</i>"""
 
         # ⭐⭐⭐ 3 TA TUGMA: Qabul, Bekor, To'lovni tekshirish
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ QABUL QILISH", callback_data=f"accept_{order.get('order_id')}"),
-                InlineKeyboardButton("❌ BEKOR QILISH", callback_data=f"reject_{order.get('order_id')}")
-            ],
-            [
-                InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=f"open_payme_group_{order.get('order_id')}")
-            ]
-        ])
+        keyboard = admin_order_keyboard(order)
 
         admin_sent = await bot.send_message(
             chat_id=ADMIN_CHAT_ID_INT,
@@ -826,6 +3241,7 @@ def get_cors_headers():
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
         'Access-Control-Allow-Headers': '*',
+        'Access-Control-Expose-Headers': 'ETag',
         'Access-Control-Max-Age': '86400',
     }
 
@@ -837,6 +3253,383 @@ async def options_handler(request):
         body='{}'
     )
 
+# ==========================================
+# CALLBACK MARSHRUTLASH (ixcham callback_data)
+# ==========================================
+
+# Buyurtma tugmalari: "~" + base64url(kod, orders.id, change_seq) - 19 belgi (limit 64 bayt)
+CALLBACK_PACKED_PREFIX = '~'
+_CALLBACK_STRUCT = struct.Struct('>cIQ')
+# orders.id -> oxirgi ko'rilgan change_seq; eskirgan tugma DB ga bormasdan rad etiladi
+CALLBACK_SEQ_CACHE_MAX = int(os.getenv("CALLBACK_SEQ_CACHE_MAX", "5000"))
+
+callback_stale_total = Counter(
+    'bodrum_callback_stale_total', 'Eskirgan tugma bosishlar', ('route', 'checked'))
+
+class CallbackRoute:
+    __slots__ = ('name', 'code', 'handler', 'versioned', 'legacy_prefix', 'takes_arg', 'preload')
+    
+    def __init__(self, name, code, handler, versioned, legacy_prefix, takes_arg, preload):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.versioned = versioned
+        self.legacy_prefix = legacy_prefix
+        self.takes_arg = takes_arg
+        self.preload = preload
+
+class CallbackArgs:
+    """Dekodlangan callback: buyurtma PK + versiya (yangi format) yoki order_id (eski format)"""
+    __slots__ = ('order_pk', 'version', 'order_id', 'arg', 'order')
+    
+    def __init__(self, order_pk: Optional[int] = None, version: int = 0,
+                 order_id: Optional[str] = None, arg: Optional[str] = None):
+        self.order_pk = order_pk
+        self.version = version
+        self.order_id = order_id
+        self.arg = arg
+        # Buyurtma tugmalari uchun dispatch da o'qiladi
+        self.order: Optional[Order] = None
+
+# kod -> route (ixcham format) va nom -> route (oddiy "admin_stats" kabi tugmalar)
+CALLBACK_ROUTES: Dict[bytes, CallbackRoute] = {}
+CALLBACK_ROUTES_BY_NAME: Dict[str, CallbackRoute] = {}
+# Yangilanishdan oldin yuborilgan xabarlardagi "accept_ORD_..." tugmalari uchun
+CALLBACK_LEGACY_PREFIXES: List[tuple] = []
+callback_seq_cache: OrderedDict = OrderedDict()
+
+def callback_route(name: str, code: Optional[str] = None, versioned: bool = False,
+                   legacy_prefix: Optional[str] = None, takes_arg: bool = False, preload: bool = True):
+    """Callback handler ni ro'yxatga olish.
+    code - buyurtma tugmalari uchun bitta belgi; versioned - eskirgan versiya rad etiladi;
+    takes_arg - "nom_<arg>" ko'rinishidagi tugmalar (arg handler ga beriladi);
+    preload=False - buyurtmani handler o'zi o'qiydi/yangilaydi (transition_order)."""
+    def decorator(handler):
+        route = CallbackRoute(name, code.encode() if code else None, handler, versioned,
+                              legacy_prefix, takes_arg, preload)
+        if route.code:
+            assert route.code not in CALLBACK_ROUTES, f"Callback kodi band: {code}"
+            CALLBACK_ROUTES[route.code] = route
+        CALLBACK_ROUTES_BY_NAME[name] = route
+        if legacy_prefix:
+            CALLBACK_LEGACY_PREFIXES.append((legacy_prefix, route))
+            # Uzunroq prefiks birinchi: "cancel_accept_" "accept_" dan oldin
+            CALLBACK_LEGACY_PREFIXES.sort(key=lambda item: -len(item[0]))
+        return handler
+    return decorator
+
+def order_callback(name: str, order: Order) -> str:
+    """Buyurtma tugmasi uchun callback_data (PK + change_seq)"""
+    route = CALLBACK_ROUTES_BY_NAME[name]
+    packed = _CALLBACK_STRUCT.pack(route.code, order.id, order.change_seq or 0)
+    return CALLBACK_PACKED_PREFIX + base64.urlsafe_b64encode(packed).rstrip(b'=').decode()
+
+def decode_callback(data: str):
+    """callback_data -> (route, CallbackArgs) yoki (None, None)"""
+    if data.startswith(CALLBACK_PACKED_PREFIX):
+        try:
+            raw = base64.urlsafe_b64decode(data[1:] + '=' * (-len(data[1:]) % 4))
+            code, order_pk, version = _CALLBACK_STRUCT.unpack(raw)
+        except (ValueError, struct.error):
+            return None, None
+        route = CALLBACK_ROUTES.get(code)
+        return route, CallbackArgs(order_pk=order_pk, version=version) if route else None
+    
+    route = CALLBACK_ROUTES_BY_NAME.get(data)
+    if route:
+        return route, CallbackArgs()
+    
+    head, _, arg = data.partition('_')
+    route = CALLBACK_ROUTES_BY_NAME.get(head)
+    if route and route.takes_arg:
+        return route, CallbackArgs(arg=arg)
+    
+    for prefix, route in CALLBACK_LEGACY_PREFIXES:
+        if data.startswith(prefix):
+            return route, CallbackArgs(order_id=data[len(prefix):])
+    return None, None
+
+def note_order_seq(order: Order):
+    """Jarayon ko'rgan eng yangi change_seq (eskirgan tugmalarni DB siz aniqlash uchun)"""
+    if not order or not order.id or not order.change_seq:
+        return
+    with _versions_lock:
+        if callback_seq_cache.get(order.id, 0) < order.change_seq:
+            callback_seq_cache[order.id] = order.change_seq
+            callback_seq_cache.move_to_end(order.id)
+            while len(callback_seq_cache) > CALLBACK_SEQ_CACHE_MAX:
+                callback_seq_cache.popitem(last=False)
+
+def callback_is_stale(route: CallbackRoute, args: CallbackArgs) -> bool:
+    """Ma'lum bo'lgan yangiroq versiya bor - DB ga murojaat qilmasdan rad etish"""
+    if not route.versioned or not args.version or args.order_pk is None:
+        return False
+    known = callback_seq_cache.get(args.order_pk)
+    return known is not None and known > args.version
+
+register_query('get_order_by_pk', f"SELECT {ORDER_SELECT} FROM orders WHERE id = %s", read_only=True)
+
+def get_order_by_pk(order_pk: int) -> Optional[Order]:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'get_order_by_pk', (order_pk,))
+        result = cur.fetchone()
+        cur.close()
+        return Order(*result) if result else None
+    except Exception as e:
+        logger.error(f"Get order by pk error: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def resolve_callback_order(args: CallbackArgs) -> Optional[Order]:
+    """Tugmadagi buyurtmani o'qish (yangi format - PK, eski - order_id)"""
+    order = get_order_by_pk(args.order_pk) if args.order_pk is not None else get_order(args.order_id)
+    note_order_seq(order)
+    return order
+
+def admin_order_keyboard(order: Order) -> InlineKeyboardMarkup:
+    """Yangi/to'langan buyurtma xabaridagi 3 ta tugma"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ QABUL QILISH", callback_data=order_callback('accept', order)),
+            InlineKeyboardButton("❌ BEKOR QILISH", callback_data=order_callback('reject', order))
+        ],
+        [
+            InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=order_callback('open_payme_group', order))
+        ]
+    ])
+
+# ==========================================
+# BOT HOLATI POSTGRES DA (bir nechta replika uchun)
+# ==========================================
+
+# Admin "tayyorlanish vaqtini kiriting" holati shuncha soniyadan keyin eskiradi
+ADMIN_FLOW_TTL = int(os.getenv("ADMIN_FLOW_TTL", "600"))
+
+# --- Admin jarayonlari (tayyorlanish vaqti kutilmoqda) ---
+# Write-through: boshqa replika yoki restartdan keyin ham darhol ko'rinadi
+
+register_query('admin_flow_start', """
+    INSERT INTO admin_flows (admin_id, action, order_id, expires_at)
+    VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+    ON CONFLICT (admin_id) DO UPDATE SET
+        action = EXCLUDED.action,
+        order_id = EXCLUDED.order_id,
+        expires_at = EXCLUDED.expires_at
+""")
+register_query('admin_flow_get', """
+    SELECT action, order_id FROM admin_flows
+    WHERE admin_id = %s AND expires_at > CURRENT_TIMESTAMP
+""", read_only=True)
+register_query('admin_flow_clear', """
+    DELETE FROM admin_flows
+    WHERE admin_id = %s AND (%s::text IS NULL OR order_id = %s)
+    RETURNING action
+""")
+register_query('admin_flows_expire', "DELETE FROM admin_flows WHERE expires_at <= CURRENT_TIMESTAMP")
+
+def start_admin_flow(admin_id: int, action: str, order_id: str, ttl: int = ADMIN_FLOW_TTL) -> bool:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'admin_flow_start', (admin_id, action, order_id, ttl))
+        conn.commit()
+        cur.close()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Admin flow saqlash xatosi: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def get_admin_flow(admin_id: int) -> Optional[Dict[str, str]]:
+    """Faol (muddati o'tmagan) admin jarayoni yoki None"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'admin_flow_get', (admin_id,))
+        row = cur.fetchone()
+        cur.close()
+        return {'action': row[0], 'order_id': row[1]} if row else None
+    except Exception as e:
+        logger.error(f"❌ Admin flow o'qish xatosi: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def clear_admin_flow(admin_id: int, order_id: Optional[str] = None) -> bool:
+    """Jarayonni yakunlash; order_id berilsa faqat shu buyurtma uchun. O'chirildimi?"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'admin_flow_clear', (admin_id, order_id, order_id))
+        cleared = cur.fetchone() is not None
+        conn.commit()
+        cur.close()
+        return cleared
+    except Exception as e:
+        logger.error(f"❌ Admin flow o'chirish xatosi: {e}")
+        if conn:
+            conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def expire_admin_flows() -> int:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'admin_flows_expire')
+        count = cur.rowcount
+        conn.commit()
+        cur.close()
+        return count
+    except Exception as e:
+        logger.error(f"❌ Admin flow tozalash xatosi: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+# ==========================================
+# LIDER SAYLOVI (Postgres advisory lock)
+# ==========================================
+
+# 0 - saylov o'chirilgan, har bir jarayon o'zini lider deb hisoblaydi (bitta replika)
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "1") == "1"
+# Barcha replikalar uchun bir xil advisory lock kaliti
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "7305521641"))
+# Lider lease ni shuncha soniyada tekshiradi, follower qayta urinadi
+LEADER_RENEW_INTERVAL = float(os.getenv("LEADER_RENEW_INTERVAL", "10"))
+
+is_leader_gauge = Gauge('bodrum_leader', 'Bu replika lider (1) yoki follower (0)')
+
+class LeaderElector:
+    """pg_try_advisory_lock asosidagi lider saylovi.
+    
+    Lock alohida (autocommit, keepalive li) ulanishda sessiya darajasida ushlanadi:
+    lider jarayoni o'lsa yoki tarmoq uzilsa Postgres sessiyani yopadi va lock bo'shaydi.
+    Lease yangilash - har LEADER_RENEW_INTERVAL da ulanish tirikligi va lock hali
+    bizdaligini tekshirish; yo'qotilsa on_demoted chaqiriladi."""
+    
+    def __init__(self, lock_key: int, on_elected=None, on_demoted=None):
+        self.lock_key = lock_key
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.is_leader = False
+        self._conn = None
+        self._task = None
+    
+    def _connect(self):
+        conn = psycopg2.connect(
+            DATABASE_URL,
+            application_name='bodrum-leader',
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            keepalives=1,
+            keepalives_idle=int(LEADER_RENEW_INTERVAL),
+            keepalives_interval=5,
+            keepalives_count=3
+        )
+        conn.autocommit = True
+        return conn
+    
+    def _try_acquire(self) -> bool:
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+        cur = self._conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_key,))
+        acquired = cur.fetchone()[0]
+        cur.close()
+        return acquired
+    
+    def _still_held(self) -> bool:
+        cur = self._conn.cursor()
+        cur.execute("""
+            SELECT 1 FROM pg_locks
+            WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND granted
+            AND objsubid = 1 AND ((classid::bigint << 32) | objid::bigint) = %s
+        """, (self.lock_key,))
+        held = cur.fetchone() is not None
+        cur.close()
+        return held
+    
+    def _check(self) -> bool:
+        """Bitta tik: lider bo'lsa lease ni tekshirish, aks holda lock olishga urinish"""
+        try:
+            if self.is_leader:
+                return self._still_held()
+            return self._try_acquire()
+        except Exception as e:
+            logger.error(f"❌ Leader lock xatosi: {e}")
+            self._close()
+            return False
+    
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+    
+    async def _set_leader(self, leader: bool):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        is_leader_gauge.set(1 if leader else 0)
+        callback = self.on_elected if leader else self.on_demoted
+        logger.info("👑 Bu replika lider bo'ldi" if leader else "🔻 Liderlik yo'qotildi")
+        if callback:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"❌ Leader callback xatosi: {e}")
+    
+    async def _renew_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(LEADER_RENEW_INTERVAL)
+            await self._set_leader(await loop.run_in_executor(None, self._check))
+    
+    async def start(self) -> bool:
+        """Birinchi urinish darhol; keyin fonda yangilash. Lider bo'lsa True"""
+        if not LEADER_ELECTION:
+            await self._set_leader(True)
+            return True
+        if self._task is not None:
+            # Startup qayta urinishi - fon yangilash allaqachon ishlayapti
+            return self.is_leader
+        await self._set_leader(await asyncio.get_running_loop().run_in_executor(None, self._check))
+        self._task = asyncio.create_task(self._renew_loop())
+        return self.is_leader
+    
+    async def stop(self):
+        """Lock ni bo'shatish - boshqa replika keyingi tikda lider bo'ladi"""
+        if self._task:
+            self._task.cancel()
+        if self.is_leader and self._conn is not None:
+            try:
+                cur = self._conn.cursor()
+                cur.execute("SELECT pg_advisory_unlock(%s)", (self.lock_key,))
+                cur.close()
+            except Exception as e:
+                logger.error(f"❌ Leader unlock xatosi: {e}")
+        self._close()
+        self.is_leader = False
+
 # ==========================================
 # TELEGRAM BOT FUNCTIONS
 # ==========================================
@@ -851,6 +3644,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_admin:
         keyboard = [
             [InlineKeyboardButton("🛎️ Yangi buyurtmalar", callback_data="show_new_orders")],
+            [InlineKeyboardButton("☑️ Ommaviy amal", callback_data="bulk_select")],
             [InlineKeyboardButton("📊 Statistika", callback_data="admin_stats")],
             [InlineKeyboardButton("🍽️ Menyu ko'rish", web_app=WebAppInfo(url=WEBAPP_URL))],
             [InlineKeyboardButton("⚙️ Admin Panel", web_app=WebAppInfo(url=f"{WEBAPP_URL}/admin.html"))]
@@ -872,9 +3666,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Oddiy foydalanuvchi
     profile = get_user_profile(user.id)
     
-    if profile and profile.get('phone'):
-        name = profile.get('name', 'Foydalanuvchi')
-        phone = profile.get('phone', '')
+    if profile and profile.phone:
+        name = profile.name or 'Foydalanuvchi'
+        phone = profile.phone
         
         formatted_phone = phone
         if len(phone) == 9:
@@ -960,6 +3754,13 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML'
         )
 
+register_query('new_orders_24h', f"""
+    SELECT {ORDER_SELECT} FROM orders 
+    WHERE status IN ('pending_payment', 'pending')
+    AND created_at > CURRENT_TIMESTAMP - INTERVAL '24 hours'
+    ORDER BY created_at DESC
+""", read_only=True)
+
 async def show_new_orders_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Yangi buyurtmalar ro'yxatini ko'rsatish"""
     query = update.callback_query
@@ -967,27 +3768,14 @@ async def show_new_orders_list(update: Update, context: ContextTypes.DEFAULT_TYP
     
     conn = None
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True, consistency_key='orders')
         cur = conn.cursor()
         
         # ⭐⭐⭐ TO'G'RILANDI - Yangi buyurtmalar: pending_payment statusida
-        cur.execute("""
-            SELECT * FROM orders 
-            WHERE status IN ('pending_payment', 'pending')
-            AND created_at > CURRENT_TIMESTAMP - INTERVAL '24 hours'
-            ORDER BY created_at DESC
-        """)
-        results = cur.fetchall()
+        execute_named(cur, 'new_orders_24h')
+        new_orders = [Order(*row) for row in cur.fetchall()]
         cur.close()
         
-        new_orders = []
-        for row in results:
-            order_dict = dict(row)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            new_orders.append(order_dict)
-        
     except Exception as e:
         logger.error(f"❌ Yangi buyurtmalarni olish xatosi: {e}")
         new_orders = []
@@ -1006,57 +3794,41 @@ async def show_new_orders_list(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Har bir buyurtma uchun xabar yuborish
     for order in new_orders:
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
+        items = order.items
         
         items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
         
-        raw_phone = order.get('phone', '')
-        phone_display = format_phone_display(raw_phone)
+        phone_display = format_phone_display(order.phone)
         
-        location = order.get('location')
         location_text = ""
-        location_coords = None
-        if location and ',' in str(location):
-            try:
-                lat, lng = str(location).split(',')
-                lat = float(lat.strip())
-                lng = float(lng.strip())
-                location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
-                location_coords = (lat, lng)
-            except:
-                pass
+        location_coords = order.coords
+        if location_coords:
+            lat, lng = location_coords
+            location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
+        
+        created_at = order.created_at or datetime.now()
         
         message = f"""🛎️ <b>YANGI BUYURTMA!</b>
 
-🆔 Buyurtma: #{order.get('order_id', 'N/A')[-6:]}
-👤 Mijoz: {order.get('name')}
+🆔 Buyurtma: #{order.short_id}
+👤 Mijoz: {order.name}
 📞 Telefon: {phone_display}
-💵 Summa: {format_price(order.get('total', 0))} so'm
-💳 To'lov: Kutilmoqda{location_text}
+💵 Summa: {format_price(order.total or 0)} so'm
+💳 To'lov: Kutilmoqda{location_text}{delivery_text(order)}
 
 🍽 Mahsulotlar:
 {items_text}
 
-⏰ {order.get('created_at', datetime.now().isoformat())[:19]}
+⏰ {created_at.strftime('%Y-%m-%d %H:%M:%S')}
 
 <i>⏳ To'lovni tekshiring va buyurtmani qabul qiling</i>"""
 
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ QABUL QILISH", callback_data=f"accept_{order.get('order_id')}"),
-                InlineKeyboardButton("❌ BEKOR QILISH", callback_data=f"reject_{order.get('order_id')}")
-            ],
-            [
-                InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=f"open_payme_group_{order.get('order_id')}")
-            ]
-        ]
+        keyboard = admin_order_keyboard(order)
         
         sent_message = await context.bot.send_message(
             chat_id=update.effective_user.id,
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=keyboard,
             parse_mode='HTML'
         )
         
@@ -1075,6 +3847,9 @@ async def show_new_orders_list(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.edit_message_text(
         f"📋 <b>{len(new_orders)} ta yangi buyurtma</b> yuborildi.\n"
         f"⏳ Ularni qabul qilish yoki bekor qilish mumkin.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("☑️ Bir nechtasini birdan", callback_data="bulk_select")]
+        ]),
         parse_mode='HTML'
     )
 
@@ -1089,58 +3864,49 @@ async def prep_time_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id != ADMIN_CHAT_ID_INT:
         return
     
-    # Kutilayotgan state mavjudmi tekshirish
-    if not context.user_data.get('awaiting_prep_time'):
+    # Kutilayotgan state mavjudmi tekshirish (DB da - istalgan replika ko'radi)
+    flow = get_admin_flow(user.id)
+    if not flow or flow['action'] != 'prep_time':
         return
     
-    order_id = context.user_data.get('accepting_order_id')
+    order_id = flow['order_id']
     prep_time = update.message.text.strip()
     
     if not order_id:
         await update.message.reply_text("❌ Xatolik: Buyurtma ID topilmadi!")
-        context.user_data.pop('awaiting_prep_time', None)
-        context.user_data.pop('accepting_order_id', None)
-        return
-    
-    # Buyurtma ma'lumotlarini olish
-    order = get_order(order_id)
-    if not order:
-        await update.message.reply_text("❌ Xatolik: Buyurtma ma'lumotlar bazasidan topilmadi!")
-        context.user_data.pop('awaiting_prep_time', None)
-        context.user_data.pop('accepting_order_id', None)
-        return
-    
-    # Buyurtma allaqachon qabul qilinganmi tekshirish
-    if order.get('status') == 'accepted':
-        await update.message.reply_text("⚠️ Bu buyurtma allaqachon qabul qilingan!")
-        context.user_data.pop('awaiting_prep_time', None)
-        context.user_data.pop('accepting_order_id', None)
+        clear_admin_flow(user.id)
         return
     
     try:
-        # Buyurtma statusini yangilash (accepted + tayyorlanish vaqti)
-        updated_order = update_order_status(
-            order_id, 
-            'accepted',
-            admin_note=f"Tayyorlanish vaqti: {prep_time}",
-            accepted_at=datetime.utcnow()
-        )
-        
-        if updated_order:
+        # Tekshirish va yangilash bitta shartli UPDATE da (ikki admin / qayta bosish poygasi yo'q)
+        result = transition_order(order_id, 'accepted', admin_note=f"{PREP_TIME_NOTE}{prep_time}")
+        
+        if result and result.outcome == TransitionResult.NOT_FOUND:
+            await update.message.reply_text("❌ Xatolik: Buyurtma ma'lumotlar bazasidan topilmadi!")
+        elif result and result.outcome == TransitionResult.ALREADY:
+            await update.message.reply_text("⚠️ Bu buyurtma allaqachon qabul qilingan!")
+        elif result and result.outcome == TransitionResult.ILLEGAL:
+            await update.message.reply_text(
+                f"⚠️ Buyurtmani qabul qilib bo'lmaydi - holati: <b>{result.order.status}</b>",
+                parse_mode='HTML'
+            )
+        elif result and result.applied:
+            order = result.order
             # Admin ga tasdiqlash xabarini yuborish
+            customer_name = order.name or "Noma'lum"
             admin_confirm_msg = (
                 f"✅ <b>BUYURTMA QABUL QILINDI</b>\n\n"
                 f"🆔 Buyurtma: #{order_id[-6:]}\n"
-                f"👤 Mijoz: {order.get('name', 'Noma\'lum')}\n"
+                f"👤 Mijoz: {customer_name}\n"
                 f"⏱ <b>Tayyorlanish vaqti:</b> {prep_time}\n"
-                f"💵 Summa: {format_price(order.get('total', 0))} so'm\n\n"
-                f"📨 Mijozga xabar yuborildi!"
+                f"💵 Summa: {format_price(order.total or 0)} so'm\n\n"
+                f"📨 Mijozga xabar yuboriladi."
             )
             
             await update.message.reply_text(admin_confirm_msg, parse_mode='HTML')
             
-            # Mijozga xabar yuborish
-            await notify_customer_accepted(context.bot, order, prep_time)
+            # Admin alerti va mijoz xabari joyida yangilanadi
+            queue_order_refresh(order)
             
         else:
             await update.message.reply_text(
@@ -1157,309 +3923,330 @@ async def prep_time_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     finally:
         # State ni tozalash
-        context.user_data.pop('awaiting_prep_time', None)
-        context.user_data.pop('accepting_order_id', None)
+        clear_admin_flow(user.id)
 
-async def notify_customer_accepted(bot, order: Dict, prep_time: str):
-    """
-    Buyurtma qabul qilinganda mijozga xabar yuboradi.
-    Tayyorlanish vaqti bilan birga yuboriladi.
-    """
-    tg_id = order.get('tg_id')
-    
-    if not tg_id or str(tg_id) in ['0', 'None', '', 'null']:
-        logger.warning(f"⚠️ Mijoz tg_id yo'q: {order.get('order_id')}")
-        return False
-    
+# --- Ommaviy tanlash (multi-select) ---
+# Tanlov holati tugmalarning o'zida (☑️/⬜) - DB ga yozilmaydi, istalgan replika davom ettiradi
+
+BULK_SELECT_LIMIT = 40  # Telegram inline klaviatura 100 tugmagacha
+BULK_PREP_TIMES = ['15 daqiqa', '20 daqiqa', '30-40 daqiqa', '1 soat']
+BULK_CHECKED, BULK_UNCHECKED = '☑️', '⬜'
+BULK_STATUS_ICONS = {'pending_payment': '⏳', 'pending': '⏳', 'accepted': '👨‍🍳'}
+BULK_STATUS_DONE = {'accepted': 'qabul qilindi', 'rejected': 'bekor qilindi', 'confirmed': 'tasdiqlandi'}
+
+register_query('bulk_candidates', f"""
+    SELECT {ORDER_SELECT} FROM orders
+    WHERE status IN ('pending_payment', 'pending', 'accepted')
+    AND created_at > CURRENT_TIMESTAMP - INTERVAL '24 hours'
+    ORDER BY created_at
+    LIMIT %s
+""", read_only=True)
+
+def _bulk_action_rows(count: int) -> List[List[InlineKeyboardButton]]:
+    return [
+        [
+            InlineKeyboardButton(f"✅ Qabul ({count})", callback_data="bulk_ask_prep"),
+            InlineKeyboardButton(f"❌ Bekor ({count})", callback_data="bulk_do_rejected")
+        ],
+        [
+            InlineKeyboardButton(f"✅✅ Tayyor ({count})", callback_data="bulk_do_confirmed"),
+            InlineKeyboardButton("✖️ Yopish", callback_data="bulk_close")
+        ]
+    ]
+
+def _bulk_prep_rows() -> List[List[InlineKeyboardButton]]:
+    buttons = [InlineKeyboardButton(f"⏱ {label}", callback_data=f"bulk_prep_{i}") for i, label in enumerate(BULK_PREP_TIMES)]
+    return [buttons[:2], buttons[2:], [InlineKeyboardButton("🔙 Orqaga", callback_data="bulk_back")]]
+
+def _bulk_order_rows(markup: InlineKeyboardMarkup) -> List[List[InlineKeyboardButton]]:
+    return [row for row in markup.inline_keyboard if row and row[0].callback_data.startswith("bulk_t_")]
+
+def _bulk_selected(markup: InlineKeyboardMarkup) -> List[str]:
+    return [row[0].callback_data[len("bulk_t_"):] for row in _bulk_order_rows(markup)
+            if row[0].text.startswith(BULK_CHECKED)]
+
+async def show_bulk_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Faol buyurtmalar ro'yxati - belgilab, bitta amal bilan o'zgartirish"""
+    query = update.callback_query
+    conn = None
     try:
-        # Xabar matnini tayyorlash
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
-        
-        items_short = ", ".join([f"{i.get('name')} x{i.get('qty')}" for i in items[:3]])
-        if len(items) > 3:
-            items_short += f" va yana {len(items)-3} ta"
-        
-        customer_message = (
-            f"🎉 <b>Buyurtmangiz qabul qilindi!</b>\n\n"
-            f"🆔 <b>Buyurtma raqami:</b> #{str(order.get('order_id', 'N/A'))[-6:]}\n"
-            f"⏱ <b>Tayyorlanish vaqti:</b> {prep_time}\n"
-            f"💵 <b>Summa:</b> {format_price(order.get('total', 0))} so'm\n\n"
-            f"🍽 <b>Buyurtma:</b>\n{items_short}\n\n"
-            f"👨‍🍳 Oshxonada tayyorlanmoqda...\n"
-            f"🚚 Tayyor bo'lganda yetkazib beramiz!\n\n"
-            f"📞 Savollar bo'yicha: +998901234567\n"
-            f"⏰ {datetime.now().strftime('%H:%M')}"
-        )
-        
-        # Mijozga xabar yuborish
-        await bot.send_message(
-            chat_id=int(tg_id),
-            text=customer_message,
-            parse_mode='HTML'
-        )
-        
-        logger.info(f"✅ Mijozga qabul xabari yuborildi: {tg_id}, vaqt: {prep_time}")
-        return True
-        
+        conn = get_db_connection(readonly=True, consistency_key='orders')
+        cur = conn.cursor()
+        execute_named(cur, 'bulk_candidates', (BULK_SELECT_LIMIT,))
+        orders = [Order(*row) for row in cur.fetchall()]
+        cur.close()
     except Exception as e:
-        logger.error(f"❌ Mijozga xabar yuborishda xato: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+        logger.error(f"❌ Ommaviy tanlov ro'yxati xatosi: {e}")
+        orders = []
+    finally:
+        if conn:
+            conn.close()
+    
+    if not orders:
+        await query.edit_message_text("📭 <b>Faol buyurtmalar yo'q</b>", parse_mode='HTML')
+        return
+    
+    rows = [[InlineKeyboardButton(
+        f"{BULK_UNCHECKED} #{order.short_id} {BULK_STATUS_ICONS.get(order.status, '')} {format_price(order.total or 0)} so'm",
+        callback_data=f"bulk_t_{order.order_id}"
+    )] for order in orders]
+    
+    await query.edit_message_text(
+        "☑️ <b>OMMAVIY AMAL</b>\n\n"
+        "Buyurtmalarni belgilang, keyin amalni tanlang.\n"
+        "⏳ - to'lov kutilmoqda, 👨‍🍳 - tayyorlanmoqda",
+        reply_markup=InlineKeyboardMarkup(rows + _bulk_action_rows(0)),
+        parse_mode='HTML'
+    )
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Barcha callback query larni qayta ishlash.
-    Bu yerda tugma bosilganlarida bajariladigan amallar mavjud.
-    """
+async def bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
     query = update.callback_query
-    user = update.effective_user
+    markup = query.message.reply_markup
+    order_rows = _bulk_order_rows(markup)
     
-    # Har doim callback query ga javob qaytarish (telegram talabi)
-    try:
-        await query.answer()
-    except Exception as e:
-        logger.error(f"Query answer xatosi: {e}")
+    if data == "bulk_close":
+        await query.edit_message_text("✖️ Ommaviy amal yopildi.")
+        return
     
-    data = query.data
-    logger.info(f"👆 Callback query: {data} from admin: {user.id}")
+    # Belgini almashtirish - faqat klaviatura tahrirlanadi
+    if data.startswith("bulk_t_"):
+        rows = []
+        for row in order_rows:
+            button = row[0]
+            if button.callback_data == data:
+                mark, rest = button.text.split(' ', 1)
+                mark = BULK_UNCHECKED if mark == BULK_CHECKED else BULK_CHECKED
+                button = InlineKeyboardButton(f"{mark} {rest}", callback_data=button.callback_data)
+            rows.append([button])
+        count = sum(1 for row in rows if row[0].text.startswith(BULK_CHECKED))
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(rows + _bulk_action_rows(count)))
+        return
     
-    # === TAYYORLANISH VAQTI KUTILMOQDA (Bekor qilish) ===
-    if data.startswith("cancel_accept_"):
-        order_id = data.replace("cancel_accept_", "")
-        
-        # State ni tekshirish
-        if (context.user_data.get('awaiting_prep_time') and 
-            context.user_data.get('accepting_order_id') == order_id):
-            
-            context.user_data.pop('awaiting_prep_time', None)
-            context.user_data.pop('accepting_order_id', None)
-            
-            await query.edit_message_text(
-                "❌ <b>Qabul qilish bekor qilindi</b>\n\n"
-                "Yangi buyurtmalarni ko'rish uchun /start ni bosing.",
-                parse_mode='HTML'
-            )
-            return
+    selected = _bulk_selected(markup)
     
-    # === STATISTIKA ===
-    if data == "admin_stats":
-        await show_stats(update, context)
+    if data == "bulk_back":
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(order_rows + _bulk_action_rows(len(selected))))
         return
     
-    # === YANGI BUYURTMALAR RO'YXATI ===
-    if data == "show_new_orders":
-        await show_new_orders_list(update, context)
+    if not selected:
+        await query.answer("⚠️ Avval buyurtmalarni belgilang", show_alert=True)
         return
     
-    # === PAYME GURUHIGA O'TISH ===
-    if data.startswith("open_payme_group_"):
-        order_id = data.replace("open_payme_group_", "")
-        order = get_order(order_id)
-        
-        if not order:
-            await query.edit_message_text("❌ Buyurtma topilmadi!")
-            return
-        
-        payme_group_username = os.getenv("PAYME_GROUP_USERNAME", "bodrumbota")
-        group_link = f"https://t.me/{payme_group_username}"
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💳 Payme guruhiga o'tish", url=group_link)],
-            [InlineKeyboardButton("🔙 Orqaga", callback_data=f"back_to_order_{order_id}")]
-        ])
-        
-        await query.edit_message_text(
-            f"💳 <b>To'lovni tekshirish</b>\n\n"
-            f"🆔 Buyurtma: #{order_id[-6:]}\n"
-            f"💵 Summa: {format_price(order.get('total', 0))} so'm\n\n"
-            f"Quyidagi ORDER ID ni Payme guruhida qidiring:\n"
-            f"<code>{order_id}</code>\n\n"
-            f"To'lov topilsa, qaytib kelib <b>\"Qabul qilish\"</b> ni bosing.",
-            reply_markup=keyboard,
-            parse_mode='HTML'
-        )
+    if data == "bulk_ask_prep":
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(order_rows + _bulk_prep_rows()))
         return
     
-    # === ORQAGA QAYTISH ===
-    if data.startswith("back_to_order_"):
-        order_id = data.replace("back_to_order_", "")
-        order = get_order(order_id)
-        
-        if not order:
-            await query.edit_message_text("❌ Buyurtma topilmadi!")
+    prep_time = None
+    if data.startswith("bulk_prep_"):
+        status = 'accepted'
+        prep_time = BULK_PREP_TIMES[int(data[len("bulk_prep_"):])]
+    else:
+        status = data[len("bulk_do_"):]
+        if status not in BATCH_STATUSES:
             return
-        
-        # Buyurtma ma'lumotlarini qayta ko'rsatish
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
-        
-        items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
-        phone_display = format_phone_display(order.get('phone', ''))
-        
-        location_text = ""
-        location = order.get('location')
-        if location and ',' in str(location):
-            try:
-                lat, lng = str(location).split(',')
-                location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
-            except:
-                pass
-        
-        status_text = "⏳ <b>YANGI BUYURTMA - TO'LOV KUTILMOQDA!</b>"
-        
-        message = (
-            f"{status_text}\n\n"
-            f"🆔 Buyurtma: #{order_id[-6:]}\n"
-            f"👤 Mijoz: {order.get('name')}\n"
-            f"📞 Telefon: {phone_display}\n"
-            f"💵 Summa: {format_price(order.get('total', 0))} so'm"
-            f"{location_text}\n\n"
-            f"🍽 Mahsulotlar:\n{items_text}\n\n"
-            f"⏰ {datetime.now().strftime('%H:%M:%S')}"
-        )
-        
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ QABUL QILISH", callback_data=f"accept_{order_id}"),
-                InlineKeyboardButton("❌ BEKOR QILISH", callback_data=f"reject_{order_id}")
-            ],
-            [
-                InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=f"open_payme_group_{order_id}")
-            ]
-        ])
-        
-        await query.edit_message_text(message, reply_markup=keyboard, parse_mode='HTML')
+    
+    admin_note = f"{PREP_TIME_NOTE}{prep_time}" if prep_time else None
+    updated = update_orders_batch(selected, status, admin_note)
+    if updated is None:
+        await query.edit_message_text("❌ Xatolik yuz berdi!")
         return
     
-    # === BUYURTMANI QABUL QILISH (Vaqt so'rash) ===
-    if data.startswith("accept_"):
-        order_id = data.replace("accept_", "")
-        order = get_order(order_id)
-        
-        if not order:
-            await query.edit_message_text("❌ Buyurtma topilmadi!")
-            return
-        
-        # Allaqachon qabul qilinganmi?
-        if order.get('status') == 'accepted':
-            await query.answer("⚠️ Bu buyurtma allaqachon qabul qilingan!", show_alert=True)
-            return
-        
-        # State saqlash
-        context.user_data['awaiting_prep_time'] = True
-        context.user_data['accepting_order_id'] = order_id
-        
-        # Vaqt kiritish uchun so'rov
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
-        items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("❌ Bekor qilish", callback_data=f"cancel_accept_{order_id}")]
-        ])
-        
-        prompt_message = (
-            f"⏱ <b>BUYURTMANI QABUL QILISH</b>\n\n"
-            f"🆔 Buyurtma: #{order_id[-6:]}\n"
-            f"👤 Mijoz: {order.get('name')}\n"
-            f"💵 Summa: {format_price(order.get('total', 0))} so'm\n\n"
-            f"🍽 Mahsulotlar:\n{items_text}\n\n"
-            f"✍️ <b>Tayyorlanish vaqtini kiriting:</b>\n"
-            f"<i>Masalan:</i> <code>20 daqiqa</code>, <code>30-40 daqiqa</code>, <code>1 soat</code>"
-        )
-        
-        await query.edit_message_text(
-            prompt_message,
-            reply_markup=keyboard,
-            parse_mode='HTML'
-        )
+    notified = refresh_order_messages(updated)
+    skipped = len(selected) - len(updated)
+    ids_text = ", ".join(f"#{order.short_id}" for order in updated) or "-"
+    prep_text = f"\n⏱ Tayyorlanish vaqti: {prep_time}" if prep_time else ""
+    skipped_text = f"\n⚠️ O'zgarmadi (holati mos emas): {skipped} ta" if skipped else ""
+    
+    await query.edit_message_text(
+        f"📦 <b>{len(updated)} ta buyurtma {BULK_STATUS_DONE[status]}</b>\n\n"
+        f"🆔 {ids_text}{prep_text}{skipped_text}\n"
+        f"📨 Mijozlarga xabar navbatda: {notified} ta\n"
+        f"⏰ {datetime.now().strftime('%H:%M:%S')}",
+        parse_mode='HTML'
+    )
+
+# --- Callback route lari (dispatch: CALLBACK MARSHRUTLASH bo'limi) ---
+
+CALLBACK_STALE_TEXT = "⚠️ Bu tugma eskirgan - buyurtma o'zgargan. Yangi xabardan foydalaning."
+
+@callback_route('cancel_accept', code='c', legacy_prefix='cancel_accept_')
+async def cancel_accept_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Tayyorlanish vaqti kutilmoqda - bekor qilish"""
+    # State ni tekshirish va tozalash (faqat shu buyurtma uchun bo'lsa)
+    # Xabar yana buyurtma kartasiga qaytadi (alert joyida qoladi)
+    if clear_admin_flow(update.effective_user.id, args.order.order_id):
+        text, markup = render_admin_order_card(args.order)
+        await update.callback_query.edit_message_text(text, reply_markup=markup, parse_mode='HTML')
+
+@callback_route('bulk_select')
+async def bulk_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    await show_bulk_select(update, context)
+
+@callback_route('bulk', takes_arg=True)
+async def bulk_action_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    await bulk_callback(update, context, f"bulk_{args.arg}")
+
+@callback_route('admin_stats')
+async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    await show_stats(update, context)
+
+@callback_route('show_new_orders')
+async def show_new_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    await show_new_orders_list(update, context)
+
+@callback_route('open_payme_group', code='p', legacy_prefix='open_payme_group_')
+async def open_payme_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Payme guruhiga o'tish"""
+    order = args.order
+    order_id = order.order_id
+    
+    payme_group_username = os.getenv("PAYME_GROUP_USERNAME", "bodrumbota")
+    group_link = f"https://t.me/{payme_group_username}"
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💳 Payme guruhiga o'tish", url=group_link)],
+        [InlineKeyboardButton("🔙 Orqaga", callback_data=order_callback('back_to_order', order))]
+    ])
+    
+    await update.callback_query.edit_message_text(
+        f"💳 <b>To'lovni tekshirish</b>\n\n"
+        f"🆔 Buyurtma: #{order_id[-6:]}\n"
+        f"💵 Summa: {format_price(order.total or 0)} so'm\n\n"
+        f"Quyidagi ORDER ID ni Payme guruhida qidiring:\n"
+        f"<code>{order_id}</code>\n\n"
+        f"To'lov topilsa, qaytib kelib <b>\"Qabul qilish\"</b> ni bosing.",
+        reply_markup=keyboard,
+        parse_mode='HTML'
+    )
+
+@callback_route('back_to_order', code='b', legacy_prefix='back_to_order_')
+async def back_to_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Buyurtma ma'lumotlarini qayta ko'rsatish (yangi versiyadagi tugmalar bilan)"""
+    text, markup = render_admin_order_card(args.order)
+    await update.callback_query.edit_message_text(text, reply_markup=markup, parse_mode='HTML')
+
+@callback_route('accept', code='a', versioned=True, legacy_prefix='accept_')
+async def accept_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Buyurtmani qabul qilish - tayyorlanish vaqtini so'rash"""
+    query = update.callback_query
+    order = args.order
+    order_id = order.order_id
+    
+    # Allaqachon qabul qilinganmi? (yakuniy tekshiruv prep_time_handler dagi transition_order da)
+    if order.status == 'accepted':
+        await query.answer("⚠️ Bu buyurtma allaqachon qabul qilingan!", show_alert=True)
+        return
+    if not can_transition(order.status, 'accepted'):
+        await query.edit_message_text(f"⚠️ Buyurtmani qabul qilib bo'lmaydi - holati: <b>{order.status}</b>", parse_mode='HTML')
         return
     
-    # === BUYURTMANI BEKOR QILISH ===
-    if data.startswith("reject_"):
-        action, order_id = data.split("_", 1)
-        order = get_order(order_id)
-        
-        if not order:
-            await query.edit_message_text("❌ Buyurtma topilmadi!")
-            return
-        
-        # Status ni rejected ga o'zgartirish
-        updated = update_order_status(order_id, 'rejected', rejected_at=datetime.utcnow())
-        
-        if updated:
-            # Admin ga tasdiq
-            await query.edit_message_text(
-                f"❌ <b>BUYURTMA BEKOR QILINDI</b>\n\n"
-                f"🆔 #{order_id[-6:]}\n"
-                f"👤 {order.get('name')}\n"
-                f"⏰ {datetime.now().strftime('%H:%M:%S')}",
-                parse_mode='HTML'
-            )
-            
-            # Mijoz ga xabar
-            tg_id = order.get('tg_id')
-            if tg_id and str(tg_id) not in ['0', 'None', '', 'null']:
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(tg_id),
-                        text=(
-                            f"❌ <b>Buyurtmangiz bekor qilindi</b>\n\n"
-                            f"🆔 Buyurtma: #{order_id[-6:]}\n"
-                            f"📞 Qo'llab-quvvatlash: +998901234567"
-                        ),
-                        parse_mode='HTML'
-                    )
-                except Exception as e:
-                    logger.error(f"Mijozga bekor xabari yuborishda xato: {e}")
-        else:
-            await query.edit_message_text("❌ Xatolik yuz berdi!")
-        
+    # State saqlash (muddati ADMIN_FLOW_TTL)
+    start_admin_flow(update.effective_user.id, 'prep_time', order_id)
+    
+    # Vaqt kiritish uchun so'rov
+    items = order.items
+    items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
+    
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=order_callback('cancel_accept', order))]
+    ])
+    
+    prompt_message = (
+        f"⏱ <b>BUYURTMANI QABUL QILISH</b>\n\n"
+        f"🆔 Buyurtma: #{order_id[-6:]}\n"
+        f"👤 Mijoz: {order.name}\n"
+        f"💵 Summa: {format_price(order.total or 0)} so'm\n\n"
+        f"🍽 Mahsulotlar:\n{items_text}\n\n"
+        f"✍️ <b>Tayyorlanish vaqtini kiriting:</b>\n"
+        f"<i>Masalan:</i> <code>20 daqiqa</code>, <code>30-40 daqiqa</code>, <code>1 soat</code>"
+    )
+    
+    await query.edit_message_text(
+        prompt_message,
+        reply_markup=keyboard,
+        parse_mode='HTML'
+    )
+
+async def transition_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs, target: str):
+    """Tugma bo'yicha status o'tishi: tekshirish + yangilash bitta so'rovda (transition_order).
+    Bosilgan xabar darhol joriy holatga tahrirlanadi, qolganlari queue_order_refresh orqali."""
+    query = update.callback_query
+    result = transition_order(args.order_id, target, order_pk=args.order_pk,
+                              expected_version=args.version or None)
+    
+    if result is None:
+        await query.edit_message_text("❌ Xatolik yuz berdi!")
+        return
+    if result.outcome == TransitionResult.NOT_FOUND:
+        await query.edit_message_text("❌ Buyurtma topilmadi!")
+        return
+    if result.outcome == TransitionResult.STALE:
+        callback_stale_total.inc(target, 'db')
+        await query.edit_message_text(CALLBACK_STALE_TEXT)
         return
     
-    # === BUYURTMANI TASDIQLASH (Confirm) ===
-    if data.startswith("confirm_"):
-        action, order_id = data.split("_", 1)
-        order = get_order(order_id)
-        
-        if not order:
-            await query.edit_message_text("❌ Buyurtma topilmadi!")
+    order = result.order
+    text, markup = render_admin_order_card(order)
+    if result.outcome != TransitionResult.APPLIED:
+        note = "Allaqachon shu holatda" if result.outcome == TransitionResult.ALREADY else "Bu amal hozirgi holatda mumkin emas"
+        text = f"⚠️ <i>{note}</i>\n\n{text}"
+    
+    await query.edit_message_text(text, reply_markup=markup, parse_mode='HTML')
+    
+    # Admin alerti (boshqa xabar bo'lsa) va mijoz xabari
+    if result.applied:
+        queue_order_refresh(order, fresh_message=(query.message.chat_id, query.message.message_id))
+
+@callback_route('reject', code='r', versioned=True, legacy_prefix='reject_', preload=False)
+async def reject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Buyurtmani bekor qilish"""
+    await transition_callback(update, context, args, 'rejected')
+
+@callback_route('confirm', code='f', versioned=True, legacy_prefix='confirm_', preload=False)
+async def confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, args: CallbackArgs):
+    """Buyurtmani tasdiqlash (tayyor)"""
+    await transition_callback(update, context, args, 'confirmed')
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Barcha callback query lar: callback_data dekodlanadi va CALLBACK_ROUTES dan
+    handler olinadi. Eskirgan versiyali tugmalar DB ga murojaatsiz rad etiladi.
+    """
+    query = update.callback_query
+    user = update.effective_user
+    data = query.data
+    logger.info(f"👆 Callback query: {data} from admin: {user.id}")
+    
+    route, args = decode_callback(data or '')
+    if route is None:
+        logger.warning(f"⚠️ Noma'lum callback: {data}")
+        await query.answer()
+        return
+    
+    if callback_is_stale(route, args):
+        callback_stale_total.inc(route.name, 'cache')
+        await query.answer(CALLBACK_STALE_TEXT, show_alert=True)
+        return
+    
+    # Buyurtma tugmalari: buyurtma bir marta o'qiladi va handler ga beriladi
+    if route.code and route.preload:
+        args.order = resolve_callback_order(args)
+        if args.order and route.versioned and args.version and args.order.change_seq != args.version:
+            callback_stale_total.inc(route.name, 'db')
+            await query.answer(CALLBACK_STALE_TEXT, show_alert=True)
             return
-        
-        updated = update_order_status(order_id, 'confirmed', confirmed_at=datetime.utcnow())
-        
-        if updated:
-            await query.edit_message_text(
-                f"✅✅ <b>BUYURTMA TASDIQLANDI</b>\n\n"
-                f"🆔 #{order_id[-6:]}\n"
-                f"⏰ {datetime.now().strftime('%H:%M:%S')}",
-                parse_mode='HTML'
-            )
-            
-            # Mijoz ga xabar
-            tg_id = order.get('tg_id')
-            if tg_id and str(tg_id) not in ['0', 'None', '', 'null']:
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(tg_id),
-                        text=(
-                            f"✅✅ <b>Buyurtmangiz tayyor!</b>\n\n"
-                            f"🆔 Buyurtma: #{order_id[-6:]}\n"
-                            f"🚚 Tez orada yetkazib beramiz!"
-                        ),
-                        parse_mode='HTML'
-                    )
-                except Exception as e:
-                    logger.error(f"Mijozga tasdiq xabari yuborishda xato: {e}")
-        else:
-            await query.edit_message_text("❌ Xatolik yuz berdi!")
-        
+    
+    # Har doim callback query ga javob qaytarish (telegram talabi)
+    try:
+        await query.answer()
+    except Exception as e:
+        logger.error(f"Query answer xatosi: {e}")
+    
+    if route.code and route.preload and not args.order:
+        await query.edit_message_text("❌ Buyurtma topilmadi!")
         return
+    
+    await route.handler(update, context, args)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Statistika ko'rsatish"""
@@ -1471,32 +4258,69 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await show_stats(update, context)
 
+register_query('stats_new_count', f"""
+    SELECT COUNT(*) FROM orders
+    WHERE status IN ('pending', 'pending_payment')
+    {orders_hot_bound()}
+""", read_only=True)
+register_query('stats_today', f"""
+    SELECT COUNT(*), COALESCE(SUM(total), 0) FROM orders
+    WHERE status = 'accepted'
+    AND accepted_at >= %s::date AND accepted_at < %s::date + 1
+    {orders_hot_bound('CURRENT_DATE')}
+""", read_only=True)
+# Jami - arxivga ko'chirilgan buyurtmalar ham hisobga olinadi
+register_query('stats_total', """
+    SELECT COUNT(*), COALESCE(SUM(total), 0) FROM (
+        SELECT total FROM orders WHERE status = 'accepted'
+        UNION ALL
+        SELECT total FROM orders_archive WHERE status = 'accepted'
+    ) accepted
+""", read_only=True)
+register_query('stats_lifecycle_24h', """
+    SELECT stage,
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_seconds),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY duration_seconds)
+    FROM order_stage_durations
+    WHERE stage = ANY(%s)
+    AND ended_at >= CURRENT_TIMESTAMP - INTERVAL '24 hours'
+    GROUP BY stage
+""", read_only=True)
+
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Statistikani ko'rsatish"""
-    user = update.effective_user
-    
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True, consistency_key='orders')
         cur = conn.cursor()
         
         today = datetime.now().strftime('%Y-%m-%d')
         
-        cur.execute("SELECT COUNT(*) FROM orders WHERE status IN ('pending', 'pending_payment')")
-        new_count = cur.fetchone()['count']
+        execute_named(cur, 'stats_new_count')
+        new_count = cur.fetchone()[0]
         
-        cur.execute("SELECT COUNT(*), COALESCE(SUM(total), 0) FROM orders WHERE status = 'accepted' AND DATE(accepted_at) = %s", (today,))
+        execute_named(cur, 'stats_today', (today, today))
         today_result = cur.fetchone()
-        today_count = today_result['count']
-        today_sum = today_result['coalesce'] or 0
+        today_count, today_sum = today_result
+        today_sum = today_sum or 0
         
-        cur.execute("SELECT COUNT(*), COALESCE(SUM(total), 0) FROM orders WHERE status = 'accepted'")
+        execute_named(cur, 'stats_total')
         total_result = cur.fetchone()
-        total_count = total_result['count']
-        total_sum = total_result['coalesce'] or 0
+        total_count, total_sum = total_result
+        total_sum = total_sum or 0
+        
+        execute_named(cur, 'stats_lifecycle_24h', (list(ORDER_STAGES),))
+        lifecycle = {stage: (p50, p90) for stage, p50, p90 in cur.fetchall()}
         
         cur.close()
         conn.close()
         
+        lifecycle_text = ""
+        if lifecycle:
+            lifecycle_text = "\n⏱ <b>Kutish vaqti (24 soat, p50 / p90):</b>\n" + "\n".join(
+                f"• {ORDER_STAGE_LABELS[stage]}: {format_duration(p50)} / {format_duration(p90)}"
+                for stage, (p50, p90) in lifecycle.items()
+            ) + "\n"
+        
         stats_text = f"""📊 <b>STATISTIKA</b>
 
 🕐 <b>Bugun ({today}):</b>
@@ -1509,7 +4333,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📈 <b>Jami:</b>
 • Qabul qilingan: {total_count} ta
 • Umumiy summa: {format_price(total_sum)} so'm
-
+{lifecycle_text}
 ⏰ {datetime.now().strftime('%H:%M:%S')}"""
         
         keyboard = [
@@ -1538,8 +4362,830 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(text)
 
+# ==========================================
+# BUYURTMA QIDIRUVI (qisqa raqam, telefon, ism)
+# ==========================================
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = 100
+# /find javobida shuncha natija (har biriga tugma)
+FIND_COMMAND_LIMIT = 10
+SEARCH_KINDS = ('order', 'phone', 'name')
+
+# Yengil proyeksiya - items va boshqa og'ir ustunlarsiz
+SEARCH_COLUMNS = (
+    'id', 'order_id', 'name', 'phone', 'total', 'status', 'payment_status',
+    'created_at', 'delivery_zone', 'change_seq'
+)
+
+# Har bir tur o'z indeksiga tushadi:
+#   order - idx_orders_order_id_reverse: "#ab12cd" suffiksi teskari matnda prefiks bo'ladi
+#   phone - idx_orders_phone_digits: to'liq raqam (=) yoki boshlanishi (LIKE 'x%')
+#   name  - idx_orders_name_trgm (pg_trgm bo'lsa): LIKE '%x%'
+SEARCH_CONDITIONS = {
+    'order': "reverse(lower(order_id)) LIKE %s",
+    'phone': f"{PHONE_DIGITS_SQL} LIKE %s",
+    'name': "lower(name) LIKE %s",
+}
+
+class OrderSearchHit:
+    """Qidiruv natijasi - order_callback uchun id va change_seq ham bor"""
+    
+    __slots__ = SEARCH_COLUMNS
+    
+    def __init__(self, id, order_id, name, phone, total, status, payment_status,
+                 created_at, delivery_zone, change_seq):
+        self.id = id
+        self.order_id = order_id
+        self.name = name
+        self.phone = phone
+        self.total = total
+        self.status = status
+        self.payment_status = payment_status
+        self.created_at = created_at
+        self.delivery_zone = delivery_zone
+        self.change_seq = change_seq
+    
+    @property
+    def short_id(self) -> str:
+        return str(self.order_id or 'N/A')[-6:]
+    
+    def to_dict(self) -> Dict[str, Any]:
+        data = {col: getattr(self, col) for col in SEARCH_COLUMNS}
+        data['created_at'] = self.created_at.isoformat() if self.created_at else None
+        data['short_id'] = self.short_id
+        return data
+
+def _search_sql(kind: str, with_cursor: bool) -> str:
+    cursor_filter = "AND (created_at, id) < (%s::timestamp, %s)" if with_cursor else ""
+    return f"""
+        SELECT {', '.join(SEARCH_COLUMNS)} FROM orders
+        WHERE {SEARCH_CONDITIONS[kind]} {cursor_filter}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """
+
+for _kind in SEARCH_KINDS:
+    register_query(f"search_orders_{_kind}", _search_sql(_kind, False), read_only=True)
+    register_query(f"search_orders_{_kind}_cursor", _search_sql(_kind, True), read_only=True)
+
+def _like_escape(value: str) -> str:
+    return re.sub(r'([\\%_])', r'\\\1', value)
+
+def classify_search(query: str) -> str:
+    """'#ab12cd' -> order; telefon (7+ raqam, "+" yoki bo'shliqli raqamlar) -> phone;
+    raqamli bitta so'z -> order; qolgani -> name"""
+    if query.startswith('#'):
+        return 'order'
+    if re.fullmatch(r'[\d\s()+-]+', query) and (
+            len(normalize_phone_digits(query)) >= 7 or query.startswith('+') or ' ' in query):
+        return 'phone'
+    if any(ch.isdigit() for ch in query) and ' ' not in query:
+        return 'order'
+    return 'name'
+
+def _search_pattern(kind: str, query: str) -> Optional[str]:
+    if kind == 'order':
+        suffix = query.lstrip('#').strip().lower()
+        return _like_escape(suffix[::-1]) + '%' if suffix else None
+    if kind == 'phone':
+        digits = re.sub(r'\D', '', query)
+        # "+998 90 12..." yoki to'liq xalqaro raqam - davlat kodisiz, PHONE_DIGITS_SQL kabi
+        if digits.startswith('998') and (query.lstrip().startswith('+') or len(digits) > 9):
+            digits = digits[3:]
+        return digits[-9:] + '%' if digits else None
+    # Trigram indeksi 3 belgidan boshlab ishlaydi
+    name = query.strip().lower()
+    return '%' + _like_escape(name) + '%' if len(name) >= 3 else None
+
+def search_orders(query: str, kind: Optional[str] = None, cursor: Optional[str] = None,
+                  limit: int = SEARCH_PAGE_SIZE) -> Dict[str, Any]:
+    """Keyset pagination (created_at, id) bo'yicha. ValueError - noto'g'ri so'rov yoki kursor"""
+    query = (query or '').strip()
+    kind = kind or classify_search(query)
+    pattern = _search_pattern(kind, query)
+    if pattern is None:
+        raise ValueError("query too short")
+    
+    name = f"search_orders_{kind}"
+    params = (pattern, limit + 1)
+    if cursor:
+        created_at, order_pk = parse_history_cursor(cursor)
+        name += "_cursor"
+        params = (pattern, created_at, order_pk, limit + 1)
+    
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True, consistency_key='orders')
+        cur = conn.cursor()
+        execute_named(cur, name, params)
+        hits = [OrderSearchHit(*row) for row in cur.fetchall()]
+        cur.close()
+    finally:
+        if conn:
+            conn.close()
+    
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = f"{hits[-1].created_at.isoformat()}|{hits[-1].id}"
+    return {'kind': kind, 'results': hits, 'next_cursor': next_cursor}
+
+async def search_orders_handler(request):
+    """GET /api/orders/search?q=<#suffiks | telefon | ism>&by=order|phone|name&cursor=&limit="""
+    query = request.query.get('q', '')
+    kind = request.query.get('by') or None
+    if kind is not None and kind not in SEARCH_KINDS:
+        return web.json_response({
+            "error": f"by must be one of: {', '.join(SEARCH_KINDS)}"
+        }, status=400, headers=get_cors_headers())
+    try:
+        limit = max(1, min(int(request.query.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE))
+    except ValueError:
+        limit = SEARCH_PAGE_SIZE
+    
+    try:
+        page = await run_blocking(search_orders, query, kind, request.query.get('cursor'), limit)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400, headers=get_cors_headers())
+    except Exception as e:
+        logger.error(f"Order search error: {e}")
+        return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
+    
+    return web.json_response({
+        "kind": page['kind'],
+        "results": [hit.to_dict() for hit in page['results']],
+        "next_cursor": page['next_cursor']
+    }, headers=get_cors_headers())
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <#suffiks | telefon | ism> - admin uchun buyurtma qidirish"""
+    if update.effective_user.id != ADMIN_CHAT_ID_INT:
+        await update.message.reply_text("❌ Siz admin emassiz!")
+        return
+    
+    query = ' '.join(context.args or [])
+    try:
+        page = await run_blocking(search_orders, query, None, None, FIND_COMMAND_LIMIT)
+    except ValueError:
+        await update.message.reply_text(
+            "🔎 Foydalanish: /find <i>#ab12cd</i> | <i>901234567</i> | <i>ism</i>", parse_mode='HTML')
+        return
+    except Exception as e:
+        logger.error(f"❌ /find xatosi: {e}")
+        await update.message.reply_text("❌ Qidiruvda xatolik")
+        return
+    
+    hits = page['results']
+    if not hits:
+        await update.message.reply_text(f"🔎 Hech narsa topilmadi: <b>{html.escape(query)}</b>", parse_mode='HTML')
+        return
+    
+    lines = [f"🔎 <b>{html.escape(query)}</b> - {len(hits)} ta natija:\n"]
+    keyboard = []
+    for hit in hits:
+        created = hit.created_at.strftime('%d.%m %H:%M') if hit.created_at else ''
+        lines.append(f"#{hit.short_id} · {html.escape(hit.name or 'Mijoz')} · {format_phone_display(hit.phone)} · "
+                     f"{format_price(hit.total or 0)} so'm · {hit.status} · {created}")
+        keyboard.append([InlineKeyboardButton(f"📦 #{hit.short_id} - {hit.status}",
+                                              callback_data=order_callback('back_to_order', hit))])
+    if page['next_cursor']:
+        lines.append("\n<i>Yana natijalar bor - so'rovni aniqroq yozing</i>")
+    
+    await update.message.reply_text('\n'.join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+# ==========================================
+# BUYURTMALAR EKSPORTI (CSV / NDJSON oqimi)
+# ==========================================
+
+# Server tomonidagi kursordan bir martada olinadigan qatorlar - xotira eksport hajmiga bog'liq emas
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Bitta eksportdagi eng uzun davr (kun)
+EXPORT_MAX_DAYS = int(os.getenv("EXPORT_MAX_DAYS", "400"))
+# Eksport ulanishi: bitta FETCH va mijoz sekin o'qiganda ochiq tranzaksiya chegarasi (ms).
+# Uzoq ochiq snapshot VACUUM ni ushlab turadi - osilib qolgan eksport server tomonida uziladi
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("EXPORT_STATEMENT_TIMEOUT_MS", "60000"))
+EXPORT_IDLE_TIMEOUT_MS = int(os.getenv("EXPORT_IDLE_TIMEOUT_MS", "120000"))
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+# CSV ustunlari; items "Osh x2; Choy x1" ko'rinishida, to'liq tarkib NDJSON da
+EXPORT_CSV_COLUMNS = (
+    'order_id', 'created_at', 'status', 'payment_status', 'payment_method', 'total',
+    'items', 'name', 'phone', 'source', 'delivery_zone', 'delivery_distance_m',
+    'accepted_at', 'paid_at', 'confirmed_at', 'rejected_at', 'transaction_id',
+    'payme_receipt_id', 'admin_note'
+)
+# Mijoz kiritgan matn Excel da formula bo'lib ochilmasligi uchun
+EXPORT_CSV_TEXT_COLUMNS = ('name', 'admin_note')
+
+export_rows_total = Counter('bodrum_export_rows_total', 'Eksport qilingan buyurtmalar', ('format',))
+
+register_query('export_session_timeouts', """
+    SELECT set_config('statement_timeout', %s, false),
+           set_config('idle_in_transaction_session_timeout', %s, false)
+""", read_only=True)
+register_query('export_orders', f"""
+    SELECT {ORDER_SELECT} FROM orders
+    WHERE created_at >= %s AND created_at < %s
+    ORDER BY created_at, id
+""", read_only=True)
+# Arxivdagi items siqilgan (items_z) yoki olib tashlangan bo'lishi mumkin
+register_query('export_orders_archive', f"""
+    SELECT {ORDER_SELECT}, items_z FROM orders_archive
+    WHERE created_at >= %s AND created_at < %s
+    ORDER BY created_at, id
+""", read_only=True)
+
+_ITEMS_INDEX = ORDER_COLUMNS.index('items')
+
+def _day_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, value.day)
+
+def parse_export_range(date_from: Optional[str], date_to: Optional[str]) -> tuple:
+    """'YYYY-MM-DD' sanalar -> [from, to + 1 kun) oralig'i; to berilmasa - bugun"""
+    if not date_from:
+        raise ValueError("from is required (YYYY-MM-DD)")
+    try:
+        start = datetime.strptime(date_from, '%Y-%m-%d')
+        end = datetime.strptime(date_to, '%Y-%m-%d') if date_to else _day_start(datetime.utcnow())
+    except ValueError:
+        raise ValueError("dates must be YYYY-MM-DD")
+    end += timedelta(days=1)
+    if end <= start:
+        raise ValueError("to must not be before from")
+    if (end - start).days > EXPORT_MAX_DAYS:
+        raise ValueError(f"range must not exceed {EXPORT_MAX_DAYS} days")
+    # detach rejimida sovuq partitsiyalar orders dan ajratilgan - fayl jimgina qisqa chiqmasin
+    if ORDERS_PARTITIONING and ORDERS_ARCHIVE_MODE == 'detach':
+        cutoff = orders_archive_cutoff()
+        if start < cutoff:
+            raise ValueError(f"from must not be before {cutoff:%Y-%m-%d} (older partitions are detached)")
+    return start, end
+
+def _archived_order(row) -> Order:
+    """orders_archive qatori (+ items_z) -> Order; siqilgan items ochiladi"""
+    row, items_z = list(row[:-1]), row[-1]
+    if row[_ITEMS_INDEX] is None and items_z is not None:
+        row[_ITEMS_INDEX] = zlib.decompress(bytes(items_z)).decode('utf-8')
+    return Order(*row)
+
+def _csv_value(order: Order, col: str):
+    if col == 'items':
+        return '; '.join(f"{i.get('name')} x{i.get('qty')}" for i in order.items)
+    value = getattr(order, col)
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(sep=' ', timespec='seconds')
+    if col in EXPORT_CSV_TEXT_COLUMNS and str(value)[:1] in ('=', '+', '-', '@'):
+        return "'" + str(value)
+    return value
+
+class OrderExport:
+    """Bitta eksport: nomlangan (server tomonidagi) kursor va fetchmany partiyalari.
+    Metodlar bloklovchi - handler ularni run_blocking orqali chaqiradi, event loop band bo'lmaydi."""
+    
+    def __init__(self, start: datetime, end: datetime, fmt: str):
+        self.start = start
+        self.end = end
+        self.format = fmt
+        self.rows = 0
+        # Arxivdagi qatorlar eskiroq - avval ular, keyin orders (created_at tartibi saqlanadi)
+        self.sources = ['export_orders_archive', 'export_orders'] if ORDERS_ARCHIVE_MODE == 'archive' else ['export_orders']
+        self.conn = None
+        self.cursor = None
+        self.query_name = None
+        # Mijoz uzilganda close() boshqa thread da ishlayotgan fetch() bilan ustma-ust tushmasligi uchun
+        self._lock = threading.Lock()
+    
+    def open(self):
+        with self._lock:
+            self.conn = get_db_connection(readonly=True)
+            cur = self.conn.cursor()
+            execute_named(cur, 'export_session_timeouts',
+                          (str(EXPORT_STATEMENT_TIMEOUT_MS), str(EXPORT_IDLE_TIMEOUT_MS)))
+            cur.close()
+            self._next_source()
+    
+    def _next_source(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        if not self.sources:
+            return
+        self.query_name = self.sources.pop(0)
+        self.cursor = self.conn.cursor(name=self.query_name)
+        self.cursor.itersize = EXPORT_BATCH_SIZE
+        execute_named(self.cursor, self.query_name, (self.start, self.end))
+    
+    def preamble(self) -> bytes:
+        if self.format == 'csv':
+            # BOM - Excel UTF-8 ni (kirill, o'zbek harflari) to'g'ri ochadi
+            return ('\ufeff' + ','.join(EXPORT_CSV_COLUMNS) + '\r\n').encode('utf-8')
+        return b''
+    
+    def fetch(self) -> Optional[bytes]:
+        """Keyingi partiya tayyor baytlar ko'rinishida; None - eksport tugadi"""
+        with self._lock:
+            while self.cursor is not None:
+                rows = self.cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if rows:
+                    if self.query_name == 'export_orders_archive':
+                        orders = [_archived_order(row) for row in rows]
+                    else:
+                        orders = [Order(*row) for row in rows]
+                    self.rows += len(orders)
+                    export_rows_total.inc(self.format, amount=len(orders))
+                    return self._encode(orders)
+                self._next_source()
+            return None
+    
+    def _encode(self, orders: List[Order]) -> bytes:
+        if self.format == 'ndjson':
+            return ''.join(order.to_json() + '\n' for order in orders).encode('utf-8')
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for order in orders:
+            writer.writerow([_csv_value(order, col) for col in EXPORT_CSV_COLUMNS])
+        return buffer.getvalue().encode('utf-8')
+    
+    def close(self):
+        with self._lock:
+            if self.conn is None:
+                return
+            try:
+                if self.cursor is not None:
+                    self.cursor.close()
+                self.conn.rollback()
+            except Exception as e:
+                logger.warning(f"⚠️ Eksport kursorini yopishda xato: {e}")
+            finally:
+                self.conn.close()
+                self.conn = None
+                self.cursor = None
+
+async def export_orders_handler(request):
+    """GET /api/orders/export?from=YYYY-MM-DD&to=YYYY-MM-DD&format=csv|ndjson (to kuni ham kiradi)"""
+    fmt = request.query.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return web.json_response({
+            "error": f"format must be one of: {', '.join(EXPORT_FORMATS)}"
+        }, status=400, headers=get_cors_headers())
+    try:
+        start, end = parse_export_range(request.query.get('from'), request.query.get('to'))
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400, headers=get_cors_headers())
+    
+    export = OrderExport(start, end, fmt)
+    try:
+        await run_blocking(export.open)
+    except Exception as e:
+        db_executor.submit(export.close)
+        logger.error(f"Order export error: {e}")
+        return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
+    
+    filename = f"orders_{start:%Y-%m-%d}_{end - timedelta(days=1):%Y-%m-%d}.{fmt}"
+    # Sarlavhalar darhol yuboriladi - CORS middleware prepare dan keyin ularni o'zgartira olmaydi
+    response = web.StreamResponse(headers={
+        **get_cors_headers(),
+        'Content-Type': EXPORT_FORMATS[fmt],
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+    })
+    response.enable_chunked_encoding()
+    started = time.perf_counter()
+    try:
+        await response.prepare(request)
+        await response.write(export.preamble())
+        while True:
+            chunk = await run_blocking(export.fetch)
+            if chunk is None:
+                break
+            # write() transport buferi to'lsa kutadi - sekin mijoz DB dan o'qishni ham sekinlashtiradi
+            await response.write(chunk)
+        await response.write_eof()
+        logger.info(f"📤 Eksport: {export.rows} ta buyurtma ({fmt}, {filename}), "
+                    f"{time.perf_counter() - started:.1f} s")
+    except (ConnectionResetError, asyncio.CancelledError):
+        logger.warning(f"⚠️ Eksport uzildi: {export.rows} ta qatordan keyin ({filename})")
+        raise
+    except Exception as e:
+        # Status allaqachon yuborilgan - ulanish uziladi, mijoz to'liq bo'lmagan faylni oladi
+        logger.error(f"❌ Eksport xatosi ({filename}, {export.rows} qator): {e}")
+        raise
+    finally:
+        # Bekor qilingan handler ichida kutmasdan - yopish executor da (fetch tugashini lock kutadi)
+        db_executor.submit(export.close)
+    return response
+
+# ==========================================
+# ADMISSION CONTROL (yuklamani cheklash)
+# ==========================================
+
+# 0 - o'chirilgan: so'rovlar chegarasiz handler ga o'tadi
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+# 503 javobidagi Retry-After (soniya)
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+# HTTP handlerlardagi bloklovchi DB chaqiruvlari shu thread larda - event loop band bo'lmaydi.
+# Navbat pool chegaralari bilan cheklangan (executor ichidagi navbat <= limitlar yig'indisi)
+DB_EXECUTOR_THREADS = int(os.getenv("DB_EXECUTOR_THREADS", "16"))
+
+admission_in_flight = Gauge('bodrum_admission_in_flight', "Pool bo'yicha bajarilayotgan so'rovlar", ('pool',))
+admission_queued = Gauge('bodrum_admission_queued', "Pool navbatida kutayotgan so'rovlar", ('pool',))
+admission_shed_total = Counter(
+    'bodrum_admission_shed_total', "503 bilan rad etilgan so'rovlar", ('pool', 'reason'))
+admission_wait = Histogram('bodrum_admission_wait_seconds', 'Navbatda kutish vaqti', ('pool',))
+
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_THREADS, thread_name_prefix='db')
+
+async def run_blocking(func, *args, **kwargs):
+    """Bloklovchi (psycopg2) chaqiruv db_executor da; contextvars (joriy span) nusxalanadi"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, functools.partial(context.run, func, *args, **kwargs))
+
+class AdmissionPool:
+    """Route guruhi uchun parallel so'rovlar chegarasi va cheklangan kutish navbati.
+    yields_to dagi pool larda navbat bo'lsa, bu pool so'rovlari kutmasdan rad etiladi."""
+    
+    __slots__ = ('name', 'limit', 'queue_max', 'wait_timeout', 'yields_to', 'in_flight', 'waiters')
+    
+    def __init__(self, name: str, limit: int, queue_max: int, wait_timeout: float, yields_to: tuple = ()):
+        self.name = name
+        self.limit = limit
+        self.queue_max = queue_max
+        self.wait_timeout = wait_timeout
+        self.yields_to = yields_to
+        self.in_flight = 0
+        self.waiters: deque = deque()
+    
+    def _report(self):
+        admission_in_flight.set(self.in_flight, self.name)
+        admission_queued.set(len(self.waiters), self.name)
+    
+    async def acquire(self) -> Optional[str]:
+        """None - ruxsat berildi; aks holda rad etish sababi"""
+        if any(ADMISSION_POOLS[name].waiters for name in self.yields_to):
+            return 'priority'
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            self._report()
+            return None
+        if len(self.waiters) >= self.queue_max:
+            return 'queue_full'
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._report()
+        try:
+            await asyncio.wait_for(waiter, self.wait_timeout)
+            return None
+        except asyncio.TimeoutError:
+            return 'timeout'
+        except asyncio.CancelledError:
+            # Mijoz uzildi, lekin slot allaqachon berilgan bo'lsa - qaytarish
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self._report()
+    
+    def release(self):
+        # Slot navbatdagi birinchi kutayotganga to'g'ridan-to'g'ri o'tadi (in_flight o'zgarmaydi)
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._report()
+                return
+        self.in_flight -= 1
+        self._report()
+
+def _admission_pool(name: str, limit: int, queue_max: int, wait_timeout: float, yields_to: tuple = ()):
+    prefix = f"ADMISSION_{name.upper()}"
+    return AdmissionPool(
+        name,
+        int(os.getenv(f"{prefix}_LIMIT", str(limit))),
+        int(os.getenv(f"{prefix}_QUEUE", str(queue_max))),
+        float(os.getenv(f"{prefix}_WAIT", str(wait_timeout))),
+        yields_to
+    )
+
+# Webhook va buyurtma yaratish o'z byudjetiga ega; admin o'qishlari kichik navbat bilan
+# va ular navbatga tusha boshlaganda birinchi bo'lib rad etiladi
+ADMISSION_POOLS = {
+    'webhook': _admission_pool('webhook', 32, 256, 5.0),
+    'orders': _admission_pool('orders', 16, 128, 3.0),
+    'api': _admission_pool('api', 16, 64, 2.0),
+    'admin': _admission_pool('admin', 8, 16, 0.5, yields_to=('webhook', 'orders')),
+    # Eksport uzoq davom etadi - admin slotlarini band qilmaydi, navbatsiz
+    'export': _admission_pool('export', 2, 0, 0.0, yields_to=('webhook', 'orders')),
+}
+
+# (method, route shabloni) -> pool. Ro'yxatda yo'qlar (health, ready, metrics) cheklanmaydi
+ADMISSION_ROUTES = {
+    ('POST', '/webhook'): 'webhook',
+    ('POST', '/api/orders'): 'orders',
+    ('POST', '/payme'): 'orders',
+    ('GET', '/api/orders/{order_id}'): 'api',
+    ('POST', '/api/user/profile'): 'api',
+    ('POST', '/api/user/save-profile'): 'api',
+    ('POST', '/api/user/orders'): 'api',
+    ('GET', '/api/orders'): 'admin',
+    ('GET', '/api/orders/new'): 'admin',
+    ('GET', '/api/orders/search'): 'admin',
+    ('GET', '/api/orders/export'): 'export',
+    ('GET', '/api/stats/lifecycle'): 'admin',
+    ('PUT', '/api/orders/batch'): 'admin',
+    ('PUT', '/api/orders/{order_id}'): 'admin',
+}
+
+def admission_pool_for(request) -> Optional[AdmissionPool]:
+    if not ADMISSION_CONTROL:
+        return None
+    resource = request.match_info.route.resource
+    if resource is None:
+        return None
+    name = ADMISSION_ROUTES.get((request.method, resource.canonical))
+    return ADMISSION_POOLS[name] if name else None
+
+def shed_response(pool: AdmissionPool, reason: str):
+    admission_shed_total.inc(pool.name, reason)
+    return web.json_response({"error": "Server busy, retry later"}, status=503, headers={
+        **get_cors_headers(),
+        'Retry-After': str(ADMISSION_RETRY_AFTER)
+    })
+
+async def stop_db_executor(app):
+    db_executor.shutdown(wait=False, cancel_futures=True)
+
+# ==========================================
+# RATE LIMIT (token bucket)
+# ==========================================
+
+# 0 - o'chirilgan
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") == "1"
+# memory - har bir replika o'zi; postgres - replikalar uchun umumiy bucketlar (xotiradagi tekshiruvdan keyin)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+# Xotirada shuncha bucket saqlanadi, eng eskisi chiqarib tashlanadi (LRU)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+# IP bucket sig'imi = route limiti * shu koeffitsient (NAT ortida ko'p foydalanuvchi)
+RATE_LIMIT_IP_MULTIPLIER = float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "10"))
+# Proksi (Railway) ortida - mijoz IP si X-Forwarded-For ga proksi qo'shgan qiymat.
+# Birinchi qiymatni mijoz o'zi yozishi mumkin, shuning uchun oxiridan HOPS-chi olinadi
+# (HOPS = bizning oldimizdagi ishonchli proksilar soni)
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "1") == "1"
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "1"))
+# Postgres bucketlari shuncha soniya ishlatilmasa o'chiriladi
+RATE_LIMIT_IDLE_SECONDS = int(os.getenv("RATE_LIMIT_IDLE_SECONDS", "3600"))
+
+rate_limited_total = Counter('bodrum_rate_limited_total', "429 bilan rad etilgan so'rovlar", ('limit', 'key'))
+rate_limit_backend_errors = Counter('bodrum_rate_limit_backend_errors_total', 'Umumiy bucket xatolari (fail open)')
+
+class RateLimit:
+    """capacity - burst, rate - soniyasiga qo'shiladigan token"""
+    
+    __slots__ = ('name', 'capacity', 'rate')
+    
+    def __init__(self, name: str, default: str):
+        # RATE_LIMIT_<NAME>="<so'rovlar>/<soniya>", masalan "5/60"
+        spec = os.getenv(f"RATE_LIMIT_{name.upper()}", default)
+        count, _, period = spec.partition('/')
+        self.name = name
+        self.capacity = float(count)
+        self.rate = self.capacity / float(period or 1)
+
+RATE_LIMITS = {
+    'create_order': RateLimit('create_order', '5/60'),
+    'profile': RateLimit('profile', '60/60'),
+    'save_profile': RateLimit('save_profile', '10/60'),
+}
 
+# (method, route shabloni) -> limit. /api/user/orders profil sahifasi bilan bitta bucket da
+RATE_LIMIT_ROUTES = {
+    ('POST', '/api/orders'): 'create_order',
+    ('POST', '/api/user/profile'): 'profile',
+    ('POST', '/api/user/orders'): 'profile',
+    ('POST', '/api/user/save-profile'): 'save_profile',
+}
 
+class RateDecision:
+    """Bir nechta bucket (tgId, IP) ichida eng qattig'i bo'yicha natija"""
+    
+    __slots__ = ('allowed', 'capacity', 'tokens', 'rate')
+    
+    def __init__(self, allowed: bool, capacity: float, tokens: float, rate: float):
+        self.allowed = allowed
+        self.capacity = capacity
+        self.tokens = tokens
+        self.rate = rate
+    
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            'RateLimit-Limit': str(int(self.capacity)),
+            'RateLimit-Remaining': str(max(0, int(self.tokens))),
+            # Bucket to'liq bo'lguncha
+            'RateLimit-Reset': str(math.ceil((self.capacity - self.tokens) / self.rate)),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil((1 - self.tokens) / self.rate)))
+        return headers
+
+class TokenBucketStore:
+    """Xotiradagi bucketlar: key -> (tokens, oxirgi yangilanish). Faqat event loop dan chaqiriladi"""
+    
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.buckets: OrderedDict = OrderedDict()
+    
+    def take(self, key: str, capacity: float, rate: float) -> tuple:
+        """(ruxsat, qolgan tokenlar). Chiqarib tashlangan bucket keyingi safar to'liq boshlanadi"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return allowed, tokens
+
+rate_limit_store = TokenBucketStore(RATE_LIMIT_MAX_KEYS)
+
+METRICS_COLLECTORS.append(lambda: [
+    "# TYPE bodrum_rate_limit_buckets gauge",
+    f"bodrum_rate_limit_buckets {len(rate_limit_store.buckets)}"
+])
+
+# Bitta round trip: barcha kalitlar uchun to'ldirish + token olish (vaqt - DB soati, replikalar uchun bir xil).
+# SET ifodalari eski qator qiymatlarini ko'radi
+register_query('rate_limit_take', """
+    INSERT INTO rate_limit_buckets AS b (key, tokens, capacity, rate, updated_at, allowed)
+    SELECT k, c - 1, c, r, EXTRACT(EPOCH FROM clock_timestamp()), TRUE
+    FROM unnest(%s::text[], %s::float8[], %s::float8[]) AS t(k, c, r)
+    ON CONFLICT (key) DO UPDATE SET
+        allowed = LEAST(EXCLUDED.capacity,
+                        b.tokens + GREATEST(0, EXCLUDED.updated_at - b.updated_at) * EXCLUDED.rate) >= 1,
+        tokens = LEAST(EXCLUDED.capacity,
+                       b.tokens + GREATEST(0, EXCLUDED.updated_at - b.updated_at) * EXCLUDED.rate)
+                 - CASE WHEN LEAST(EXCLUDED.capacity,
+                        b.tokens + GREATEST(0, EXCLUDED.updated_at - b.updated_at) * EXCLUDED.rate) >= 1
+                   THEN 1 ELSE 0 END,
+        capacity = EXCLUDED.capacity,
+        rate = EXCLUDED.rate,
+        updated_at = EXCLUDED.updated_at
+    RETURNING key, allowed, tokens
+""")
+register_query('rate_limit_prune', """
+    DELETE FROM rate_limit_buckets WHERE updated_at < EXTRACT(EPOCH FROM clock_timestamp()) - %s
+""")
+
+def take_shared_tokens(buckets: List[tuple]) -> Dict[str, tuple]:
+    """[(key, capacity, rate), ...] -> key -> (ruxsat, qolgan tokenlar)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        keys, capacities, rates = (list(column) for column in zip(*buckets))
+        execute_named(cur, 'rate_limit_take', (keys, capacities, rates))
+        result = {key: (allowed, tokens) for key, allowed, tokens in cur.fetchall()}
+        conn.commit()
+        cur.close()
+        return result
+    finally:
+        if conn:
+            conn.close()
+
+def prune_rate_limit_buckets() -> int:
+    if RATE_LIMIT_BACKEND != 'postgres':
+        return 0
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'rate_limit_prune', (RATE_LIMIT_IDLE_SECONDS,))
+        count = cur.rowcount
+        conn.commit()
+        cur.close()
+        return count
+    except Exception as e:
+        logger.error(f"❌ Rate limit bucketlarini tozalash xatosi: {e}")
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+def rate_limit_for(request) -> Optional[RateLimit]:
+    if not RATE_LIMIT:
+        return None
+    resource = request.match_info.route.resource
+    if resource is None:
+        return None
+    name = RATE_LIMIT_ROUTES.get((request.method, resource.canonical))
+    return RATE_LIMITS[name] if name else None
+
+def client_ip(request) -> str:
+    if RATE_LIMIT_TRUST_PROXY and RATE_LIMIT_PROXY_HOPS > 0:
+        hops = [h.strip() for h in request.headers.get('X-Forwarded-For', '').split(',') if h.strip()]
+        # Sarlavha qisqa - proksi orqali kelmagan, mijoz yozgan qiymatga ishonmaymiz
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote or 'unknown'
+
+async def request_tg_id(request) -> Optional[int]:
+    """Body dagi tgId - aiohttp body ni keshlaydi, handler uni qayta o'qiy oladi"""
+    try:
+        data = await request.json()
+        tg_id = data.get('tgId') or data.get('tg_id')
+        return int(tg_id) if tg_id else None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+async def check_rate_limit(request, limit: RateLimit) -> RateDecision:
+    """Avval xotiradagi bucketlar (DB siz rad etish), keyin ixtiyoriy umumiy Postgres bucketlari"""
+    buckets = [(f"{limit.name}:ip:{client_ip(request)}", limit.capacity * RATE_LIMIT_IP_MULTIPLIER,
+                limit.rate * RATE_LIMIT_IP_MULTIPLIER)]
+    tg_id = await request_tg_id(request)
+    if tg_id:
+        buckets.append((f"{limit.name}:tg:{tg_id}", limit.capacity, limit.rate))
+    
+    results = {key: rate_limit_store.take(key, capacity, rate) for key, capacity, rate in buckets}
+    if RATE_LIMIT_BACKEND == 'postgres' and all(allowed for allowed, _ in results.values()):
+        try:
+            results = await run_blocking(take_shared_tokens, buckets)
+        except Exception as e:
+            # Umumiy holat ishlamasa - faqat xotiradagi natija (so'rovlar to'xtab qolmaydi)
+            rate_limit_backend_errors.inc()
+            logger.error(f"❌ Rate limit backend xatosi: {e}")
+    
+    # Eng kam token qolgan bucket javob sarlavhalarini belgilaydi
+    decision = None
+    for key, capacity, rate in buckets:
+        allowed, tokens = results[key]
+        if not allowed:
+            rate_limited_total.inc(limit.name, key.split(':')[1])
+        if decision is None or (allowed, tokens / capacity) < (decision.allowed, decision.tokens / decision.capacity):
+            decision = RateDecision(allowed, capacity, tokens, rate)
+    return decision
+
+async def metrics_handler(request):
+    return web.Response(
+        text=render_metrics(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+async def event_loop_lag_monitor():
+    """Event loop kechikishini o'lchash: kutilgan va haqiqiy uyg'onish farqi"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_INTERVAL
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(max(0.0, loop.time() - expected))
+
+async def start_metrics(app):
+    app['event_loop_lag_task'] = asyncio.create_task(event_loop_lag_monitor())
+
+async def stop_metrics(app):
+    task = app.get('event_loop_lag_task')
+    if task:
+        task.cancel()
+
+async def lifecycle_stats_handler(request):
+    """GET /api/stats/lifecycle?bucket=hour|day&days=7&stage=payment,acceptance"""
+    bucket = request.query.get('bucket', 'hour')
+    if bucket not in ('hour', 'day'):
+        return web.json_response({
+            "success": False,
+            "error": "bucket must be 'hour' or 'day'"
+        }, status=400, headers=get_cors_headers())
+    
+    try:
+        days = max(1, min(int(request.query.get('days', '7')), LIFECYCLE_MAX_DAYS))
+    except ValueError:
+        days = 7
+    
+    stages = [s for s in request.query.get('stage', '').split(',') if s in ORDER_STAGES] or None
+    
+    try:
+        result = await run_blocking(get_lifecycle_percentiles, bucket, days, stages)
+        return web.json_response({
+            "success": True,
+            "bucket": bucket,
+            "days": days,
+            "stages": result
+        }, headers=get_cors_headers())
+    except Exception as e:
+        logger.error(f"Lifecycle stats error: {e}")
+        return web.json_response({
+            "success": False,
+            "error": str(e)
+        }, status=500, headers=get_cors_headers())
 
 async def health_handler(request):
     return web.json_response({
@@ -1548,9 +5194,22 @@ async def health_handler(request):
         "timestamp": datetime.utcnow().isoformat(),
         "payme_receipt_parser": "enabled",
         "auto_accept": "enabled",
-        "payme_group_id": PAYME_GROUP_ID_INT
+        "payme_group_id": PAYME_GROUP_ID_INT,
+        "profile_cache": profile_cache.stats(),
+        "ready": startup_state['ready'],
+        "leader": leader_elector.is_leader
     }, headers=get_cors_headers())
 
+async def ready_handler(request):
+    """Readiness: bot ishga tushib bo'lganmi (liveness uchun /health)"""
+    return web.json_response({
+        "ready": startup_state['ready'],
+        "leader": leader_elector.is_leader,
+        "error": startup_state['error'],
+        "attempts": startup_state['attempts'],
+        "phases_ms": startup_state['phases']
+    }, status=200 if startup_state['ready'] else 503, headers=get_cors_headers())
+
 async def create_order_handler(request):
     try:
         data = await request.json()
@@ -1561,24 +5220,24 @@ async def create_order_handler(request):
         if not data.get('phone'):
             data['phone'] = '000000000'
         
-        order = create_order(data)
+        order = await run_blocking(create_order, data)
         
         if order:
-            logger.info(f"✅ Buyurtma yaratildi: {order['order_id']}")
+            logger.info(f"✅ Buyurtma yaratildi: {order.order_id}")
             
             # ⭐⭐⭐ DARHOL ADMINGA XABAR YUBORISH (TO'G'RI FUNKSIYA)
             try:
                 # ASINXRON XABAR YUBORISH - notify_admin_new_order chaqiriladi
                 asyncio.create_task(notify_admin_new_order(order))
-                logger.info(f"📨 Admin ga xabar yuborildi: {order['order_id']}")
+                logger.info(f"📨 Admin ga xabar yuborildi: {order.order_id}")
             except Exception as e:
                 logger.error(f"❌ Admin ga xabar yuborish xatosi: {e}")
             
             # Payme URL ni qaytarish
-            payme_url = f"https://checkout.payme.uz/{os.getenv('PAYME_MERCHANT_ID')}?orderId={order['order_id']}&amount={order['total'] * 100}"
+            payme_url = f"https://checkout.payme.uz/{os.getenv('PAYME_MERCHANT_ID')}?orderId={order.order_id}&amount={order.total * 100}"
             
             return web.json_response({
-                **order,
+                **order.to_dict(),
                 "message": "Buyurtma yaratildi. To'lovni amalga oshiring.",
                 "payme_url": payme_url
             }, status=201, headers=get_cors_headers())
@@ -1591,86 +5250,26 @@ async def create_order_handler(request):
         traceback.print_exc()
         return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
 
-async def notify_admin_new_order(order: Dict):
+async def notify_admin_new_order(order: Order):
     """
     Admin ga YANGI BUYURTMA haqida xabar (to'lov tekshirilmagan)
     """
     try:
-        logger.info(f"🔔 Yangi buyurtma admin ga: {order.get('order_id')}")
+        logger.info(f"🔔 Yangi buyurtma admin ga: {order.order_id}")
 
         if not ADMIN_CHAT_ID_INT:
             logger.error("❌ ADMIN_CHAT_ID o'rnatilmagan!")
             return False
 
-        global application
         if not application or not application.bot:
             logger.error("❌ Bot mavjud emas!")
             return False
         
         bot = application.bot
+        location_coords = order.coords
 
-        # Buyurtma ma'lumotlarini olish
-        items = order.get('items', [])
-        if isinstance(items, str):
-            items = json.loads(items)
-
-        items_text = "\n".join([f"• {i.get('name')} x{i.get('qty')}" for i in items]) if items else "Ma'lumot yo'q"
-
-        raw_phone = order.get('phone', '')
-        phone_display = format_phone_display(raw_phone)
-
-        customer_name = order.get('name', 'Mijoz')
-        if not customer_name or customer_name == 'null':
-            customer_name = 'Mijoz'
-
-        location = order.get('location')
-        location_text = ""
-        location_coords = None
-
-        if location and ',' in str(location):
-            try:
-                lat, lng = str(location).split(',')
-                lat = float(lat.strip())
-                lng = float(lng.strip())
-                location_text = f"\n📍 <b>Joylashuv:</b> <a href='https://maps.google.com/?q={lat},{lng}'>Xaritada ko'rish</a>"
-                location_coords = (lat, lng)
-            except Exception as e:
-                logger.warning(f"Joylashuv parse xatosi: {e}")
-                location_text = f"\n📍 <b>Manzil:</b> {location}"
-        elif location:
-            location_text = f"\n📍 <b>Manzil:</b> {location}"
-
-        source = order.get('source', 'website')
-        source_icon = "🤖 WebApp" if source == 'webapp' else "🌐 Sayt"
-
-        # ⭐ YANGI: To'lov kutilmoqda statusi
-        status_text = "⏳ <b>YANGI BUYURTMA - TO'LOV KUTILMOQDA!</b>"
-
-        admin_message = f"""{status_text}
-
-🆔 Buyurtma: #{order.get('order_id', 'N/A')[-6:]}
-👤 Mijoz: {customer_name}
-📞 Telefon: {phone_display}
-💵 Summa: {format_price(order.get('total', 0))} so'm
-📱 Manba: {source_icon}{location_text}
-
-🍽 Mahsulotlar:
-{items_text}
-
-⏰ {datetime.now().strftime('%H:%M:%S')}
-
-<i>⚡ To'lovni tekshiring, keyin qabul qiling yoki bekor qiling</i>"""
-
-        # ⭐⭐⭐ 3 TA TUGMA: Qabul, Bekor, To'lovni tekshirish
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ QABUL QILISH", callback_data=f"accept_{order.get('order_id')}"),
-                InlineKeyboardButton("❌ BEKOR QILISH", callback_data=f"reject_{order.get('order_id')}")
-            ],
-            [
-                InlineKeyboardButton("💳 TO'LOVNI TEKSHIRISH", callback_data=f"open_payme_group_{order.get('order_id')}")
-            ]
-        ])
+        # ⭐⭐⭐ 3 TA TUGMA: Qabul, Bekor, To'lovni tekshirish (render_admin_order_card)
+        admin_message, keyboard = render_admin_order_card(order)
 
         admin_sent = await bot.send_message(
             chat_id=ADMIN_CHAT_ID_INT,
@@ -1679,6 +5278,11 @@ async def notify_admin_new_order(order: Dict):
             parse_mode='HTML'
         )
 
+        # Keyingi status o'zgarishlari shu xabarni tahrirlaydi
+        if admin_sent:
+            await asyncio.get_running_loop().run_in_executor(
+                None, save_order_message, order.id, 'admin', ADMIN_CHAT_ID_INT, admin_sent.message_id)
+
         if location_coords and admin_sent:
             try:
                 await bot.send_location(
@@ -1689,7 +5293,7 @@ async def notify_admin_new_order(order: Dict):
             except Exception as e:
                 logger.error(f"❌ Joylashuv yuborish xatosi: {e}")
 
-        logger.info(f"✅ Admin ga xabar yuborildi: {order.get('order_id')}")
+        logger.info(f"✅ Admin ga xabar yuborildi: {order.order_id}")
         return True
 
     except Exception as e:
@@ -1701,85 +5305,165 @@ async def notify_admin_new_order(order: Dict):
 async def get_order_handler(request):
     try:
         order_id = request.match_info['order_id']
-        order = get_order(order_id)
+        order = await run_blocking(get_order, order_id)
         
         if not order:
             return web.json_response({"error": "Not found"}, status=404, headers=get_cors_headers())
         
-        return web.json_response(order, headers=get_cors_headers())
+        # ⭐ ETag - qatorning change_seq i; o'zgarmagan buyurtma qayta kodlanmaydi
+        etag = make_etag('o', order.change_seq)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        
+        cache_key = f"order:{order.order_id.lower()}"
+        body = get_cached_response(cache_key, order.change_seq)
+        if body is None:
+            body = order.to_json().encode('utf-8')
+            store_cached_response(cache_key, order.change_seq, body)
+        
+        return encoded_json_response(body, etag)
     except Exception as e:
         logger.error(f"API get order error: {e}")
         return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
 
-async def orders_list_handler(request):
-    """Barcha buyurtmalarni olish - BARCHA STATUSLAR"""
+register_query('orders_list', f"""
+    SELECT {ORDER_SELECT} FROM orders 
+    WHERE status <> 'expired'
+    {orders_hot_bound()}
+    ORDER BY 
+        CASE 
+            WHEN status = 'pending_payment' THEN 1
+            WHEN status = 'pending' THEN 2
+            WHEN status = 'accepted' THEN 3
+            WHEN status = 'confirmed' THEN 4
+            WHEN status = 'rejected' THEN 5
+            ELSE 6
+        END,
+        created_at DESC 
+    LIMIT 200
+""", read_only=True)
+
+register_query('orders_version', "SELECT version FROM orders_version WHERE id = 1", read_only=True)
+
+def _list_version(version: int):
+    """Partitsiyada issiq oyna chegarasi ham versiyaga kiradi (ORDERS_HOT_ETAG_SECONDS qadami)"""
+    if not ORDERS_PARTITIONING:
+        return version
+    return f"{version}.{int(time.time()) // ORDERS_HOT_ETAG_SECONDS}"
+
+def fetch_orders_version():
+    """orders_version - ro'yxat ETag i (bitta qator)"""
+    conn = None
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True, consistency_key='orders')
+        cur = conn.cursor()
+        execute_named(cur, 'orders_version')
+        version = cur.fetchone()[0]
+        cur.close()
+        return _list_version(version)
+    finally:
+        if conn:
+            conn.close()
+
+def fetch_hot_orders(query_name: str) -> tuple:
+    """orders_list / orders_new - replikadan (bo'lsa), partitsiyada issiq oyna. (version, orders):
+    versiya ro'yxatdan oldin o'qiladi - javob hech qachon o'z ETag idan eski bo'lmaydi"""
+    conn = None
+    try:
+        conn = get_db_connection(readonly=True, consistency_key='orders')
         cur = conn.cursor()
+        execute_named(cur, 'orders_version')
+        version = _list_version(cur.fetchone()[0])
+        execute_named(cur, query_name)
+        orders = [Order(*row) for row in cur.fetchall()]
+        cur.close()
+        return version, orders
+    finally:
+        if conn:
+            conn.close()
+
+async def orders_list_handler(request):
+    """Barcha buyurtmalarni olish - BARCHA STATUSLAR (?since=<change_seq> - faqat o'zgarishlar)"""
+    try:
+        if 'since' in request.query:
+            return await orders_delta_handler(request)
+        
+        # ⭐ Hech narsa o'zgarmagan bo'lsa - 304, faqat bitta yengil so'rov
+        version = await run_blocking(fetch_orders_version)
+        etag = make_etag('list', version)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        
+        body = get_cached_response('list', version)
+        if body is not None:
+            return encoded_json_response(body, etag)
         
         # ⭐⭐⭐ BARCHA STATUSLARNI OLIB QAYTARISH (filtr olib tashlandi)
-        cur.execute("""
-            SELECT * FROM orders 
-            ORDER BY 
-                CASE 
-                    WHEN status = 'pending_payment' THEN 1
-                    WHEN status = 'pending' THEN 2
-                    WHEN status = 'accepted' THEN 3
-                    WHEN status = 'confirmed' THEN 4
-                    WHEN status = 'rejected' THEN 5
-                    ELSE 6
-                END,
-                created_at DESC 
-            LIMIT 200
-        """)
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        orders = []
-        for row in results:
-            order_dict = dict(row)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            orders.append(order_dict)
+        version, orders = await run_blocking(fetch_hot_orders, 'orders_list')
+        etag = make_etag('list', version)
         
-        return web.json_response(orders, headers=get_cors_headers())
+        body = orders_to_json(orders)
+        store_cached_response('list', version, body)
+        return encoded_json_response(body, etag)
         
     except Exception as e:
         logger.error(f"Orders list error: {e}")
         return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
 
+async def orders_delta_handler(request):
+    """Delta sync: GET /api/orders?since=<cursor>&limit=<n>"""
+    try:
+        since = int(request.query.get('since') or 0)
+        limit = min(int(request.query.get('limit', 500)), DELTA_MAX_LIMIT)
+    except ValueError:
+        return web.json_response({"error": "since va limit butun son bo'lishi kerak"}, status=400, headers=get_cors_headers())
+    
+    if since < 0 or limit <= 0:
+        return web.json_response({"error": "since >= 0 va limit > 0 bo'lishi kerak"}, status=400, headers=get_cors_headers())
+    
+    try:
+        delta = await run_blocking(get_orders_since, since, limit)
+        changes = orders_to_json(delta.pop('changes')).decode('utf-8')
+        # changes ni qayta kodlamaslik uchun tayyor JSON matniga qo'shamiz
+        body = f'{{"changes": {changes}, {json.dumps(delta)[1:]}'
+        return web.Response(body=body.encode('utf-8'), content_type='application/json', headers=get_cors_headers())
+    except Exception as e:
+        logger.error(f"Orders delta error: {e}")
+        return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
+
+register_query('orders_new', f"""
+    SELECT {ORDER_SELECT} FROM orders 
+    WHERE status IN ('pending', 'pending_payment', 'payment_pending') 
+    {orders_hot_bound()}
+    ORDER BY created_at DESC
+""", read_only=True)
+
 async def new_orders_handler(request):
     """Yangi buyurtmalarni olish"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT * FROM orders 
-            WHERE status IN ('pending', 'pending_payment', 'payment_pending') 
-            ORDER BY created_at DESC
-        """)
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
+        version = await run_blocking(fetch_orders_version)
+        etag = make_etag('new', version)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
         
-        orders = []
-        for row in results:
-            order_dict = dict(row)
-            for key in ['created_at', 'accepted_at', 'rejected_at', 'paid_at', 'confirmed_at']:
-                if order_dict.get(key) and hasattr(order_dict[key], 'isoformat'):
-                    order_dict[key] = order_dict[key].isoformat()
-            orders.append(order_dict)
+        body = get_cached_response('new', version)
+        if body is not None:
+            return encoded_json_response(body, etag)
+        
+        version, orders = await run_blocking(fetch_hot_orders, 'orders_new')
+        etag = make_etag('new', version)
         
-        return web.json_response(orders, headers=get_cors_headers())
+        body = orders_to_json(orders)
+        store_cached_response('new', version, body)
+        return encoded_json_response(body, etag)
         
     except Exception as e:
         logger.error(f"New orders error: {e}")
         return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
 
 async def update_order_handler(request):
-    """Buyurtma yangilash"""
+    """Buyurtma yangilash: status ORDER_TRANSITIONS bo'yicha (transition_order),
+    paymentStatus / adminNote - oddiy ustunlar"""
     try:
         order_id = request.match_info['order_id']
         data = await request.json()
@@ -1787,23 +5471,114 @@ async def update_order_handler(request):
         status = data.get('status')
         payment_status = data.get('paymentStatus')
         admin_note = data.get('adminNote')
+        # Ixtiyoriy: mijoz ko'rgan change_seq - boshqa o'zgarish bo'lsa 409
+        expected_version = data.get('version')
+        try:
+            expected_version = int(expected_version) if expected_version is not None else None
+        except (ValueError, TypeError):
+            return web.json_response({"error": "version must be an integer"}, status=400, headers=get_cors_headers())
         
-        updated = update_order_status(
-            order_id, 
-            status, 
-            payment_status=payment_status,
-            admin_note=admin_note
-        )
-        
-        if updated:
-            return web.json_response(updated, headers=get_cors_headers())
-        else:
-            return web.json_response({"error": "Order not found"}, status=404, headers=get_cors_headers())
+        if status is not None and status not in ORDER_TRANSITIONS:
+            return web.json_response({
+                "error": f"status must be one of: {', '.join(ORDER_TRANSITIONS)}"
+            }, status=422, headers=get_cors_headers())
+        if not status and payment_status is None and admin_note is None:
+            return web.json_response({"error": "Nothing to update"}, status=400, headers=get_cors_headers())
+        
+        updated = None
+        changed = False
+        if status:
+            result = await run_blocking(transition_order, order_id, status,
+                                        admin_note=admin_note, expected_version=expected_version)
+            if result is None:
+                return web.json_response({"error": "Status update failed"}, status=500, headers=get_cors_headers())
+            if result.outcome == TransitionResult.NOT_FOUND:
+                return web.json_response({"error": "Order not found"}, status=404, headers=get_cors_headers())
+            if result.outcome == TransitionResult.STALE:
+                return web.json_response({
+                    "error": "Order was modified by someone else",
+                    "order": result.order.to_dict()
+                }, status=409, headers=get_cors_headers())
+            if result.outcome == TransitionResult.ILLEGAL:
+                return web.json_response({
+                    "error": f"Cannot change status from {result.order.status} to {status}",
+                    "order": result.order.to_dict()
+                }, status=422, headers=get_cors_headers())
+            updated = result.order
+            changed = result.applied
+            # adminNote o'tish bilan birga yozildi; keyingi yangilash shu holatga bog'lanadi
+            admin_note = None
+            expected_version = updated.change_seq
+        
+        if payment_status is not None or admin_note is not None:
+            updated = await run_blocking(
+                update_order_fields,
+                order_id,
+                expected_version=expected_version,
+                payment_status=payment_status,
+                admin_note=admin_note
+            )
+            if updated is None:
+                current = await run_blocking(get_order, order_id) if expected_version is not None else None
+                if current:
+                    return web.json_response({
+                        "error": "Order was modified by someone else",
+                        "order": current.to_dict()
+                    }, status=409, headers=get_cors_headers())
+                return web.json_response({"error": "Order not found"}, status=404, headers=get_cors_headers())
+            changed = True
+        
+        if changed:
+            # Admin kartasi va mijoz xabari joyida tahrirlanadi (eski tugmalar qolmasin)
+            queue_order_refresh(updated)
+        return web.json_response(updated.to_dict(), headers=get_cors_headers())
             
     except Exception as e:
         logger.error(f"Update order error: {e}")
         return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
 
+# Ommaviy amal: bitta so'rovda shuncha buyurtmagacha
+BATCH_STATUSES = ('accepted', 'rejected', 'confirmed')
+BATCH_MAX_ORDERS = int(os.getenv("BATCH_MAX_ORDERS", "100"))
+
+async def batch_update_orders_handler(request):
+    """PUT /api/orders/batch {"orderIds": [...], "status": "accepted", "prepTime"?, "adminNote"?}"""
+    try:
+        data = await request.json()
+        order_ids = data.get('orderIds')
+        status = data.get('status')
+        prep_time = data.get('prepTime')
+        
+        if status not in BATCH_STATUSES:
+            return web.json_response({
+                "error": f"status must be one of: {', '.join(BATCH_STATUSES)}"
+            }, status=400, headers=get_cors_headers())
+        if not isinstance(order_ids, list) or not order_ids or not all(isinstance(i, str) and i for i in order_ids):
+            return web.json_response({"error": "orderIds must be a non-empty list"}, status=400, headers=get_cors_headers())
+        
+        order_ids = list(dict.fromkeys(order_ids))
+        if len(order_ids) > BATCH_MAX_ORDERS:
+            return web.json_response({
+                "error": f"At most {BATCH_MAX_ORDERS} orders per request"
+            }, status=400, headers=get_cors_headers())
+        
+        admin_note = data.get('adminNote') or (f"{PREP_TIME_NOTE}{prep_time}" if prep_time else None)
+        updated = await run_blocking(update_orders_batch, order_ids, status, admin_note)
+        if updated is None:
+            return web.json_response({"error": "Batch update failed"}, status=500, headers=get_cors_headers())
+        
+        notified = refresh_order_messages(updated)
+        done = {order.order_id for order in updated}
+        return web.json_response({
+            "updated": [order.to_dict() for order in updated],
+            "skipped": [order_id for order_id in order_ids if order_id not in done],
+            "notified": notified
+        }, headers=get_cors_headers())
+        
+    except Exception as e:
+        logger.error(f"Batch update order error: {e}")
+        return web.json_response({"error": str(e)}, status=500, headers=get_cors_headers())
+
 async def save_user_profile_api(request):
     """Foydalanuvchi profilini saqlash"""
     try:
@@ -1835,16 +5610,13 @@ async def save_user_profile_api(request):
                 "error": "Valid phone required (9 digits)"
             }, status=400, headers=get_cors_headers())
         
-        success = save_user_profile(tg_id, name, phone, username)
+        result = await run_blocking(save_profile_with_history, tg_id, name, phone, username,
+                                    normalize_page_size(data.get('limit')))
         
-        if success:
-            profile = get_user_profile(tg_id)
-            orders = get_user_orders(tg_id)
-            
+        if result:
             return web.json_response({
                 "success": True,
-                "profile": profile,
-                "orders": orders
+                **result
             }, headers=get_cors_headers())
         else:
             return web.json_response({
@@ -1884,15 +5656,13 @@ async def get_user_profile_api(request):
                 "error": "Invalid tgId format"
             }, status=400, headers=get_cors_headers())
         
-        profile = get_user_profile(tg_id)
-        orders = get_user_orders(tg_id)
+        result = await run_blocking(load_profile_with_history, tg_id, normalize_page_size(data.get('limit')))
         
-        print(f"✅ API: Profil: {profile is not None}, Buyurtmalar: {len(orders)}")
+        print(f"✅ API: Profil: {result['profile'] is not None}, Buyurtmalar: {len(result['orders'])}")
         
         return web.json_response({
             "success": True,
-            "profile": profile,
-            "orders": orders
+            **result
         }, headers=get_cors_headers())
         
     except Exception as e:
@@ -1904,9 +5674,500 @@ async def get_user_profile_api(request):
             "error": str(e)
         }, status=500, headers=get_cors_headers())
 
+async def get_user_orders_api(request):
+    """Buyurtmalar tarixining keyingi sahifasi: {tgId, cursor, limit}"""
+    try:
+        data = await request.json()
+        
+        try:
+            tg_id = int(data.get('tgId'))
+        except (ValueError, TypeError):
+            return web.json_response({
+                "success": False,
+                "error": "Invalid tgId format"
+            }, status=400, headers=get_cors_headers())
+        
+        cursor = data.get('cursor')
+        if cursor:
+            try:
+                parse_history_cursor(cursor)
+            except (ValueError, AttributeError):
+                return web.json_response({
+                    "success": False,
+                    "error": "Invalid cursor"
+                }, status=400, headers=get_cors_headers())
+        
+        page = await run_blocking(get_user_orders_page, tg_id, cursor, normalize_page_size(data.get('limit')))
+        
+        return web.json_response({
+            "success": True,
+            **page
+        }, headers=get_cors_headers())
+        
+    except Exception as e:
+        logger.error(f"Get user orders API error: {e}")
+        return web.json_response({
+            "success": False,
+            "error": str(e)
+        }, status=500, headers=get_cors_headers())
+
+# ==========================================
+# PAYME MERCHANT API (JSON-RPC)
+# ==========================================
+
+# Kassa kaliti (Basic auth paroli, login "Paycom"). Vergul bilan bir nechta - masalan test va prod
+PAYME_MERCHANT_KEYS = [key.strip() for key in os.getenv('PAYME_MERCHANT_KEY', '').split(',') if key.strip()]
+# Kassa sozlamalaridagi hisob maydoni nomi (params.account.<field> = order_id)
+PAYME_ACCOUNT_FIELD = os.getenv('PAYME_ACCOUNT_FIELD', 'order_id')
+# Yaratilgan, lekin bajarilmagan tranzaksiya shuncha ms dan keyin bekor qilinadi (Payme: 12 soat)
+PAYME_TIMEOUT_MS = int(os.getenv('PAYME_TIMEOUT_MS', str(12 * 3600 * 1000)))
+
+PAYME_LOGIN = 'Paycom'
+
+# Tranzaksiya holatlari va bekor qilish sababi (Payme spetsifikatsiyasi)
+PAYME_STATE_CREATED = 1
+PAYME_STATE_PERFORMED = 2
+PAYME_STATE_CANCELLED = -1
+PAYME_STATE_CANCELLED_AFTER_PERFORM = -2
+PAYME_REASON_TIMEOUT = 4
+
+# Bu statusdagi buyurtmaga to'lov qabul qilinmaydi
+PAYME_CLOSED_STATUSES = ('rejected', 'expired')
+
+PAYME_ERRORS = {
+    -32700: ("JSON xato", "Ошибка разбора JSON", "Parse error"),
+    -32600: ("Noto'g'ri so'rov", "Неверный запрос", "Invalid request"),
+    -32601: ("Metod topilmadi", "Метод не найден", "Method not found"),
+    -32504: ("Ruxsat yo'q", "Недостаточно привилегий", "Insufficient privileges"),
+    -32400: ("Tizim xatosi", "Системная ошибка", "System error"),
+    -31001: ("Noto'g'ri summa", "Неверная сумма", "Invalid amount"),
+    -31003: ("Tranzaksiya topilmadi", "Транзакция не найдена", "Transaction not found"),
+    -31007: ("Buyurtma bajarilgan, bekor qilib bo'lmaydi", "Заказ выполнен, отмена невозможна",
+             "Order completed, cannot cancel"),
+    -31008: ("Amalni bajarib bo'lmaydi", "Невозможно выполнить операцию", "Unable to perform operation"),
+    -31050: ("Buyurtma topilmadi", "Заказ не найден", "Order not found"),
+    -31051: ("Buyurtmani to'lab bo'lmaydi", "Заказ нельзя оплатить", "Order is not payable"),
+    -31052: ("Buyurtma boshqa tranzaksiyada to'lanmoqda", "Заказ оплачивается другой транзакцией",
+             "Order is being paid by another transaction"),
+}
+
+payme_requests_total = Counter(
+    'bodrum_payme_requests_total', 'Payme Merchant API chaqiruvlari', ('method', 'result'))
+
+class PaymeError(Exception):
+    """JSON-RPC xato javobi; data - xato tegishli maydon (masalan account maydoni)"""
+    
+    def __init__(self, code: int, data: Optional[str] = None):
+        super().__init__(code)
+        self.code = code
+        self.data = data
+    
+    def to_dict(self) -> Dict[str, Any]:
+        uz, ru, en = PAYME_ERRORS[self.code]
+        error = {'code': self.code, 'message': {'uz': uz, 'ru': ru, 'en': en}}
+        if self.data:
+            error['data'] = self.data
+        return error
+
+PAYME_TX_COLUMNS = (
+    'id', 'payme_id', 'order_id', 'order_pk', 'order_created_at', 'amount', 'state', 'reason',
+    'payme_time', 'create_time', 'perform_time', 'cancel_time'
+)
+PAYME_TX_SELECT = ', '.join(PAYME_TX_COLUMNS)
+
+class PaymeTransaction:
+    """payme_transactions jadvalidagi bitta qator"""
+    
+    __slots__ = PAYME_TX_COLUMNS
+    
+    def __init__(self, id, payme_id, order_id, order_pk, order_created_at, amount, state, reason,
+                 payme_time, create_time, perform_time, cancel_time):
+        self.id = id
+        self.payme_id = payme_id
+        self.order_id = order_id
+        self.order_pk = order_pk
+        self.order_created_at = order_created_at
+        self.amount = amount
+        self.state = state
+        self.reason = reason
+        self.payme_time = payme_time
+        self.create_time = create_time
+        self.perform_time = perform_time
+        self.cancel_time = cancel_time
+    
+    @property
+    def timed_out(self) -> bool:
+        return self.state == PAYME_STATE_CREATED and payme_now() - self.create_time > PAYME_TIMEOUT_MS
+    
+    def to_statement(self) -> Dict[str, Any]:
+        return {
+            'id': self.payme_id,
+            'time': self.payme_time,
+            'amount': self.amount,
+            'account': {PAYME_ACCOUNT_FIELD: self.order_id},
+            'create_time': self.create_time,
+            'perform_time': self.perform_time,
+            'cancel_time': self.cancel_time,
+            'transaction': str(self.id),
+            'state': self.state,
+            'reason': self.reason
+        }
+
+def payme_now() -> int:
+    return int(time.time() * 1000)
+
+def payme_authorized(request) -> bool:
+    """Authorization: Basic base64("Paycom:<kalit>")"""
+    header = request.headers.get('Authorization', '')
+    if not PAYME_MERCHANT_KEYS or not header.startswith('Basic '):
+        return False
+    try:
+        login, _, password = base64.b64decode(header[6:].strip()).decode('utf-8').partition(':')
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return login == PAYME_LOGIN and any(
+        hmac.compare_digest(password.encode(), key.encode()) for key in PAYME_MERCHANT_KEYS)
+
+def _payme_param(params: Dict[str, Any], name: str, kind):
+    value = params.get(name)
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise PaymeError(-32600, name)
+    return value
+
+register_query('payme_tx_get', f"SELECT {PAYME_TX_SELECT} FROM payme_transactions WHERE payme_id = %s")
+# Qayta kelgan CreateTransaction (xuddi shu id) yangi qator yaratmaydi
+register_query('payme_tx_create', f"""
+    INSERT INTO payme_transactions (payme_id, order_id, order_pk, order_created_at, amount, payme_time, create_time)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (payme_id) DO NOTHING
+    RETURNING {PAYME_TX_SELECT}
+""")
+register_query('payme_tx_perform', f"""
+    UPDATE payme_transactions SET state = 2, perform_time = %s
+    WHERE payme_id = %s AND state = 1
+    RETURNING {PAYME_TX_SELECT}
+""")
+register_query('payme_tx_cancel', f"""
+    UPDATE payme_transactions
+    SET state = CASE WHEN state = 1 THEN -1 ELSE -2 END, reason = %s, cancel_time = %s
+    WHERE payme_id = %s AND state IN (1, 2)
+    RETURNING {PAYME_TX_SELECT}
+""")
+register_query('payme_tx_statement', f"""
+    SELECT {PAYME_TX_SELECT} FROM payme_transactions
+    WHERE payme_time BETWEEN %s AND %s
+    ORDER BY payme_time
+""")
+# Buyurtma qatori PK + created_at bo'yicha - aynan bitta partitsiya
+register_query('payme_order_lock', """
+    SELECT status FROM orders WHERE id = %s AND created_at = %s FOR UPDATE
+""")
+register_query('payme_order_paid', f"""
+    UPDATE orders SET
+        payment_status = 'paid', paid_at = %s, transaction_id = %s,
+        status = CASE WHEN status = ANY(%s) THEN 'pending' ELSE status END
+    WHERE id = %s AND created_at = %s AND status <> ALL(%s)
+    RETURNING {ORDER_SELECT}
+""")
+register_query('payme_order_refunded', f"""
+    UPDATE orders SET
+        payment_status = 'refunded',
+        rejected_at = CASE WHEN status = ANY(%s) THEN %s ELSE rejected_at END,
+        status = CASE WHEN status = ANY(%s) THEN 'rejected' ELSE status END
+    WHERE id = %s AND created_at = %s
+    RETURNING {ORDER_SELECT}
+""")
+
+def get_payme_transaction(payme_id: str) -> Optional[PaymeTransaction]:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'payme_tx_get', (payme_id,))
+        row = cur.fetchone()
+        cur.close()
+        return PaymeTransaction(*row) if row else None
+    finally:
+        if conn:
+            conn.close()
+
+# Payme account dagi ID aynan shunday solishtiriladi (ILIKE da '%'/'_' boshqa buyurtmaga tushadi)
+register_query('payme_order_get', f"SELECT {ORDER_SELECT} FROM orders WHERE order_id = %s", read_only=True)
+register_query('payme_order_get_bounded', f"""
+    SELECT {ORDER_SELECT} FROM orders
+    WHERE order_id = %s AND created_at BETWEEN %s AND %s
+""", read_only=True)
+
+def get_payme_order(order_id: str) -> Optional[Order]:
+    """get_order dan farqi: aniq moslik, DB xatosi yutilmaydi (-32400 bo'lib qaytadi)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        row = None
+        bounds = order_created_bounds(order_id)
+        if bounds:
+            execute_named(cur, 'payme_order_get_bounded', (order_id,) + bounds)
+            row = cur.fetchone()
+        if row is None:
+            execute_named(cur, 'payme_order_get', (order_id,))
+            row = cur.fetchone()
+        cur.close()
+        return Order(*row) if row else None
+    finally:
+        if conn:
+            conn.close()
+
+def _payme_order_changed(order: Order):
+    """Commit dan keyin - boshqa status o'zgarishlari bilan bir xil"""
+    note_order_seq(order)
+    note_write('orders', f"user:{order.tg_id}")
+    record_stage_durations(order.id, order.created_at)
+
+def payme_payable_order(params: Dict[str, Any]) -> Order:
+    """CheckPerformTransaction / CreateTransaction tekshiruvlari"""
+    amount = _payme_param(params, 'amount', (int, float))
+    account = params.get('account')
+    order_id = account.get(PAYME_ACCOUNT_FIELD) if isinstance(account, dict) else None
+    if not order_id:
+        raise PaymeError(-31050, PAYME_ACCOUNT_FIELD)
+    
+    order = get_payme_order(str(order_id))
+    if not order:
+        raise PaymeError(-31050, PAYME_ACCOUNT_FIELD)
+    if order.payment_status == 'paid' or order.status in PAYME_CLOSED_STATUSES:
+        raise PaymeError(-31051, PAYME_ACCOUNT_FIELD)
+    # Payme summasi tiyinda
+    if amount != (order.total or 0) * 100:
+        raise PaymeError(-31001, 'amount')
+    return order
+
+def payme_check_perform(params: Dict[str, Any]):
+    payme_payable_order(params)
+    return {'allow': True}, None
+
+def _payme_cancel(payme_id: str, reason: int) -> tuple:
+    """Tranzaksiyani bekor qilish; bajarilgan bo'lsa buyurtma 'refunded' (bitta DB tranzaksiya)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'payme_tx_get', (payme_id,))
+        row = cur.fetchone()
+        if not row:
+            raise PaymeError(-31003)
+        tx = PaymeTransaction(*row)
+        if tx.state not in (PAYME_STATE_CREATED, PAYME_STATE_PERFORMED):
+            return tx, None
+        
+        if tx.state == PAYME_STATE_PERFORMED:
+            execute_named(cur, 'payme_order_lock', (tx.order_pk, tx.order_created_at))
+            locked = cur.fetchone()
+            if locked and locked[0] == 'confirmed':
+                raise PaymeError(-31007)
+        
+        execute_named(cur, 'payme_tx_cancel', (reason, payme_now(), payme_id))
+        row = cur.fetchone()
+        if not row:
+            # Parallel Perform/Cancel o'zgartirib ulgurdi - Payme qayta so'raydi
+            raise PaymeError(-31008)
+        tx = PaymeTransaction(*row)
+        
+        order = None
+        if tx.state == PAYME_STATE_CANCELLED_AFTER_PERFORM:
+            refundable = list(ORDER_TRANSITIONS['rejected'])
+            execute_named(cur, 'payme_order_refunded', (
+                refundable, datetime.utcnow(), refundable, tx.order_pk, tx.order_created_at))
+            row = cur.fetchone()
+            order = Order(*row) if row else None
+        conn.commit()
+        cur.close()
+        
+        if order:
+            _payme_order_changed(order)
+        logger.info(f"💳 Payme tranzaksiya bekor qilindi: {payme_id} ({tx.order_id}), state={tx.state}")
+        return tx, order
+    except Exception:
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def payme_create_transaction(params: Dict[str, Any]):
+    payme_id = _payme_param(params, 'id', str)
+    payme_time = int(_payme_param(params, 'time', (int, float)))
+    
+    tx = get_payme_transaction(payme_id)
+    if tx is None:
+        order = payme_payable_order(params)
+        conn = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            execute_named(cur, 'payme_tx_create', (
+                payme_id, order.order_id, order.id, order.created_at,
+                int(params['amount']), payme_time, payme_now()))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+        except psycopg2.IntegrityError:
+            # idx_payme_transactions_active_order - buyurtmada boshqa faol tranzaksiya bor
+            if conn:
+                conn.rollback()
+            raise PaymeError(-31052, PAYME_ACCOUNT_FIELD)
+        finally:
+            if conn:
+                conn.close()
+        # row yo'q - xuddi shu id parallel so'rovda yaratildi
+        tx = PaymeTransaction(*row) if row else get_payme_transaction(payme_id)
+        if row:
+            logger.info(f"💳 Payme tranzaksiya yaratildi: {payme_id} ({order.order_id})")
+    
+    if tx.state != PAYME_STATE_CREATED:
+        raise PaymeError(-31008)
+    if tx.timed_out:
+        _payme_cancel(payme_id, PAYME_REASON_TIMEOUT)
+        raise PaymeError(-31008)
+    return {'create_time': tx.create_time, 'transaction': str(tx.id), 'state': tx.state}, None
+
+def payme_perform_transaction(params: Dict[str, Any]):
+    payme_id = _payme_param(params, 'id', str)
+    tx = get_payme_transaction(payme_id)
+    if tx is None:
+        raise PaymeError(-31003)
+    if tx.timed_out:
+        _payme_cancel(payme_id, PAYME_REASON_TIMEOUT)
+        raise PaymeError(-31008)
+    
+    order = None
+    if tx.state == PAYME_STATE_CREATED:
+        conn = None
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            execute_named(cur, 'payme_tx_perform', (payme_now(), payme_id))
+            row = cur.fetchone()
+            if row:
+                tx = PaymeTransaction(*row)
+                # Tranzaksiya holati va buyurtma "to'landi" - bitta commit
+                execute_named(cur, 'payme_order_paid', (
+                    datetime.utcnow(), payme_id, list(ORDER_TRANSITIONS['pending']),
+                    tx.order_pk, tx.order_created_at, list(PAYME_CLOSED_STATUSES)))
+                order_row = cur.fetchone()
+                if not order_row:
+                    # Buyurtma shu orada bekor qilindi yoki muddati o'tdi - pul yechilmaydi
+                    conn.rollback()
+                    raise PaymeError(-31008)
+                order = Order(*order_row)
+                conn.commit()
+            cur.close()
+        except Exception:
+            if conn:
+                conn.rollback()
+            raise
+        finally:
+            if conn:
+                conn.close()
+        if order:
+            _payme_order_changed(order)
+            logger.info(f"✅ Payme to'lov bajarildi: {order.order_id}, {tx.amount // 100} so'm")
+        else:
+            # Parallel PerformTransaction - joriy holat qaytariladi
+            tx = get_payme_transaction(payme_id)
+    
+    if tx.state != PAYME_STATE_PERFORMED:
+        raise PaymeError(-31008)
+    return {'transaction': str(tx.id), 'perform_time': tx.perform_time, 'state': tx.state}, order
+
+def payme_cancel_transaction(params: Dict[str, Any]):
+    payme_id = _payme_param(params, 'id', str)
+    reason = _payme_param(params, 'reason', int)
+    tx, order = _payme_cancel(payme_id, reason)
+    return {'transaction': str(tx.id), 'cancel_time': tx.cancel_time, 'state': tx.state}, order
+
+def payme_check_transaction(params: Dict[str, Any]):
+    tx = get_payme_transaction(_payme_param(params, 'id', str))
+    if tx is None:
+        raise PaymeError(-31003)
+    return {
+        'create_time': tx.create_time,
+        'perform_time': tx.perform_time,
+        'cancel_time': tx.cancel_time,
+        'transaction': str(tx.id),
+        'state': tx.state,
+        'reason': tx.reason
+    }, None
+
+def payme_get_statement(params: Dict[str, Any]):
+    period = (_payme_param(params, 'from', int), _payme_param(params, 'to', int))
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        execute_named(cur, 'payme_tx_statement', period)
+        transactions = [PaymeTransaction(*row).to_statement() for row in cur.fetchall()]
+        cur.close()
+        return {'transactions': transactions}, None
+    finally:
+        if conn:
+            conn.close()
+
+PAYME_METHODS = {
+    'CheckPerformTransaction': payme_check_perform,
+    'CreateTransaction': payme_create_transaction,
+    'PerformTransaction': payme_perform_transaction,
+    'CancelTransaction': payme_cancel_transaction,
+    'CheckTransaction': payme_check_transaction,
+    'GetStatement': payme_get_statement,
+}
+
+async def payme_handler(request):
+    """POST /payme - Payme Merchant API. Xatolar ham HTTP 200 bilan (JSON-RPC)"""
+    request_id = None
+    method = None
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            raise PaymeError(-32700)
+        if not isinstance(data, dict):
+            raise PaymeError(-32600)
+        request_id = data.get('id')
+        
+        if not payme_authorized(request):
+            raise PaymeError(-32504)
+        
+        method = data.get('method')
+        params = data.get('params')
+        if method not in PAYME_METHODS:
+            raise PaymeError(-32601, str(method))
+        if not isinstance(params, dict):
+            raise PaymeError(-32600, 'params')
+        
+        with span(f"payme.{method}"):
+            result, order = await run_blocking(PAYME_METHODS[method], params)
+    except PaymeError as e:
+        payme_requests_total.inc(method if method in PAYME_METHODS else 'unknown', str(e.code))
+        return web.json_response({'jsonrpc': '2.0', 'id': request_id, 'error': e.to_dict()})
+    except Exception as e:
+        logger.error(f"❌ Payme {method} xatosi: {e}")
+        payme_requests_total.inc(method, str(-32400))
+        return web.json_response({'jsonrpc': '2.0', 'id': request_id, 'error': PaymeError(-32400).to_dict()})
+    
+    payme_requests_total.inc(method, 'ok')
+    # Admin kartasi "TO'LOV QILINDI" / "BEKOR QILINDI" holatiga tahrirlanadi
+    if order:
+        queue_order_refresh(order)
+    return web.json_response({'jsonrpc': '2.0', 'id': request_id, 'result': result})
+
 # webhook_handler ga log qo'shing
 async def webhook_handler(request):
-    global application
+    
+    # Bot hali ishga tushmagan - Telegram update ni keyinroq qayta yuboradi
+    if not startup_state['ready']:
+        return web.Response(status=503, text='Starting', headers={'Retry-After': '1'})
     
     if application:
         try:
@@ -1917,32 +6178,134 @@ async def webhook_handler(request):
                 logger.info(f"👆 Callback query keldi: {data['callback_query']['data']}")
             
             update = Update.de_json(data, application.bot)
-            await application.process_update(update)
+            webhook_in_flight.inc()
+            try:
+                with span('bot.process_update', update_id=update.update_id,
+                          kind='callback_query' if update.callback_query else 'message'):
+                    await application.process_update(update)
+            finally:
+                webhook_in_flight.dec()
         except Exception as e:
             logger.error(f"Webhook processing error: {e}")
     
     return web.Response(text='OK')
 
-async def init_webhook(app):
-    global application
-    
-    if not TOKEN:
-        logger.error("❌ TOKEN o'rnatilmagan!")
-        return
-    
-    # Database ni initsializatsiya qilish
-    if not init_database():
-        logger.error("❌ Database initialization failed!")
+async def expire_orders_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: muddati o'tgan buyurtmalar va admin jarayonlari"""
+    loop = asyncio.get_running_loop()
+    expired = await loop.run_in_executor(None, expire_stale_orders)
+    # Admin alertlari "muddati o'tdi" holatiga (tugmalarsiz) tahrirlanadi
+    refresh_order_messages(expired)
+    await loop.run_in_executor(None, expire_admin_flows)
+    await loop.run_in_executor(None, prune_order_messages)
+    await loop.run_in_executor(None, prune_rate_limit_buckets)
+
+async def partition_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: oylik partitsiyalar va arxivlash (faqat lider)"""
+    await asyncio.get_running_loop().run_in_executor(None, maintain_order_partitions)
+
+async def lifecycle_backfill_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: lifecycle bosqichlarini tarixdan to'ldirish (watermark dan davom etadi)"""
+    await asyncio.get_running_loop().run_in_executor(None, backfill_stage_durations)
+
+# Faqat liderda ishlaydigan JobQueue vazifalari (liderlik yo'qolsa olib tashlanadi)
+leader_jobs = []
+
+def schedule_leader_jobs():
+    if not application or not application.job_queue or leader_jobs:
         return
-    
+    # ⌛ Muddati o'tgan buyurtmalar (ORDER_EXPIRE_HOURS > 0 bo'lsa) va eskirgan yordamchi qatorlar
+    leader_jobs.append(application.job_queue.run_repeating(expire_orders_job, interval=600, first=60))
+    leader_jobs.append(application.job_queue.run_repeating(lifecycle_backfill_job, interval=60, first=15))
+    # 📆 Keyingi oylar partitsiyalari va sovuq tarix arxivi - kuniga bir marta
+    if ORDERS_PARTITIONING:
+        leader_jobs.append(application.job_queue.run_repeating(partition_maintenance_job, interval=86400, first=300))
+
+def unschedule_leader_jobs():
+    for job in leader_jobs:
+        job.schedule_removal()
+    leader_jobs.clear()
+
+async def setup_webhook():
     webhook_url = os.getenv("WEBHOOK_URL", "")
     if not webhook_url:
         railway_domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "")
         if railway_domain:
             webhook_url = f"https://{railway_domain}"
     
+    if webhook_url:
+        full_webhook_url = f"{webhook_url}/webhook"
+        # ⭐ MUHIM: Callback query updates ni olish uchun allowed_updates
+        allowed_updates = ['message', 'callback_query', 'inline_query', 'edited_message']
+        try:
+            # Har redeployda qayta o'rnatmaslik - URL va update turlari mos bo'lsa o'tkazib yuborish
+            info = await application.bot.get_webhook_info()
+            if info.url == full_webhook_url and set(info.allowed_updates or ()) == set(allowed_updates):
+                logger.info(f"⏭️ Webhook allaqachon o'rnatilgan: {full_webhook_url}")
+                return
+            
+            await application.bot.set_webhook(url=full_webhook_url, allowed_updates=allowed_updates)
+            logger.info(f"✅ Webhook o'rnatildi: {full_webhook_url}")
+            logger.info("✅ Allowed updates: message, callback_query, inline_query, edited_message")
+        except Exception as e:
+            logger.error(f"❌ Webhook xato: {e}")
+
+# Lider migratsiyasi (init_database) muvaffaqiyatli bo'lganmi - startup qayta urinishida tekshiriladi
+schema_ready = False
+
+async def on_leader_elected():
+    """Singleton vazifalar: migratsiya, set_webhook, davriy joblar"""
+    global schema_ready
+    schema_ready = await asyncio.get_running_loop().run_in_executor(None, init_database)
+    if not schema_ready:
+        logger.error("❌ Database initialization failed!")
+    # Startup da bot hali yaratilmagan bo'ladi - init_webhook o'zi davom ettiradi
+    if application and application.running:
+        await setup_webhook()
+        schedule_leader_jobs()
+
+async def on_leader_demoted():
+    unschedule_leader_jobs()
+
+leader_elector = LeaderElector(LEADER_LOCK_KEY, on_elected=on_leader_elected, on_demoted=on_leader_demoted)
+
+# Startup xatosida qayta urinish: 2, 4, 8 ... (STARTUP_RETRY_MAX_DELAY gacha) soniyadan keyin.
+# STARTUP_MAX_ATTEMPTS dan keyin jarayon to'xtaydi - platforma (Docker/Railway) qayta ishga tushiradi
+STARTUP_MAX_ATTEMPTS = int(os.getenv("STARTUP_MAX_ATTEMPTS", "6"))
+STARTUP_RETRY_MAX_DELAY = float(os.getenv("STARTUP_RETRY_MAX_DELAY", "60"))
+
+# Startup holati: /ready va webhook shu bo'yicha javob beradi
+startup_state = {
+    'ready': False,
+    'error': None,
+    'attempts': 0,
+    'failed': False,
+    # faza -> davomiylik (ms)
+    'phases': {}
+}
+
+async def timed_phase(name: str, coro):
+    """Startup fazasini o'lchash va startup_state ga yozish"""
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        startup_state['phases'][name] = elapsed_ms
+        logger.info(f"⏱ Startup fazasi {name}: {elapsed_ms} ms")
+
+def build_application():
+    """Bot application va handlerlar (tarmoqsiz, tez)"""
+    global application
+    
     # Bot application yaratish
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .build()
+    )
     
     # ==========================================
     # HANDLERLAR TARTIBI - MUHIM!
@@ -1950,7 +6313,8 @@ async def init_webhook(app):
     
     # 1. COMMAND HANDLERS (avval)
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("stats", stats_command))    
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("find", find_command))
     
     # 2. MESSAGE HANDLERS
     # Contact handler
@@ -1968,44 +6332,88 @@ async def init_webhook(app):
     
     # 3. CALLBACK QUERY HANDLER (oxirida)
     application.add_handler(CallbackQueryHandler(callback_handler))
+
+async def startup_sequence():
+    """Mustaqil fazalar parallel: lider saylovi (+ migratsiya) va getMe bir vaqtda,
+    keyin application start, so'ng (lider) webhook va joblar.
+    Xato bo'lsa backoff bilan qayta urinadi; oxirgi urinishdan keyin jarayonni to'xtatadi."""
+    started = time.perf_counter()
+    for attempt in range(1, STARTUP_MAX_ATTEMPTS + 1):
+        startup_state['attempts'] = attempt
+        try:
+            await _startup_attempt()
+            startup_state['error'] = None
+            break
+        except Exception as e:
+            startup_state['error'] = str(e)
+            logger.error(f"❌ Startup xatosi ({attempt}/{STARTUP_MAX_ATTEMPTS}): {e}")
+            if attempt == STARTUP_MAX_ATTEMPTS:
+                logger.critical("💀 Startup muvaffaqiyatsiz - jarayon to'xtatiladi, platforma qayta ishga tushiradi")
+                startup_state['failed'] = True
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            await asyncio.sleep(min(2 ** attempt, STARTUP_RETRY_MAX_DELAY))
     
-    # ==========================================
-    # BOT NI ISHGA TUSHIRISH
-    # ==========================================
+    startup_state['phases']['total'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"🤖 Bot ishga tushdi! ({startup_state['phases']['total']} ms)")
+    logger.info("⚡ Admin tugmalari: Qabul, Bekor, To'lovni tekshirish")
+    logger.info("📦 Yangi buyurtmalar tugmasi ishga tushdi")
+
+async def _startup_attempt():
+    """Bitta urinish - qayta chaqirilsa tugagan fazalar takrorlanmaydi"""
+    global schema_ready
+    if application is None:
+        build_application()
     
-    await application.initialize()
-    await application.start()
+    await asyncio.gather(
+        timed_phase('leader_election', leader_elector.start()),
+        timed_phase('bot_initialize', application.bot.initialize())
+    )
+    # Oldingi urinishda lider migratsiyasi muvaffaqiyatsiz bo'lgan bo'lsa - qayta
+    if leader_elector.is_leader and not schema_ready:
+        schema_ready = await asyncio.get_running_loop().run_in_executor(None, init_database)
+        if not schema_ready:
+            raise RuntimeError("Database initialization failed")
+    
+    # Handlerlar (admin_flows, order_messages) jadvallarni ishlatadi - lider migratsiyasidan keyin
+    if not application.running:
+        await timed_phase('application_start', _start_application())
+    startup_state['ready'] = True
     
     # ==========================================
-    # WEBHOOK O'RNATISH
+    # WEBHOOK O'RNATISH VA DAVRIY JOBLAR (faqat lider)
     # ==========================================
     
-    if webhook_url:
-        full_webhook_url = f"{webhook_url}/webhook"
-        try:
-            # ⭐ MUHIM: Callback query updates ni olish uchun allowed_updates
-            await application.bot.set_webhook(
-                url=full_webhook_url,
-                allowed_updates=['message', 'callback_query', 'inline_query', 'edited_message']
-            )
-            logger.info(f"✅ Webhook o'rnatildi: {full_webhook_url}")
-            logger.info(f"✅ Allowed updates: message, callback_query, inline_query, edited_message")
-        except Exception as e:
-            logger.error(f"❌ Webhook xato: {e}")
+    if leader_elector.is_leader:
+        await timed_phase('set_webhook', setup_webhook())
+        schedule_leader_jobs()
+    else:
+        logger.info("👥 Follower replika: webhook va joblar lider zimmasida")
+
+async def _start_application():
+    await application.initialize()
+    await application.start()
+
+async def init_webhook(app):
+    """HTTP qatlamini bloklamaydi: port darhol ochiladi, bot fonda ishga tushadi"""
+    if not TOKEN:
+        logger.error("❌ TOKEN o'rnatilmagan!")
+        return
     
-    logger.info(f"🤖 Bot ishga tushdi!")
-    logger.info(f"⚡ Admin tugmalari: Qabul, Bekor, To'lovni tekshirish")
-    logger.info(f"📦 Yangi buyurtmalar tugmasi ishga tushdi")
+    app['startup_task'] = asyncio.create_task(startup_sequence())
 
 async def shutdown(app):
-    global application
-    if application:
+    task = app.get('startup_task')
+    if task and not task.done():
+        task.cancel()
+    if application and application.running:
         try:
             await application.stop()
             await application.shutdown()
             logger.info("🛑 Bot to'xtatildi")
         except Exception as e:
             logger.error(f"Shutdown xato: {e}")
+    await leader_elector.stop()
 
 def main():
     logger.info("🔧 Bodrum Bot starting...")
@@ -2026,7 +6434,7 @@ def main():
                     headers={
                         'Access-Control-Allow-Origin': '*',
                         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Requested-With, Cache-Control, Pragma, Accept',
+                        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Requested-With, Cache-Control, Pragma, Accept, If-None-Match',
                         'Access-Control-Max-Age': '86400',
                     }
                 )
@@ -2034,40 +6442,124 @@ def main():
             response = await handler(request)
             response.headers['Access-Control-Allow-Origin'] = '*'
             response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Cache-Control, Pragma, Accept'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Cache-Control, Pragma, Accept, If-None-Match'
             
             return response
         
         return middleware_handler
     
+    # Metrika middleware - route shabloni bo'yicha (order_id lar label ga tushmaydi)
+    async def metrics_middleware(app, handler):
+        async def middleware_handler(request):
+            started = time.perf_counter()
+            status = 500
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'unmatched'
+            root_span = start_trace(f"{request.method} {route}", request.headers.get('traceparent'),
+                                    route=route, method=request.method)
+            try:
+                with root_span:
+                    response = await handler(request)
+                    status = response.status
+                    root_span.set('http.status_code', status)
+                    return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                http_request_duration.observe(
+                    time.perf_counter() - started, route, request.method, status)
+        
+        return middleware_handler
+    
+    # Admission control - route guruhi bo'yicha parallellik chegarasi, navbat to'lsa tez 503.
+    # CORS dan keyin: OPTIONS cheklanmaydi, 503 javobi ham CORS sarlavhalari bilan
+    async def admission_middleware(app, handler):
+        async def middleware_handler(request):
+            pool = admission_pool_for(request)
+            if pool is None:
+                return await handler(request)
+            started = time.perf_counter()
+            reason = await pool.acquire()
+            admission_wait.observe(time.perf_counter() - started, pool.name)
+            if reason:
+                return shed_response(pool, reason)
+            try:
+                return await handler(request)
+            finally:
+                pool.release()
+        
+        return middleware_handler
+    
+    # Token bucket (tgId + IP) - admission dan oldin: suiiste'mol qiluvchi so'rov slot va DB ni band qilmaydi
+    async def rate_limit_middleware(app, handler):
+        async def middleware_handler(request):
+            limit = rate_limit_for(request)
+            if limit is None:
+                return await handler(request)
+            decision = await check_rate_limit(request, limit)
+            if not decision.allowed:
+                return web.json_response({"error": "Too many requests"}, status=429, headers={
+                    **get_cors_headers(),
+                    **decision.headers()
+                })
+            response = await handler(request)
+            response.headers.update(decision.headers())
+            return response
+        
+        return middleware_handler
+    
+    app.middlewares.append(metrics_middleware)
     app.middlewares.append(cors_middleware)
+    app.middlewares.append(rate_limit_middleware)
+    app.middlewares.append(admission_middleware)
     
     # Routes
     app.router.add_get('/', health_handler)
     app.router.add_get('/health', health_handler)
+    app.router.add_get('/ready', ready_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/api/stats/lifecycle', lifecycle_stats_handler)
     
     # API routes
     app.router.add_get('/api/orders', orders_list_handler)
     app.router.add_get('/api/orders/new', new_orders_handler)
+    app.router.add_get('/api/orders/search', search_orders_handler)
+    app.router.add_get('/api/orders/export', export_orders_handler)
     app.router.add_post('/api/orders', create_order_handler)
     app.router.add_get('/api/orders/{order_id}', get_order_handler)
+    app.router.add_put('/api/orders/batch', batch_update_orders_handler)
     app.router.add_put('/api/orders/{order_id}', update_order_handler)
     
     # User profile API
     app.router.add_post('/api/user/profile', get_user_profile_api)
     app.router.add_post('/api/user/save-profile', save_user_profile_api)
+    app.router.add_post('/api/user/orders', get_user_orders_api)
+    
+    # Payme Merchant API
+    app.router.add_post('/payme', payme_handler)
     
     # Webhook
     app.router.add_post('/webhook', webhook_handler)
     
+    app.on_startup.append(start_metrics)
+    app.on_startup.append(start_tracing)
+    app.on_startup.append(start_notifications)
     app.on_startup.append(init_webhook)
+    app.on_cleanup.append(stop_metrics)
+    app.on_cleanup.append(stop_tracing)
+    app.on_cleanup.append(stop_notifications)
+    app.on_cleanup.append(stop_db_executor)
     app.on_cleanup.append(shutdown)
     
     logger.info(f"🚀 Server ishga tushmoqda: 0.0.0.0:{PORT}")
-    logger.info(f"💳 Payme chek parser: Faol")
-    logger.info(f"⚡ Auto accept: Faol")
+    logger.info("💳 Payme chek parser: Faol")
+    logger.info("⚡ Auto accept: Faol")
     
     web.run_app(app, host='0.0.0.0', port=PORT)
+    # Nol bo'lmagan kod - restart siyosati (on-failure) jarayonni qayta ko'taradi
+    if startup_state['failed']:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,104 @@
+"""
+Soxta Telegram Bot API serveri - benchmark va lokal sinovlar uchun.
+
+Ishga tushirish:
+    python benchmarks/fake_telegram.py --port 8081 --latency-ms 40
+
+Keyin app.py ni TELEGRAM_API_URL=http://127.0.0.1:8081 bilan ishga tushiring.
+Har bir metod haqiqiy API ga o'xshash 'ok' javob qaytaradi, kechikish
+--latency-ms bilan beriladi. /stats - metodlar bo'yicha chaqiruvlar soni.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Bodrum Bench",
+    "username": "bodrum_bench_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False
+}
+
+
+def make_app(latency_ms: float = 0.0) -> web.Application:
+    calls = Counter()
+    message_ids = itertools.count(1)
+    webhook = {"url": "", "allowed_updates": []}
+
+    def message_result(payload):
+        chat_id = payload.get("chat_id", 0)
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": payload.get("text", "")
+        }
+
+    async def read_payload(request):
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def method_handler(request):
+        method = request.match_info["method"]
+        calls[method] += 1
+        payload = await read_payload(request)
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "sendLocation", "editMessageText", "editMessageReplyMarkup"):
+            result = message_result(payload)
+        elif method == "setWebhook":
+            webhook["url"] = payload.get("url", "")
+            allowed_updates = payload.get("allowed_updates", [])
+            # form-data da ro'yxat JSON matn sifatida keladi
+            if isinstance(allowed_updates, str):
+                allowed_updates = json.loads(allowed_updates)
+            webhook["allowed_updates"] = allowed_updates
+            result = True
+        elif method == "getWebhookInfo":
+            result = {
+                "url": webhook["url"],
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+                "allowed_updates": webhook["allowed_updates"]
+            }
+        else:
+            # answerCallbackQuery, deleteWebhook, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats_handler(request):
+        return web.json_response(dict(calls))
+
+    app = web.Application()
+    app.router.add_get("/stats", stats_handler)
+    app.router.add_route("*", "/bot{token}/{method}", method_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soxta Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    web.run_app(make_app(args.latency_ms), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
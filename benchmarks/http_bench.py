@@ -0,0 +1,367 @@
+"""
+aiohttp API uchun end-to-end HTTP yuklama benchmarki.
+
+app.py ni alohida jarayonda lokal Postgres ga ulab ishga tushiradi, Telegram
+o'rniga benchmarks/fake_telegram.py serverini qo'yadi va real aralashmadagi
+so'rovlarni (POST /api/orders, GET /api/orders, GET /api/orders/{id},
+POST /api/user/profile) berilgan parallellikda yuboradi. Natija - throughput
+va p50/p95/p99 kechikishlar - JSON faylga yoziladi.
+
+Misol:
+    createdb bodrum_bench
+    python benchmarks/http_bench.py \\
+        --database-url postgresql://localhost/bodrum_bench \\
+        --concurrency 8,32,64 --duration 30 --mix lunch --reset \\
+        --output bench_results.json
+
+DIQQAT: --reset orders va users jadvallarini TRUNCATE qiladi - faqat
+benchmark uchun alohida bazada ishlating.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_telegram import make_app as make_fake_telegram  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Operatsiya -> og'irlik. "lunch" - tushlik payti: ko'p buyurtma va admin so'rovlari
+MIXES = {
+    "lunch": {
+        "create_order": 20,
+        "list_orders": 10,
+        "poll_orders": 25,
+        "get_order": 25,
+        "profile": 20
+    },
+    "read_heavy": {
+        "create_order": 5,
+        "list_orders": 20,
+        "poll_orders": 35,
+        "get_order": 25,
+        "profile": 15
+    },
+    "write_heavy": {
+        "create_order": 60,
+        "list_orders": 5,
+        "poll_orders": 10,
+        "get_order": 15,
+        "profile": 10
+    }
+}
+
+MENU = [
+    {"id": 1, "name": "Osh", "price": 45000},
+    {"id": 2, "name": "Lag'mon", "price": 38000},
+    {"id": 3, "name": "Shashlik", "price": 22000},
+    {"id": 4, "name": "Somsa", "price": 9000},
+    {"id": 5, "name": "Choy", "price": 5000},
+    {"id": 6, "name": "Salat", "price": 18000}
+]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile (ms)"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return round(sorted_values[rank - 1], 3)
+
+
+def summarize(latencies, duration):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "throughput_rps": round(len(values) / duration, 2) if duration else None,
+        "latency_ms": {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "mean": round(sum(values) / len(values), 3) if values else None,
+            "max": round(values[-1], 3) if values else None
+        }
+    }
+
+
+class Workload:
+    """Operatsiyalar va ular orasidagi umumiy holat (yaratilgan buyurtmalar, ETag)"""
+
+    def __init__(self, base_url, users):
+        self.base_url = base_url
+        self.users = users
+        self.order_ids = []
+        self.list_etag = None
+
+    def random_order_payload(self):
+        items = []
+        for dish in random.sample(MENU, random.randint(1, 4)):
+            items.append({**dish, "qty": random.randint(1, 3)})
+        tg_id = random.choice(self.users)
+        return {
+            "orderId": f"ORD_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}",
+            "name": f"Bench {tg_id}",
+            "phone": f"90{tg_id % 10000000:07d}",
+            "items": items,
+            "total": sum(i["price"] * i["qty"] for i in items),
+            "location": f"{41.28 + random.random() / 20:.6f},{69.20 + random.random() / 20:.6f}",
+            "tgId": tg_id,
+            "source": "webapp"
+        }
+
+    async def create_order(self, session):
+        async with session.post(f"{self.base_url}/api/orders", json=self.random_order_payload()) as resp:
+            body = await resp.json()
+            if resp.status == 201:
+                self.order_ids.append(body["order_id"])
+            return resp.status
+
+    async def list_orders(self, session):
+        async with session.get(f"{self.base_url}/api/orders") as resp:
+            await resp.read()
+            if resp.status == 200:
+                self.list_etag = resp.headers.get("ETag")
+            return resp.status
+
+    async def poll_orders(self, session):
+        # Admin panel so'rovi: oxirgi ETag bilan shartli GET
+        headers = {"If-None-Match": self.list_etag} if self.list_etag else {}
+        async with session.get(f"{self.base_url}/api/orders", headers=headers) as resp:
+            await resp.read()
+            if resp.status == 200:
+                self.list_etag = resp.headers.get("ETag")
+            return resp.status
+
+    async def get_order(self, session):
+        if not self.order_ids:
+            return await self.create_order(session)
+        order_id = random.choice(self.order_ids[-500:])
+        async with session.get(f"{self.base_url}/api/orders/{order_id}") as resp:
+            await resp.read()
+            return resp.status
+
+    async def profile(self, session):
+        async with session.post(f"{self.base_url}/api/user/profile",
+                                json={"tgId": random.choice(self.users)}) as resp:
+            await resp.read()
+            return resp.status
+
+
+async def run_level(workload, mix, concurrency, duration, warmup):
+    """Bitta parallellik darajasi: warmup, keyin o'lchov"""
+    ops = list(mix.keys())
+    weights = list(mix.values())
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    errors = defaultdict(int)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        warmup_end = time.perf_counter() + warmup
+        measure_end = warmup_end + duration
+
+        async def worker():
+            while True:
+                now = time.perf_counter()
+                if now >= measure_end:
+                    return
+                op = random.choices(ops, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status = await getattr(workload, op)(session)
+                except Exception as e:
+                    status = None
+                    if started >= warmup_end:
+                        errors[f"{op}: {type(e).__name__}"] += 1
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if started < warmup_end:
+                    continue
+                statuses[op][str(status)] += 1
+                # 429/503 - rate limit yoki admission control rad etdi, muvaffaqiyat emas
+                if status is not None and status < 500 and status != 429:
+                    latencies[op].append(elapsed_ms)
+                else:
+                    errors[op] += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    result = {
+        "concurrency": concurrency,
+        "duration_s": duration,
+        **summarize(all_latencies, duration),
+        "errors": sum(v for k, v in errors.items() if ':' not in k),
+        "error_details": dict(errors),
+        "ops": {}
+    }
+    for op in ops:
+        result["ops"][op] = {
+            **summarize(latencies[op], duration),
+            "statuses": dict(statuses[op])
+        }
+    return result
+
+
+async def wait_for_health(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"app.py to'xtadi (exit code {process.returncode})")
+            try:
+                async with session.get(f"{base_url}/health") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError("app.py /health javob bermadi")
+
+
+def reset_database(database_url):
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('orders'), to_regclass('users')")
+        orders_table, users_table = cur.fetchone()
+        tables = [t for t in (orders_table, users_table) if t]
+        if tables:
+            cur.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def start_app(args):
+    env = {
+        **os.environ,
+        "PORT": str(args.app_port),
+        # .env dagi qiymatlar ustidan yozish uchun aniq beramiz (load_dotenv override qilmaydi)
+        "DATABASE_PUBLIC_URL": args.database_url,
+        "TOKEN": args.token,
+        "ADMIN_CHAT_ID": str(args.admin_chat_id),
+        "PAYME_RECEIPTS_GROUP_ID": "",
+        "WEBHOOK_URL": "",
+        "RAILWAY_PUBLIC_DOMAIN": "",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+        # Bir IP dan yuklama - rate limit va admission control o'lchovni buzmasin
+        "RATE_LIMIT": "0",
+        "ADMISSION_CONTROL": "0"
+    }
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")],
+                            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def main_async(args):
+    if args.reset:
+        reset_database(args.database_url)
+
+    fake_runner = web.AppRunner(make_fake_telegram(args.telegram_latency_ms))
+    await fake_runner.setup()
+    await web.TCPSite(fake_runner, "127.0.0.1", args.telegram_port).start()
+
+    process = start_app(args)
+    base_url = f"http://127.0.0.1:{args.app_port}"
+    try:
+        await wait_for_health(base_url, process)
+
+        users = [9_000_000 + i for i in range(args.users)]
+        workload = Workload(base_url, users)
+
+        # Profillarni oldindan yaratish (profile so'rovlari bo'sh bo'lmasligi uchun)
+        async with aiohttp.ClientSession() as session:
+            for tg_id in users:
+                async with session.post(f"{base_url}/api/user/save-profile", json={
+                    "tgId": tg_id, "name": f"Bench {tg_id}", "phone": f"90{tg_id % 10000000:07d}"
+                }) as resp:
+                    await resp.read()
+
+        runs = []
+        for concurrency in args.concurrency:
+            result = await run_level(workload, MIXES[args.mix], concurrency, args.duration, args.warmup)
+            runs.append(result)
+            lat = result["latency_ms"]
+            print(f"c={concurrency:<4} rps={result['throughput_rps']:<9} "
+                  f"p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms errors={result['errors']}")
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{args.telegram_port}/stats") as resp:
+                telegram_calls = await resp.json()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await fake_runner.cleanup()
+
+    report = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "mix": args.mix,
+            "weights": MIXES[args.mix],
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "users": args.users,
+            "telegram_latency_ms": args.telegram_latency_ms,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git_rev": git_revision()
+        },
+        "runs": runs,
+        "telegram_calls": telegram_calls
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Natija: {args.output}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bodrum API HTTP benchmark")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="Benchmark uchun alohida Postgres bazasi (BENCH_DATABASE_URL)")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="lunch")
+    parser.add_argument("--concurrency", default="8,32",
+                        type=lambda v: [int(x) for x in v.split(",") if x.strip()])
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--app-port", type=int, default=3900)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--telegram-latency-ms", type=float, default=40.0)
+    parser.add_argument("--token", default="123456:BENCH-TOKEN")
+    parser.add_argument("--admin-chat-id", type=int, default=111111)
+    parser.add_argument("--reset", action="store_true", help="orders va users ni TRUNCATE qilish")
+    parser.add_argument("--app-log", default="bench_app.log")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url yoki BENCH_DATABASE_URL kerak")
+    return args
+
+
+if __name__ == "__main__":
+    random.seed(int(os.getenv("BENCH_SEED", "42")))
+    asyncio.run(main_async(parse_args()))
@@ -0,0 +1,265 @@
+"""
+Lokal Payme simulyatori - /payme Merchant API (JSON-RPC) uchun sinov va yuklama.
+
+Payme serveri o'rnida app.py ga CheckPerformTransaction -> CreateTransaction ->
+PerformTransaction ketma-ketligini yuboradi. Buyurtmalar oldin POST /api/orders
+orqali yaratiladi. app.py PAYME_MERCHANT_KEY bilan ishga tushirilgan bo'lishi kerak.
+
+Misollar:
+    # Protokol tekshiruvi: idempotentlik, xato kodlari, bekor qilish
+    python benchmarks/payme_sim.py --url http://127.0.0.1:3000 --key TEST_KEY scenario
+
+    # Yuklama: 500 buyurtmani 16 parallel "Payme" bilan to'lash
+    python benchmarks/payme_sim.py --url http://127.0.0.1:3000 --key TEST_KEY \\
+        load --orders 500 --concurrency 16 --output payme_results.json
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from http_bench import Workload, summarize  # noqa: E402
+
+
+class PaymeClient:
+    """Payme serveri tomonidan yuboriladigan JSON-RPC so'rovlari"""
+
+    def __init__(self, session, base_url, key, account_field="order_id"):
+        self.session = session
+        self.url = f"{base_url}/payme"
+        self.account_field = account_field
+        self.auth = "Basic " + base64.b64encode(f"Paycom:{key}".encode()).decode()
+        self.ids = itertools.count(1)
+
+    async def call(self, method, params, auth=None):
+        payload = {"jsonrpc": "2.0", "id": next(self.ids), "method": method, "params": params}
+        headers = {"Authorization": auth or self.auth}
+        async with self.session.post(self.url, json=payload, headers=headers) as resp:
+            return await resp.json()
+
+    def account(self, order_id):
+        return {self.account_field: order_id}
+
+    async def check_perform(self, order_id, amount):
+        return await self.call("CheckPerformTransaction", {"amount": amount, "account": self.account(order_id)})
+
+    async def create(self, payme_id, order_id, amount):
+        return await self.call("CreateTransaction", {
+            "id": payme_id,
+            "time": int(time.time() * 1000),
+            "amount": amount,
+            "account": self.account(order_id)
+        })
+
+    async def perform(self, payme_id):
+        return await self.call("PerformTransaction", {"id": payme_id})
+
+    async def cancel(self, payme_id, reason=5):
+        return await self.call("CancelTransaction", {"id": payme_id, "reason": reason})
+
+    async def check(self, payme_id):
+        return await self.call("CheckTransaction", {"id": payme_id})
+
+    async def statement(self, start, end):
+        return await self.call("GetStatement", {"from": start, "to": end})
+
+
+def new_payme_id():
+    # Payme tranzaksiya ID si - 24 belgili hex
+    return uuid.uuid4().hex[:24]
+
+
+async def create_order(session, workload):
+    payload = workload.random_order_payload()
+    async with session.post(f"{workload.base_url}/api/orders", json=payload) as resp:
+        body = await resp.json()
+        if resp.status != 201:
+            raise RuntimeError(f"Buyurtma yaratilmadi: {resp.status} {body}")
+        return body["order_id"], body["total"] * 100
+
+
+async def get_order(session, base_url, order_id):
+    async with session.get(f"{base_url}/api/orders/{order_id}") as resp:
+        return await resp.json()
+
+
+def error_code(response):
+    return (response.get("error") or {}).get("code")
+
+
+async def run_scenario(args):
+    failures = []
+
+    def expect(name, ok, detail=None):
+        print(f"{'✅' if ok else '❌'} {name}" + (f" - {detail}" if not ok and detail else ""))
+        if not ok:
+            failures.append(name)
+
+    async with aiohttp.ClientSession() as session:
+        payme = PaymeClient(session, args.url, args.key, args.account_field)
+        workload = Workload(args.url, [9_100_000])
+        order_id, amount = await create_order(session, workload)
+        started = int(time.time() * 1000)
+
+        response = await payme.call("CheckPerformTransaction", {"amount": amount, "account": payme.account(order_id)},
+                                    auth="Basic " + base64.b64encode(b"Paycom:wrong").decode())
+        expect("Noto'g'ri kalit -> -32504", error_code(response) == -32504, response)
+
+        response = await payme.check_perform("ORD_NOT_EXISTS", amount)
+        expect("Yo'q buyurtma -> -31050", error_code(response) == -31050, response)
+
+        response = await payme.check_perform(order_id, amount + 100)
+        expect("Noto'g'ri summa -> -31001", error_code(response) == -31001, response)
+
+        response = await payme.check_perform(order_id, amount)
+        expect("CheckPerformTransaction", response.get("result", {}).get("allow") is True, response)
+
+        payme_id = new_payme_id()
+        created = await payme.create(payme_id, order_id, amount)
+        expect("CreateTransaction", created.get("result", {}).get("state") == 1, created)
+
+        replay = await payme.create(payme_id, order_id, amount)
+        expect("CreateTransaction takrori - o'sha tranzaksiya",
+               replay.get("result", {}).get("transaction") == created.get("result", {}).get("transaction"), replay)
+
+        response = await payme.create(new_payme_id(), order_id, amount)
+        expect("Ikkinchi tranzaksiya -> -31052", error_code(response) == -31052, response)
+
+        paid_started = time.perf_counter()
+        performed = await payme.perform(payme_id)
+        perform_ms = (time.perf_counter() - paid_started) * 1000
+        expect("PerformTransaction", performed.get("result", {}).get("state") == 2, performed)
+
+        replay = await payme.perform(payme_id)
+        expect("PerformTransaction takrori - o'sha perform_time",
+               replay.get("result", {}).get("perform_time") == performed.get("result", {}).get("perform_time"), replay)
+
+        order = await get_order(session, args.url, order_id)
+        expect("Buyurtma to'langan (paid, pending)",
+               order.get("payment_status") == "paid" and order.get("status") == "pending", order)
+
+        response = await payme.check_perform(order_id, amount)
+        expect("To'langan buyurtma -> -31051", error_code(response) == -31051, response)
+
+        response = await payme.check(payme_id)
+        expect("CheckTransaction", response.get("result", {}).get("state") == 2, response)
+
+        response = await payme.statement(started - 1000, int(time.time() * 1000) + 1000)
+        ids = [tx["id"] for tx in response.get("result", {}).get("transactions", [])]
+        expect("GetStatement", payme_id in ids, response)
+
+        cancelled = await payme.cancel(payme_id)
+        expect("CancelTransaction (bajarilgandan keyin) -> -2",
+               cancelled.get("result", {}).get("state") == -2, cancelled)
+
+        replay = await payme.cancel(payme_id)
+        expect("CancelTransaction takrori",
+               replay.get("result", {}).get("cancel_time") == cancelled.get("result", {}).get("cancel_time"), replay)
+
+        order = await get_order(session, args.url, order_id)
+        expect("Buyurtma qaytarilgan (refunded, rejected)",
+               order.get("payment_status") == "refunded" and order.get("status") == "rejected", order)
+
+        response = await payme.perform(new_payme_id())
+        expect("Yo'q tranzaksiya -> -31003", error_code(response) == -31003, response)
+
+    print(f"⏱ PerformTransaction: {perform_ms:.1f} ms")
+    if failures:
+        print(f"❌ {len(failures)} ta tekshiruv o'tmadi")
+        sys.exit(1)
+    print("✅ Barcha tekshiruvlar o'tdi")
+
+
+async def run_load(args):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        payme = PaymeClient(session, args.url, args.key, args.account_field)
+        workload = Workload(args.url, [9_200_000 + i for i in range(50)])
+
+        # Buyurtmalar oldindan - o'lchovga faqat Payme chaqiruvlari kiradi
+        orders = []
+        for _ in range(args.orders):
+            orders.append(await create_order(session, workload))
+        queue = asyncio.Queue()
+        for order in orders:
+            queue.put_nowait(order)
+
+        async def timed(method, coro):
+            started = time.perf_counter()
+            response = await coro
+            latencies[method].append((time.perf_counter() - started) * 1000)
+            if "error" in response:
+                errors[f"{method}: {error_code(response)}"] += 1
+                return None
+            return response
+
+        async def worker():
+            while not queue.empty():
+                order_id, amount = queue.get_nowait()
+                payme_id = new_payme_id()
+                started = time.perf_counter()
+                if not await timed("CheckPerformTransaction", payme.check_perform(order_id, amount)):
+                    continue
+                if not await timed("CreateTransaction", payme.create(payme_id, order_id, amount)):
+                    continue
+                if await timed("PerformTransaction", payme.perform(payme_id)):
+                    latencies["payment"].append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        duration = time.perf_counter() - started
+
+    report = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "orders": args.orders,
+            "concurrency": args.concurrency
+        },
+        "duration_s": round(duration, 3),
+        "errors": dict(errors),
+        "methods": {method: summarize(values, duration) for method, values in latencies.items()}
+    }
+    for method, result in report["methods"].items():
+        lat = result["latency_ms"]
+        print(f"{method:<24} n={result['requests']:<6} p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms")
+    if errors:
+        print(f"❌ Xatolar: {dict(errors)}")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Natija: {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Lokal Payme Merchant API simulyatori")
+    parser.add_argument("--url", default="http://127.0.0.1:3000", help="app.py manzili")
+    parser.add_argument("--key", default=os.getenv("PAYME_MERCHANT_KEY"),
+                        help="Kassa kaliti (PAYME_MERCHANT_KEY)")
+    parser.add_argument("--account-field", default=os.getenv("PAYME_ACCOUNT_FIELD", "order_id"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("scenario", help="Protokol tekshiruvi")
+    load = sub.add_parser("load", help="Yuklama: ko'p buyurtmani parallel to'lash")
+    load.add_argument("--orders", type=int, default=200)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--output", default="payme_results.json")
+    args = parser.parse_args()
+    if not args.key:
+        parser.error("--key yoki PAYME_MERCHANT_KEY kerak")
+    args.url = args.url.rstrip("/")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(run_scenario(args) if args.command == "scenario" else run_load(args))
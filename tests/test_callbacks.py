@@ -0,0 +1,71 @@
+import base64
+from types import SimpleNamespace
+
+import app
+
+
+def make_order(order_pk, change_seq):
+    return SimpleNamespace(id=order_pk, change_seq=change_seq)
+
+
+def test_packed_roundtrip():
+    data = app.order_callback('accept', make_order(42, 1007))
+    route, args = app.decode_callback(data)
+    assert route.name == 'accept'
+    assert (args.order_pk, args.version, args.order_id) == (42, 1007, None)
+
+
+def test_packed_fits_telegram_limit_for_max_values():
+    data = app.order_callback('confirm', make_order(2 ** 32 - 1, 2 ** 64 - 1))
+    assert len(data.encode()) <= 64
+    assert len(data) == 19
+    route, args = app.decode_callback(data)
+    assert route.name == 'confirm'
+    assert (args.order_pk, args.version) == (2 ** 32 - 1, 2 ** 64 - 1)
+
+
+def test_missing_change_seq_packs_as_zero():
+    route, args = app.decode_callback(app.order_callback('reject', make_order(7, None)))
+    assert route.name == 'reject'
+    assert args.version == 0
+
+
+def test_malformed_base64_is_rejected():
+    assert app.decode_callback('~!!not-base64!!') == (None, None)
+    assert app.decode_callback('~') == (None, None)
+
+
+def test_wrong_payload_length_is_rejected():
+    short = base64.urlsafe_b64encode(b'a\x00\x00').rstrip(b'=').decode()
+    assert app.decode_callback('~' + short) == (None, None)
+
+
+def test_unknown_route_code_is_rejected():
+    packed = app._CALLBACK_STRUCT.pack(b'Z', 1, 1)
+    data = '~' + base64.urlsafe_b64encode(packed).rstrip(b'=').decode()
+    assert app.decode_callback(data) == (None, None)
+
+
+def test_plain_and_arg_routes():
+    route, args = app.decode_callback('admin_stats')
+    assert route.name == 'admin_stats'
+    assert args.arg is None
+    route, args = app.decode_callback('bulk_accept')
+    assert route.name == 'bulk'
+    assert args.arg == 'accept'
+
+
+def test_legacy_prefixes():
+    route, args = app.decode_callback('accept_ORD_1700000000000_ab12')
+    assert route.name == 'accept'
+    assert args.order_id == 'ORD_1700000000000_ab12'
+    assert args.order_pk is None
+    # "cancel_accept_" "accept_" bilan adashtirilmaydi
+    route, args = app.decode_callback('cancel_accept_ORD_1')
+    assert route.name == 'cancel_accept'
+    assert args.order_id == 'ORD_1'
+
+
+def test_unknown_data():
+    assert app.decode_callback('nothing_here') == (None, None)
+    assert app.decode_callback('') == (None, None)
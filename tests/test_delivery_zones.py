@@ -0,0 +1,115 @@
+import json
+
+import app
+
+SQUARE = [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0)]
+
+
+def polygon(*rings):
+    return {'type': 'Polygon', 'coordinates': [list(map(list, ring)) for ring in rings]}
+
+
+def box(x1, y1, x2, y2):
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)]
+
+
+def make_zone(name, geometry, fee=None):
+    return app.DeliveryZone(name, fee, app._zone_polygons(geometry))
+
+
+def test_point_in_ring_inside_and_outside():
+    assert app._point_in_ring(0.5, 0.5, SQUARE)
+    assert not app._point_in_ring(1.5, 0.5, SQUARE)
+    assert not app._point_in_ring(-0.1, 0.5, SQUARE)
+
+
+def test_point_in_ring_edges_are_half_open():
+    # Chap va pastki qirralar ichkarida, o'ng va yuqorisi tashqarida
+    assert app._point_in_ring(0.0, 0.5, SQUARE)
+    assert app._point_in_ring(0.5, 0.0, SQUARE)
+    assert not app._point_in_ring(1.0, 0.5, SQUARE)
+    assert not app._point_in_ring(0.5, 1.0, SQUARE)
+
+
+def test_point_in_ring_vertices():
+    assert app._point_in_ring(0.0, 0.0, SQUARE)
+    assert not app._point_in_ring(1.0, 0.0, SQUARE)
+    assert not app._point_in_ring(1.0, 1.0, SQUARE)
+    assert not app._point_in_ring(0.0, 1.0, SQUARE)
+
+
+def test_shared_edge_belongs_to_exactly_one_zone():
+    west = make_zone('west', polygon(box(69.20, 41.30, 69.25, 41.35)))
+    east = make_zone('east', polygon(box(69.25, 41.30, 69.30, 41.35)))
+    index = app.DeliveryZoneIndex([west, east], 0.01)
+    for lat in (41.30, 41.31, 41.325, 41.349):
+        hits = [zone.name for zone in (west, east) if zone.contains(lat, 69.25)]
+        assert hits == ['east']
+        assert index.find(lat, 69.25) is east
+
+
+def test_hole_is_excluded():
+    zone = make_zone('ring', polygon(box(69.20, 41.30, 69.30, 41.40), box(69.24, 41.34, 69.26, 41.36)))
+    index = app.DeliveryZoneIndex([zone], 0.01)
+    assert index.find(41.35, 69.25) is None
+    assert index.find(41.31, 69.21) is zone
+
+
+def test_concave_zone_cell_candidate_outside_polygon():
+    # "L" shakli: bbox ichida, lekin poligondan tashqari nuqta
+    l_shape = [(69.20, 41.30), (69.30, 41.30), (69.30, 41.32), (69.22, 41.32),
+               (69.22, 41.40), (69.20, 41.40), (69.20, 41.30)]
+    zone = make_zone('L', polygon(l_shape))
+    index = app.DeliveryZoneIndex([zone], 0.01)
+    assert index.find(41.35, 69.28) is None
+    assert index.find(41.31, 69.28) is zone
+    assert index.find(41.35, 69.21) is zone
+
+
+def test_points_outside_grid():
+    zone = make_zone('center', polygon(box(69.20, 41.30, 69.25, 41.35)))
+    index = app.DeliveryZoneIndex([zone], 0.01)
+    assert index.find(41.50, 69.50) is None
+    assert index.find(-41.32, -69.22) is None
+    assert index.find(0.0, 0.0) is None
+
+
+def test_overlapping_zones_prefer_file_order():
+    inner = make_zone('inner', polygon(box(69.22, 41.32, 69.23, 41.33)))
+    outer = make_zone('outer', polygon(box(69.20, 41.30, 69.25, 41.35)))
+    index = app.DeliveryZoneIndex([inner, outer], 0.01)
+    assert index.find(41.325, 69.225) is inner
+    assert index.find(41.31, 69.21) is outer
+
+
+def test_negative_coordinates_cell_floor():
+    zone = make_zone('south_west', polygon(box(-0.015, -0.015, -0.005, -0.005)))
+    index = app.DeliveryZoneIndex([zone], 0.01)
+    assert index.find(-0.01, -0.01) is zone
+    assert index.find(0.001, 0.001) is None
+
+
+def test_multipolygon_and_invalid_features(tmp_path):
+    path = tmp_path / 'zones.json'
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'name': 'islands', 'fee': 15000},
+         'geometry': {'type': 'MultiPolygon', 'coordinates': [
+             [list(map(list, box(69.20, 41.30, 69.21, 41.31)))],
+             [list(map(list, box(69.28, 41.38, 69.29, 41.39)))],
+         ]}},
+        {'type': 'Feature', 'properties': {'name': 'line'},
+         'geometry': {'type': 'LineString', 'coordinates': [[69.2, 41.3], [69.3, 41.4]]}},
+        {'type': 'Feature', 'properties': {'name': 'degenerate'},
+         'geometry': {'type': 'Polygon', 'coordinates': [[[69.2, 41.3], [69.3, 41.4]]]}},
+    ]}), encoding='utf-8')
+    index = app.load_delivery_zones(str(path))
+    assert [zone.name for zone in index.zones] == ['islands']
+    assert index.by_name['islands'].fee == 15000
+    assert index.find(41.305, 69.205).name == 'islands'
+    assert index.find(41.385, 69.285).name == 'islands'
+    assert index.find(41.35, 69.25) is None
+
+
+def test_missing_zone_file():
+    assert app.load_delivery_zones('') is None
+    assert app.load_delivery_zones('/nonexistent/zones.json') is None
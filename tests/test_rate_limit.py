@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_starts_full_and_drains(clock):
+    store = app.TokenBucketStore(max_keys=10)
+    results = [store.take('k', 3, 1.0)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+
+
+def test_bucket_refills_at_rate(clock):
+    store = app.TokenBucketStore(max_keys=10)
+    for _ in range(2):
+        store.take('k', 2, 0.5)
+    assert store.take('k', 2, 0.5)[0] is False
+    clock.now += 1.0
+    assert store.take('k', 2, 0.5)[0] is False
+    clock.now += 1.0
+    allowed, tokens = store.take('k', 2, 0.5)
+    assert allowed is True
+    assert tokens == pytest.approx(0.0)
+
+
+def test_refill_is_capped_at_capacity(clock):
+    store = app.TokenBucketStore(max_keys=10)
+    store.take('k', 2, 1.0)
+    clock.now += 3600
+    allowed, tokens = store.take('k', 2, 1.0)
+    assert allowed is True
+    assert tokens == pytest.approx(1.0)
+
+
+def test_rejected_take_does_not_go_negative(clock):
+    store = app.TokenBucketStore(max_keys=10)
+    store.take('k', 1, 0.1)
+    for _ in range(3):
+        allowed, tokens = store.take('k', 1, 0.1)
+        assert allowed is False
+        assert tokens >= 0
+
+
+def test_lru_eviction_keeps_recently_used(clock):
+    store = app.TokenBucketStore(max_keys=2)
+    store.take('a', 1, 0.01)
+    store.take('b', 1, 0.01)
+    store.take('a', 1, 0.01)  # 'a' yangilandi - 'b' eng eski
+    store.take('c', 1, 0.01)
+    assert list(store.buckets) == ['a', 'c']
+    # Chiqarib tashlangan bucket to'liq boshlanadi
+    assert store.take('b', 1, 0.01)[0] is True
+    assert 'a' not in store.buckets
+
+
+def request(forwarded=None, remote='10.0.0.1'):
+    headers = {'X-Forwarded-For': forwarded} if forwarded is not None else {}
+    return SimpleNamespace(headers=headers, remote=remote)
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    def configure(trust=True, hops=1):
+        monkeypatch.setattr(app, 'RATE_LIMIT_TRUST_PROXY', trust)
+        monkeypatch.setattr(app, 'RATE_LIMIT_PROXY_HOPS', hops)
+    return configure
+
+
+def test_client_ip_uses_last_proxy_hop(proxy):
+    proxy(hops=1)
+    assert app.client_ip(request('6.6.6.6, 1.2.3.4')) == '1.2.3.4'
+    assert app.client_ip(request('1.2.3.4')) == '1.2.3.4'
+
+
+def test_client_ip_multiple_trusted_hops(proxy):
+    proxy(hops=2)
+    assert app.client_ip(request('6.6.6.6, 1.2.3.4, 172.16.0.5')) == '1.2.3.4'
+
+
+def test_client_ip_short_header_falls_back_to_remote(proxy):
+    proxy(hops=2)
+    assert app.client_ip(request('1.2.3.4')) == '10.0.0.1'
+    proxy(hops=1)
+    assert app.client_ip(request('')) == '10.0.0.1'
+    assert app.client_ip(request(' , ')) == '10.0.0.1'
+    assert app.client_ip(request()) == '10.0.0.1'
+
+
+def test_client_ip_without_trusted_proxy(proxy):
+    proxy(trust=False)
+    assert app.client_ip(request('1.2.3.4')) == '10.0.0.1'
+    proxy(hops=0)
+    assert app.client_ip(request('1.2.3.4')) == '10.0.0.1'
+    assert app.client_ip(request('1.2.3.4', remote=None)) == 'unknown'